@@ -0,0 +1,315 @@
+# George Whittington, Student ID: 20026036, 2022
+
+"""Times the busiest pages and model methods against a synthetic dataset, through the
+Flask test client, recording latency percentiles and the number of queries each makes.
+
+Run from the repository root with, for example:
+    python -m benchmarks.endpoints --dataset medium --save baseline.json
+    python -m benchmarks.endpoints --dataset medium --compare baseline.json
+"""
+
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import tempfile
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from time import perf_counter
+from typing import Callable, Dict
+
+import numpy as np
+from sqlalchemy import event
+
+from hotel_website import create_app
+from hotel_website.commands import (
+    create_db_manually, fill_db_manually, generate_load_data_manually, refresh_booking_facts_manually)
+from hotel_website.models import db, User, Location, Currency, Roomtype, Booking
+
+# Options for generate_load_data, on top of the fill-db data
+DATASETS = {
+    "small": {"locations": 0, "rooms_per_location": 0, "users": 50, "bookings": 2000},
+    "medium": {"locations": 10, "rooms_per_location": 100, "users": 1000, "bookings": 50000},
+    "large": {"locations": 50, "rooms_per_location": 150, "users": 10000, "bookings": 1000000}
+}
+
+PASSWORD = "password"
+
+BOOKING_FORM = {
+    "full_name": "Benchmark",
+    "email": "benchmark@example.com",
+    "address-address_1": "1 Test Street",
+    "address-postcode": "AB1 2CD",
+    "address-country": "GB",
+    "card_details-card_type": "V",
+    "card_details-card_number": "4111 1111 1111 1111",
+    "card_details-security_code": "123",
+    "card_details-expiry_date-expiry_month": 1,
+    "card_details-expiry_date-expiry_year": date.today().year + 1
+}
+
+
+class Benchmark:
+    """Holds the app, logged in clients and random inputs shared by every case."""
+    def __init__(self, app, seed: int):
+        self.app = app
+        self.rng = random.Random(seed)
+        self.queries = 0
+
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self._count_query)
+            self.location_ids = [location_id for location_id, in Location.query.with_entities(Location.id)]
+            self.room_type_ids = {room_type.id: room_type.max_occupants for room_type in Roomtype.query}
+            # The first generated user makes the most bookings, like a corporate account
+            self.username = User.query.filter(User.username.like("load_%")).order_by(User.id).first().username
+            self.pdf_booking_ids = [booking_id for booking_id, in Booking.query.with_entities(Booking.id).where(
+                Booking.booking_end >= date.today()).order_by(Booking.id).limit(5000)]
+            self.currency_ids = [currency_id for currency_id, in Currency.query.with_entities(Currency.id)]
+
+        self.user = self.login(self.username)
+        self.admin = self.login("admin")
+
+    def _count_query(self, *args) -> None:
+        self.queries += 1
+
+    def login(self, username: str):
+        client = self.app.test_client()
+        response = client.post("/login", data={"username": username, "password": PASSWORD})
+        if response.status_code != 302:
+            raise SystemExit(f"Couldn't log in as {username}.")
+        return client
+
+    def stay(self) -> dict:
+        """Returns random search arguments for a stay within the next three months."""
+        booking_start = date.today() + timedelta(days=self.rng.randrange(1, 80))
+        room_type = self.rng.choice(list(self.room_type_ids))
+        return {
+            "location": self.rng.choice(self.location_ids),
+            "room_type": room_type,
+            "booking_start": booking_start,
+            "booking_end": booking_start + timedelta(days=self.rng.randrange(1, 8)),
+            "guests": self.rng.randint(1, self.room_type_ids[room_type])
+        }
+
+    def month(self) -> date:
+        """Returns the first day of a random month within six months of today."""
+        today = date.today()
+        month = today.year * 12 + today.month - 1 + self.rng.randrange(-6, 6)
+        return date(month // 12, month % 12 + 1, 1)
+
+
+def query_string(stay: dict) -> dict:
+    return {key: value.isoformat() if isinstance(value, date) else value for key, value in stay.items()}
+
+
+def find_room_prices(bench: Benchmark) -> None:
+    stay = bench.stay()
+    with bench.app.app_context():
+        location = Location.query.get(stay["location"])
+        location.find_room_prices(
+            Roomtype.query.get(stay["room_type"]), stay["booking_start"], stay["booking_end"],
+            location.currency, stay["guests"])
+
+
+def rooms_available(bench: Benchmark) -> None:
+    stay = bench.stay()
+    with bench.app.app_context():
+        Location.query.get(stay["location"]).rooms_available(stay["booking_start"], stay["booking_end"])
+
+
+def get(client_name: str, path: Callable[[Benchmark], str], **kwargs) -> Callable[[Benchmark], None]:
+    def case(bench: Benchmark) -> None:
+        response = getattr(bench, client_name).get(path(bench), **kwargs)
+        if response.status_code >= 400:
+            raise SystemExit(f"{response.request.path} answered {response.status_code}.")
+    return case
+
+
+def monthly_bookings(bench: Benchmark) -> None:
+    get("admin", lambda bench: "/admin/analytics/monthly_bookings", query_string={
+        "location": bench.rng.choice(bench.location_ids), "month": bench.month().strftime("%Y-%m")})(bench)
+
+
+def post(client_name: str, path: str, data: Callable[[Benchmark], dict]) -> Callable[[Benchmark], None]:
+    def case(bench: Benchmark) -> None:
+        response = getattr(bench, client_name).post(path, data=data(bench))
+        if response.status_code >= 400:
+            raise SystemExit(f"{path} answered {response.status_code}.")
+    return case
+
+
+def search(bench: Benchmark) -> None:
+    stay = query_string(bench.stay())
+    del stay["room_type"]
+    get("user", lambda bench: "/search", query_string=stay)(bench)
+
+
+def room_get(bench: Benchmark) -> None:
+    get("user", lambda bench: "/room", query_string=query_string(bench.stay()))(bench)
+
+
+def room_post(bench: Benchmark) -> None:
+    response = bench.user.post("/room", query_string=query_string(bench.stay()), data=BOOKING_FORM)
+    if response.status_code != 302:
+        raise SystemExit(f"Booking a room answered {response.status_code}.")
+
+
+def month_range(bench: Benchmark) -> dict:
+    month = bench.month()
+    end_month = month + timedelta(days=monthrange(month.year, month.month)[1] + 62)
+    return {"month": month.strftime("%Y-%m"), "end_month": end_month.strftime("%Y-%m")}
+
+
+def occupancy_form(bench: Benchmark) -> dict:
+    start = bench.month()
+    return {
+        "start": start.isoformat(), "end": (start + timedelta(days=90)).isoformat(),
+        "locations": bench.rng.sample(bench.location_ids, min(5, len(bench.location_ids)))}
+
+
+def booking_pdf(bench: Benchmark) -> None:
+    # A random booking each time, so most PDFs are rendered rather than served from the cache
+    booking_id = bench.pdf_booking_ids[bench.rng.randrange(len(bench.pdf_booking_ids))]
+    get("admin", lambda bench: f"/booking_{booking_id}.pdf")(bench)
+
+
+CASES: Dict[str, Callable[[Benchmark], None]] = {
+    "find_room_prices": find_room_prices,
+    "rooms_available": rooms_available,
+    "search": search,
+    "room_get": room_get,
+    "room_post": room_post,
+    "my_account": get("user", lambda bench: "/my-account"),
+    "monthly_bookings": monthly_bookings,
+    "compare_bookings": post("admin", "/admin/analytics/compare_bookings", lambda bench: {
+        **month_range(bench), "locations": bench.rng.sample(bench.location_ids, min(5, len(bench.location_ids)))}),
+    "occupancy": post("admin", "/admin/analytics/occupancy", occupancy_form),
+    "revenue": post("admin", "/admin/analytics/revenue", lambda bench: {
+        **month_range(bench), "currency": bench.rng.choice(bench.currency_ids)}),
+    "booking_pdf": booking_pdf
+}
+
+
+def run_case(bench: Benchmark, case: Callable[[Benchmark], None], iterations: int, warmup: int) -> dict:
+    """Runs case warmup times untimed, then iterations times, returning latency percentiles
+    in milliseconds and the median and largest number of queries per run.
+    """
+    for _ in range(warmup):
+        case(bench)
+
+    latencies = []
+    queries = []
+    for _ in range(iterations):
+        bench.queries = 0
+        started = perf_counter()
+        case(bench)
+        latencies.append((perf_counter() - started) * 1000)
+        queries.append(bench.queries)
+
+    p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+    return {
+        "iterations": iterations,
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(max(latencies), 3),
+        "queries_median": int(np.median(queries)),
+        "queries_max": max(queries)
+    }
+
+
+def build_app(dataset: str, seed: int, database_uri: str = None):
+    app = create_app(testing=True)
+    app.config["PDF_CACHE_DIR"] = tempfile.mkdtemp(prefix="benchmark_pdf_cache_")
+    app.config["PDF_RENDER_WORKERS"] = 0
+    if database_uri:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    # A line for every request would bury the results
+    logging.getLogger("hotel_website.requests").setLevel(logging.WARNING)
+
+    with app.app_context():
+        create_db_manually()
+        fill_db_manually()
+        generate_load_data_manually(**DATASETS[dataset], seed=seed)
+        refresh_booking_facts_manually(full=True)
+
+    return app
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Returns a line describing each case slower, or making more queries, than its baseline."""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline["results"].get(name)
+        if previous is None:
+            continue
+
+        if result["p50_ms"] > previous["p50_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p50 {previous['p50_ms']:.1f}ms -> {result['p50_ms']:.1f}ms")
+        if result["queries_max"] > previous["queries_max"]:
+            regressions.append(f"{name}: queries {previous['queries_max']} -> {result['queries_max']}")
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dataset", choices=DATASETS, default="small", help="Size of the synthetic dataset.")
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES), help="Cases to run, all by default.")
+    parser.add_argument("--iterations", type=int, default=50, help="Number of timed runs of each case.")
+    parser.add_argument("--warmup", type=int, default=5, help="Number of untimed runs of each case first.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-uri", help="Database to build the dataset in, an in-memory SQLite one by default.")
+    parser.add_argument("--save", help="Writes the results to this JSON file, to use as a baseline.")
+    parser.add_argument("--compare", help="JSON file of an earlier run to check these results against.")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25,
+        help="How much slower than the baseline a case's p50 can be before it counts as a regression.")
+    args = parser.parse_args()
+
+    started = perf_counter()
+    app = build_app(args.dataset, args.seed, args.database_uri)
+    print(f"Built the {args.dataset} dataset in {perf_counter() - started:.1f}s")
+
+    bench = Benchmark(app, args.seed)
+    results = {}
+    print(f"{'case':<18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'queries':>9}")
+    for name in args.cases:
+        results[name] = result = run_case(bench, CASES[name], args.iterations, args.warmup)
+        print(
+            f"{name:<18}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['p99_ms']:>10.1f}"
+            f"{result['max_ms']:>10.1f}{result['queries_max']:>9}")
+
+    run = {
+        "dataset": args.dataset,
+        "options": DATASETS[args.dataset],
+        "seed": args.seed,
+        "iterations": args.iterations,
+        "python": platform.python_version(),
+        "created": datetime.utcnow().isoformat(timespec="seconds"),
+        "results": results
+    }
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(run, f, indent=2)
+        print(f"Saved the results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["dataset"] != args.dataset:
+            print(f"Warning: the baseline was run against the {baseline['dataset']} dataset.")
+
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Regression, {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+# George Whittington, Student ID: 20026036, 2022
+
+"""Replays a mix of simulated users' traffic against the site at a target concurrency
+and rate, reporting throughput, latency percentiles and error rates per endpoint.
+
+By default the app runs in-process, through the Flask test client, on a synthetic
+dataset. --serve runs the same app behind a local threaded HTTP server instead, and
+--url points at a server that is already running, which must have users made by
+generate-load-data. Run from the repository root with, for example:
+    python -m benchmarks.load_test --dataset medium --concurrency 16 --rate 50 --duration 60
+    python -m benchmarks.load_test --url http://127.0.0.1:5000 --concurrency 8 --duration 30
+"""
+
+import argparse
+import html
+import json
+import logging
+import platform
+import random
+import re
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+from collections import Counter, deque
+from datetime import date, datetime, timedelta
+from threading import Lock, Thread
+from time import perf_counter, sleep
+from typing import Dict, List, Tuple, Union
+from urllib.parse import urlencode
+
+import numpy as np
+from werkzeug.serving import make_server
+
+from benchmarks.endpoints import BOOKING_FORM, DATASETS, PASSWORD, build_app
+
+# Relative weights of each kind of request in the traffic
+DEFAULT_MIX = {"home": 20, "search": 30, "room": 15, "book": 5, "my_account": 15, "pdf": 15}
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]*)"')
+LOCATION_OPTION = re.compile(r'<option value="(\d+)"')
+ROOM_LINK = re.compile(r'href="(/room\?[^"]+)"')
+PDF_LINK = re.compile(r'href="(/booking_\d+\.pdf)"')
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Leaves redirects for the caller, as the test client does."""
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class ClientSession:
+    """Sends a user's requests straight to the app through the Flask test client."""
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method: str, path: str, data: dict = None) -> Tuple[int, str, bytes]:
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.headers.get("Location", ""), response.get_data()
+
+
+class HttpSession:
+    """Sends a user's requests to a server over HTTP, keeping their cookies."""
+    def __init__(self, base_url: str, timeout: float):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(), _NoRedirect())
+
+    def request(self, method: str, path: str, data: dict = None) -> Tuple[int, str, bytes]:
+        body = urlencode(data, doseq=True).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.headers.get("Location", ""), response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers.get("Location", ""), error.read()
+
+
+class VirtualUser:
+    """A logged in user browsing the site, who books rooms they have found by searching
+    and downloads the PDFs of bookings listed on their account.
+    """
+    def __init__(self, session: Union[ClientSession, HttpSession], username: str, rng: random.Random):
+        self.session = session
+        self.username = username
+        self.rng = rng
+        self.csrf_token = None
+        self.location_ids = []
+        self.room_links = deque(maxlen=20)
+        self.pdf_links = []
+
+    def fetch(self, method: str, path: str, data: dict = None) -> Tuple[int, str, float, str]:
+        """Sends a request, returning its status, redirect location, the time it finished and its body."""
+        if data is not None and self.csrf_token:
+            data = {**data, "csrf_token": self.csrf_token}
+
+        status, location, body = self.session.request(method, path, data)
+        finished = perf_counter()
+
+        text = body.decode(errors="replace")
+        token = CSRF_TOKEN.search(text)
+        if token:
+            self.csrf_token = token.group(1)
+
+        return status, location, finished, text
+
+    def login(self) -> None:
+        self.fetch("GET", "/login")
+        status, _, _, _ = self.fetch("POST", "/login", {"username": self.username, "password": PASSWORD})
+        if status != 302:
+            raise SystemExit(f"Couldn't log in as {self.username}, answered {status}.")
+
+        _, _, _, text = self.fetch("GET", "/")
+        self.location_ids = [int(location_id) for location_id in LOCATION_OPTION.findall(text)]
+        if not self.location_ids:
+            raise SystemExit("Couldn't find any locations on the home page.")
+
+    def home(self) -> Tuple[str, bool, float]:
+        status, _, finished, _ = self.fetch("GET", "/")
+        return "home", status == 200, finished
+
+    def search(self) -> Tuple[str, bool, float]:
+        booking_start = date.today() + timedelta(days=self.rng.randrange(1, 80))
+        path = "/search?" + urlencode({
+            "location": self.rng.choice(self.location_ids),
+            "booking_start": booking_start.isoformat(),
+            "booking_end": (booking_start + timedelta(days=self.rng.randrange(1, 8))).isoformat(),
+            "guests": self.rng.randint(1, 2)})
+
+        status, _, finished, text = self.fetch("GET", path)
+        self.room_links.extend(html.unescape(link) for link in ROOM_LINK.findall(text))
+        return "search", status == 200, finished
+
+    def room(self) -> Tuple[str, bool, float]:
+        if not self.room_links:
+            return self.search()
+
+        status, _, finished, _ = self.fetch("GET", self.rng.choice(self.room_links))
+        return "room", status == 200, finished
+
+    def book(self) -> Tuple[str, bool, float]:
+        if not self.room_links:
+            return self.search()
+
+        # Each room found is only booked once, the next search finds more
+        link = self.room_links.pop()
+        status, location, finished, _ = self.fetch("POST", link, BOOKING_FORM)
+        return "book", status == 302 and "/room_confirm/" in location, finished
+
+    def my_account(self) -> Tuple[str, bool, float]:
+        status, _, finished, text = self.fetch("GET", "/my-account")
+        self.pdf_links = PDF_LINK.findall(text)
+        return "my_account", status == 200, finished
+
+    def pdf(self) -> Tuple[str, bool, float]:
+        if not self.pdf_links:
+            return self.my_account()
+
+        status, _, finished, _ = self.fetch("GET", self.rng.choice(self.pdf_links))
+        return "pdf", status == 200, finished
+
+
+class Schedule:
+    """Hands out the times requests are due, spaced so that between them all the
+    workers send rate requests a second, or straight away if rate is 0, until
+    duration seconds have passed.
+    """
+    def __init__(self, rate: float, duration: float):
+        self.lock = Lock()
+        self.started = perf_counter()
+        self.ends = self.started + duration
+        self.interval = 1 / rate if rate else 0
+        self.next_due = self.started
+
+    def next(self) -> Union[float, None]:
+        with self.lock:
+            if self.interval:
+                due = self.next_due
+                self.next_due += self.interval
+            else:
+                due = perf_counter()
+
+        return due if due < self.ends else None
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """Parses weights given as "home=20,search=30,...", leaving out kinds of request as 0."""
+    mix = {name: 0.0 for name in DEFAULT_MIX}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in mix:
+            raise argparse.ArgumentTypeError(f"Unknown request {name.strip()!r}, choose from {', '.join(mix)}.")
+        mix[name.strip()] = float(weight)
+
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("At least one weight must be above 0.")
+    return mix
+
+
+def run(users: List[VirtualUser], mix: Dict[str, float], rate: float, duration: float) -> Tuple[dict, float]:
+    """Runs a worker thread for each user until duration has passed, returning each
+    endpoint's latencies in seconds, statuses and error count, and the time taken.
+
+    Latency is measured from when a request was due rather than when it was sent, so
+    time spent waiting for a free worker, when the site can't keep up with the rate,
+    is counted rather than hidden.
+    """
+    names, weights = list(mix), list(mix.values())
+    schedule = Schedule(rate, duration)
+    results = {name: {"latencies": [], "errors": 0, "failures": Counter()} for name in DEFAULT_MIX}
+    lock = Lock()
+
+    def worker(user: VirtualUser) -> None:
+        local = {name: {"latencies": [], "errors": 0, "failures": Counter()} for name in DEFAULT_MIX}
+        while True:
+            due = schedule.next()
+            if due is None:
+                break
+            sleep(max(0.0, due - perf_counter()))
+
+            action = user.rng.choices(names, weights)[0]
+            try:
+                name, ok, finished = getattr(user, action)()
+            except Exception as error:
+                name, ok, finished = action, False, perf_counter()
+                local[name]["failures"][type(error).__name__] += 1
+            else:
+                if not ok:
+                    local[name]["failures"]["unexpected response"] += 1
+
+            local[name]["latencies"].append(finished - due)
+            local[name]["errors"] += not ok
+
+        with lock:
+            for name, result in local.items():
+                results[name]["latencies"] += result["latencies"]
+                results[name]["errors"] += result["errors"]
+                results[name]["failures"] += result["failures"]
+
+    threads = [Thread(target=worker, args=(user,)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results, perf_counter() - schedule.started
+
+
+def summarise(results: dict, elapsed: float) -> dict:
+    """Returns throughput, error rate and latency percentiles in milliseconds per endpoint,
+    and over all of them.
+    """
+    summary = {}
+    all_latencies = []
+    all_errors = 0
+    for name, result in results.items():
+        if not result["latencies"]:
+            continue
+        all_latencies += result["latencies"]
+        all_errors += result["errors"]
+        summary[name] = _stats(result["latencies"], result["errors"], elapsed)
+        summary[name]["failures"] = dict(result["failures"])
+
+    if all_latencies:
+        summary["all"] = _stats(all_latencies, all_errors, elapsed)
+    return summary
+
+
+def _stats(latencies: List[float], errors: int, elapsed: float) -> dict:
+    p50, p95, p99 = np.percentile(latencies, (50, 95, 99)) * 1000
+    return {
+        "requests": len(latencies),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "error_rate": round(errors / len(latencies), 4),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(max(latencies) * 1000, 3)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--url", help="Base URL of a running server to load, rather than running the app here.")
+    target.add_argument("--serve", action="store_true", help="Serves the app on a local port and loads it over HTTP.")
+    parser.add_argument(
+        "--dataset", choices=DATASETS, default="small", help="Size of the synthetic dataset, unless --url is given.")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=DEFAULT_MIX,
+        help=f"Weights of each kind of request, by default {','.join(f'{k}={v}' for k, v in DEFAULT_MIX.items())}.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of users sending requests at once.")
+    parser.add_argument(
+        "--rate", type=float, default=0,
+        help="Requests a second to send between all the users, 0 for as fast as they can.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to send requests for.")
+    parser.add_argument("--users", type=int, default=20, help="Number of generated users, load_1 upwards, to log in as.")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each response over HTTP.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="Writes the results to this JSON file.")
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base_url = args.url
+    else:
+        started = perf_counter()
+        # A file rather than an in-memory database, so each thread gets its own connection
+        database_uri = f"sqlite:///{tempfile.mkdtemp(prefix='load_test_')}/hotel_website.db"
+        app = build_app(args.dataset, args.seed, database_uri)
+        print(f"Built the {args.dataset} dataset in {perf_counter() - started:.1f}s")
+
+        if args.serve:
+            # Forms need their CSRF token, as they do on a real server
+            app.config["WTF_CSRF_ENABLED"] = True
+            logging.getLogger("werkzeug").setLevel(logging.WARNING)
+            server = make_server("127.0.0.1", 0, app, threaded=True)
+            Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f"http://127.0.0.1:{server.server_port}"
+            print(f"Serving on {base_url}")
+
+    def session():
+        return HttpSession(base_url, args.timeout) if args.url or args.serve else ClientSession(app)
+
+    users = [
+        VirtualUser(session(), f"load_{i % args.users + 1}", random.Random(args.seed * 1000 + i))
+        for i in range(args.concurrency)]
+    try:
+        for user in users:
+            user.login()
+    except OSError as error:
+        raise SystemExit(f"Couldn't reach {base_url}: {error}")
+
+    rate = f"{args.rate:g} requests a second" if args.rate else "as fast as possible"
+    print(f"Sending {rate} from {args.concurrency} users for {args.duration:g}s")
+    results, elapsed = run(users, args.mix, args.rate, args.duration)
+    if server is not None:
+        server.shutdown()
+
+    summary = summarise(results, elapsed)
+    print(f"{'endpoint':<12}{'requests':>10}{'req/s':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in summary.items():
+        print(
+            f"{name:<12}{stats['requests']:>10}{stats['throughput']:>9.1f}{stats['error_rate']:>8.1%}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}")
+    for name, stats in summary.items():
+        for failure, count in stats.get("failures", {}).items():
+            print(f"{name}: {count} x {failure}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "target": args.url or ("serve" if args.serve else "in-process"),
+                "dataset": None if args.url else args.dataset,
+                "mix": args.mix,
+                "concurrency": args.concurrency,
+                "rate": args.rate,
+                "duration": round(elapsed, 3),
+                "seed": args.seed,
+                "python": platform.python_version(),
+                "created": datetime.utcnow().isoformat(timespec="seconds"),
+                "results": summary
+            }, f, indent=2)
+        print(f"Saved the results to {args.save}")
+
+    if summary.get("all", {}).get("error_rate"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
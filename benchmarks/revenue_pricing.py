@@ -0,0 +1,106 @@
+# George Whittington, Student ID: 20026036, 2022
+
+"""Compares pricing bookings one at a time with Booking.find_room_prices against
+pricing them all at once with find_booking_prices_batch, as the revenue report does.
+
+Run from the repository root with: python -m benchmarks.revenue_pricing
+"""
+
+import argparse
+import random
+from datetime import date, timedelta
+from time import perf_counter
+
+from hotel_website import create_app
+from hotel_website.commands import create_db_manually, fill_db_manually
+from hotel_website.models import db, Location, Currency, Roomtype, Room, Booking
+from hotel_website.pricing import find_booking_prices_batch
+
+
+def add_bookings(count: int, seed: int) -> None:
+    """Inserts count bookings spread over the next year, at random rooms."""
+    rng = random.Random(seed)
+    room_ids = [room_id for room_id, in Room.query.with_entities(Room.id)]
+    currency_ids = [currency_id for currency_id, in Currency.query.with_entities(Currency.id)]
+    today = date.today()
+
+    bookings = []
+    for _ in range(count):
+        booking_start = today + timedelta(days=rng.randrange(365))
+        bookings.append({
+            "guests": 1, "booking_start": booking_start,
+            "booking_end": booking_start + timedelta(days=rng.randrange(14)),
+            "name": "Benchmark", "email": "benchmark@example.com", "address_1": "1 Test Street",
+            "postcode": "AB1 2CD", "country": "GB", "card_type": "V", "card_number": "4111111111111111",
+            "expiry_date": date(today.year + 1, 1, 1), "currency_id": rng.choice(currency_ids),
+            "room_id": rng.choice(room_ids)})
+
+    # Inserted without the ORM, as room inventory isn't needed here
+    db.session.execute(Booking.__table__.insert(), bookings)
+    db.session.commit()
+
+
+def price_one_at_a_time(currency: Currency) -> list:
+    """The per-booking path, each booking's room, location and room type are loaded lazily."""
+    return [
+        booking.room.location.find_room_prices(
+            room_type=booking.room.room_type, booking_start=booking.booking_start,
+            booking_end=booking.booking_end, currency=currency, guests=booking.guests,
+            date_booked=booking.date_created.date())
+        for booking in Booking.query.order_by(Booking.id)]
+
+
+def price_in_bulk(currency: Currency) -> list:
+    """The revenue report's path, a single joined query priced in one batch."""
+    bookings = Booking.query.with_entities(
+        Booking.id, Location, Roomtype, Booking.guests, Booking.booking_start, Booking.booking_end,
+        Booking.date_created
+    ).join(Booking.room).join(Room.location).join(Room.room_type).order_by(Booking.id)
+
+    return find_booking_prices_batch(
+        ((location, room_type, guests, booking_start, booking_end, date_created.date())
+         for _, location, room_type, guests, booking_start, booking_end, date_created in bookings),
+        currency)
+
+
+def best_time(function, currency: Currency, repeat: int) -> tuple:
+    """Returns the fastest of repeat runs of function, each with an empty session."""
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        currency = db.session.merge(currency)
+
+        started = perf_counter()
+        result = function(currency)
+        times.append(perf_counter() - started)
+
+    return min(times), result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--bookings", type=int, default=5000, help="Number of bookings to price.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times each path is timed.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = create_app(testing=True)
+    with app.app_context():
+        create_db_manually()
+        fill_db_manually()
+        add_bookings(args.bookings, args.seed)
+
+        currency = Currency.query.filter_by(acronym="EUR").first()
+        one_at_a_time, expected = best_time(price_one_at_a_time, currency, args.repeat)
+        in_bulk, result = best_time(price_in_bulk, currency, args.repeat)
+
+        if result != expected:
+            raise SystemExit("The bulk prices don't match the per-booking prices.")
+
+        print(f"Priced {args.bookings} bookings, best of {args.repeat} runs:")
+        print(f"  one at a time: {one_at_a_time * 1000:.1f}ms")
+        print(f"  in bulk:       {in_bulk * 1000:.1f}ms ({one_at_a_time / in_bulk:.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
@@ -35,17 +35,30 @@ def create_app(testing=False):
     db.init_app(app)
 
     from . import hotels, auth, admin, commands
+    from .cache import reference_cache, search_cache, user_cache
+    from .pdfs import booking_pdf_cache, booking_pdf_render_queue
+    from .passwords import PasswordHashingBusy, password_hasher
+    from .instrumentation import request_instrumentation
+    from .metrics import metrics
     app.register_blueprint(auth.bp)
     app.register_blueprint(hotels.bp)
     app.register_blueprint(commands.bp, cli_group=None)
 
     auth.login_manager.init_app(app)
     admin.admin.init_app(app)  # Admin's views get registered here
+    reference_cache.init_app(app)
+    search_cache.init_app(app)
+    user_cache.init_app(app)
+    booking_pdf_cache.init_app(app)
+    booking_pdf_render_queue.init_app(app)
+    password_hasher.init_app(app)
+    request_instrumentation.init_app(app)
+    metrics.init_app(app)
 
     # Provide currency data to all templates during rendering
     @app.context_processor
     def utility_processor():
-        currencies = Currency.query.all()
+        currencies = reference_cache.all(Currency)
         return dict(currencies=currencies)
 
     @app.errorhandler(401)
@@ -58,4 +71,9 @@ def create_app(testing=False):
         error_msg = "That page could not be found."
         return render_template("error.html", error_no=404, error_msg=error_msg), 404
 
+    @app.errorhandler(PasswordHashingBusy)
+    def error_password_hashing_busy(error):
+        error_msg = "The website is busy, please try again in a moment."
+        return render_template("error.html", error_no=503, error_msg=error_msg), 503, {"Retry-After": "1"}
+
     return app
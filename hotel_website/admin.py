@@ -1,19 +1,35 @@
 # George Whittington, Student ID: 20026036, 2022
 
 from calendar import monthrange
-from datetime import date
+from collections import deque
+from datetime import date, datetime
+from typing import List, Tuple
 
-from flask import redirect, url_for, request, flash
+from flask import redirect, url_for, request, flash, current_app, Response, stream_with_context
 from flask_admin import Admin, AdminIndexView, expose, BaseView
 from flask_admin.contrib.sqla import ModelView
 import flask_login
-from sqlalchemy import text
+import numpy as np
+from sqlalchemy import case, literal, select, union_all
+from sqlalchemy.orm import contains_eager, joinedload
 from sqlalchemy.sql import func
+from werkzeug.utils import secure_filename
 from wtforms import StringField
 
-from .constants import ROOM_TYPES, COUNTRIES_TUPLES, CARD_TYPES_TUPLES
-from .forms import MonthAndLocationForm, MonthAndLocationsForm
-from .models import db, User, Location, Currency, Roomtype, Room, Booking
+from .cache import reference_cache
+from .constants import ROOM_TYPES, COUNTRIES_TUPLES, CARD_TYPES_TUPLES, CURRENCY_SYMBOLS, ANALYTICS_PAGE_SIZE
+from .forms import MonthAndLocationForm, MonthAndLocationsForm, DateRangeAndLocationsForm, MonthRangeAndCurrencyForm
+from .models import db, User, Location, Currency, Roomtype, Room, Booking, BookingDailyFact, RollupWatermark
+from .pdfs import booking_pdf_cache, booking_pdf_render_queue, stream_zip
+from .pricing import find_booking_prices_batch
+from .rollups import BOOKING_FACTS, occupancy_report
+
+
+def rooms_with_names():
+    """Returns a query for rooms with the location and room type they are named after,
+    so select fields listing rooms don't load them one room at a time.
+    """
+    return Room.query.options(joinedload(Room.location), joinedload(Room.room_type))
 
 
 class CustomIndexView(AdminIndexView):
@@ -40,6 +56,14 @@ class CustomModelView(ModelView):
     def inaccessible_callback(self, name, **kwargs):
         return redirect(url_for("auth.login", next=request.url))
 
+    def after_model_change(self, form, model, is_created):
+        reference_cache.invalidate(self.model)
+        booking_pdf_cache.invalidate(self.model)
+
+    def after_model_delete(self, model):
+        reference_cache.invalidate(self.model)
+        booking_pdf_cache.invalidate(self.model)
+
 
 class BookingAnalyticsViews(BaseView):
     @expose("/")
@@ -50,83 +74,331 @@ class BookingAnalyticsViews(BaseView):
     def monthly_bookings(self):
         form = MonthAndLocationForm()
 
-        locations = Location.query.with_entities(Location.id, Location.name).order_by(Location.name).all()
-        form.location.choices = [(loc_id, loc_name) for loc_id, loc_name in locations]
+        locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
+        form.location.choices = [(loc.id, loc.name) for loc in locations]
 
         if request.method == "POST":
             if form.validate_on_submit():
-                month_start = form.month.data
-                month_end = date(
-                    year=month_start.year,
-                    month=month_start.month,
-                    day=monthrange(month_start.year, month_start.month)[1])
-
-                bookings = Location.query.with_entities(Booking).join(Location.rooms, Room.bookings).where(
-                    Location.id == form.location.data,
-                    # Logic for testing if there is any overlap of ranges from:
-                    # https://stackoverflow.com/a/3269471
-                    month_start <= Booking.booking_end,
-                    Booking.booking_start <= month_end).all()
-
-                return self.render(
-                    "/admin/monthly_bookings.html", form=form,
-                    bookings=bookings, room_types=ROOM_TYPES)
+                return redirect(url_for(
+                    "analytics.monthly_bookings", location=form.location.data,
+                    month=form.month.data.strftime("%Y-%m")))
 
             flash("Please enter a location.")
+            return self.render("/admin/monthly_bookings.html", form=form)
+
+        location = request.args.get("location", type=int)
+        month_start = request.args.get("month", type=lambda month: datetime.strptime(month, "%Y-%m").date())
+        after = request.args.get("after", type=int)
+        before = request.args.get("before", type=int)
+
+        if location not in [loc.id for loc in locations] or month_start is None:
+            return self.render("/admin/monthly_bookings.html", form=form)
+
+        form.location.data = location
+        form.month.data = month_start
+        month_end = date(
+            year=month_start.year,
+            month=month_start.month,
+            day=monthrange(month_start.year, month_start.month)[1])
+
+        in_month = (
+            Room.location_id == location,
+            # Logic for testing if there is any overlap of ranges from:
+            # https://stackoverflow.com/a/3269471
+            month_start <= Booking.booking_end,
+            Booking.booking_start <= month_end)
+
+        # Bookings overlapping the month are those staying on its first night, plus those arriving later in it
+        first_night = BookingDailyFact.night == month_start
+        summary = BookingDailyFact.query.with_entities(
+            func.coalesce(func.sum(case(
+                (first_night, BookingDailyFact.rooms_sold), else_=BookingDailyFact.arrivals)), 0).label("total_bookings"),
+            func.coalesce(func.sum(case(
+                (first_night, BookingDailyFact.guests), else_=BookingDailyFact.arrival_guests)), 0).label("total_guests"),
+            func.coalesce(func.sum(BookingDailyFact.revenue), 0).label("revenue")
+        ).where(
+            BookingDailyFact.location_id == location,
+            BookingDailyFact.night.between(month_start, month_end)
+        ).one()
+
+        # Pages are found by booking id rather than offset, so later pages cost the same as the first
+        bookings = Booking.query.join(Booking.room).options(
+            contains_eager(Booking.room).options(joinedload(Room.location), joinedload(Room.room_type))
+        ).where(*in_month)
+
+        if before is not None:
+            bookings = bookings.where(Booking.id < before).order_by(Booking.id.desc())
+        else:
+            if after is not None:
+                bookings = bookings.where(Booking.id > after)
+            bookings = bookings.order_by(Booking.id)
+
+        bookings = bookings.limit(ANALYTICS_PAGE_SIZE + 1).all()
+        more = len(bookings) > ANALYTICS_PAGE_SIZE
+        bookings = bookings[:ANALYTICS_PAGE_SIZE]
 
-        return self.render("/admin/monthly_bookings.html", form=form)
+        if before is not None:
+            bookings.reverse()
+            has_previous, has_next = more, True
+        else:
+            has_previous, has_next = after is not None, more
+
+        page_args = {"location": location, "month": month_start.strftime("%Y-%m")}
+        previous_url = next_url = None
+        if bookings and has_previous:
+            previous_url = url_for("analytics.monthly_bookings", before=bookings[0].id, **page_args)
+        if bookings and has_next:
+            next_url = url_for("analytics.monthly_bookings", after=bookings[-1].id, **page_args)
+
+        return self.render(
+            "/admin/monthly_bookings.html", form=form, bookings=bookings,
+            summary=summary, room_types=ROOM_TYPES,
+            symbol=CURRENCY_SYMBOLS[reference_cache.get(Location, location).currency.acronym],
+            facts_refreshed=RollupWatermark.query.get(BOOKING_FACTS),
+            previous_url=previous_url, next_url=next_url)
 
     @expose("/compare_bookings", methods=["GET", "POST"])
     def compare_bookings(self):
         form = MonthAndLocationsForm()
 
-        locations = Location.query.with_entities(Location.id, Location.name).order_by(Location.name).all()
-        form.locations.choices = [(loc_id, loc_name) for loc_id, loc_name in locations]
+        locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
+        form.locations.choices = [(loc.id, loc.name) for loc in locations]
+
+        if form.validate_on_submit():
+            months = self._month_range(form.month.data, form.end_month.data or form.month.data)
+
+            # Each month's bounds are selected as a row, so nights can be joined onto
+            # their month and every month is counted in a single scan of the rollup.
+            month_bounds = union_all(*(
+                select(
+                    literal(index).label("month"),
+                    literal(month_start).label("month_start"),
+                    literal(month_end).label("month_end"))
+                for index, (month_start, month_end) in enumerate(months)
+            )).subquery("month_bounds")
+
+            # Bookings overlapping a month are those staying on its first night, plus those arriving later in it
+            counted = case(
+                (BookingDailyFact.night == month_bounds.c.month_start, BookingDailyFact.rooms_sold),
+                else_=BookingDailyFact.arrivals)
+
+            room_types = sorted(reference_cache.all(Roomtype), key=lambda rt: rt.max_occupants)
+            room_type_counts = (
+                func.sum(case((BookingDailyFact.room_type_id == room_type.id, counted), else_=0))
+                for room_type in room_types)
+
+            counts = BookingDailyFact.query.with_entities(
+                month_bounds.c.month,
+                BookingDailyFact.location_id,
+                func.sum(counted),
+                func.sum(BookingDailyFact.revenue),
+                *room_type_counts
+            ).join(
+                month_bounds, BookingDailyFact.night.between(month_bounds.c.month_start, month_bounds.c.month_end)
+            ).where(
+                BookingDailyFact.location_id.in_(form.locations.data)
+            ).group_by(month_bounds.c.month, BookingDailyFact.location_id).all()
+
+            counts = {
+                (month, location_id): (total, room_type_totals, revenue)
+                for month, location_id, total, revenue, *room_type_totals in counts}
+            no_bookings = (0, [0] * len(room_types), 0)
+            selected = [loc for loc in locations if loc.id in form.locations.data]
+
+            bookings = []
+            for index, (month_start, _) in enumerate(months):
+                rows = [(loc, *counts.get((index, loc.id), no_bookings)) for loc in selected]
+                bookings.append((month_start.strftime("%B %Y"), rows))
+
+            return self.render(
+                "/admin/compare_bookings.html", form=form, bookings=bookings,
+                room_types=room_types, ROOM_TYPES=ROOM_TYPES, CURRENCY_SYMBOLS=CURRENCY_SYMBOLS,
+                facts_refreshed=RollupWatermark.query.get(BOOKING_FACTS))
+
+        if form.end_month.errors:
+            flash(form.end_month.errors[0])
+
+        return self.render("/admin/compare_bookings.html", form=form)
+
+    @expose("/occupancy", methods=["GET", "POST"])
+    def occupancy(self):
+        form = DateRangeAndLocationsForm()
+
+        locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
+        form.locations.choices = [(loc.id, loc.name) for loc in locations]
 
         if form.validate_on_submit():
-            month_start = form.month.data
-            month_end = date(
-                year=month_start.year,
-                month=month_start.month,
-                day=monthrange(month_start.year, month_start.month)[1])
-
-            # A subquery is created for a total count and also each
-            # room type's count, then joined onto the main query.
-            room_types = Roomtype.query.order_by(Roomtype.max_occupants).all()
-            subquery_labels = [("total_count", None)]
-            subquery_labels += [(f"{ROOM_TYPES[rt.room_type]}_count", rt.room_type) for rt in room_types]
-            labels = (text(label) for label, _ in subquery_labels)
-
-            subquerys = []
-            for label, room_type in subquery_labels:
-                subquery = Booking.query.with_entities(
-                    Room.location_id,
-                    func.count(Booking.id).label(label))
-                subquery = subquery.join(Booking.room).where(
+            report = occupancy_report(form.locations.data, form.start.data, form.end.data)
+
+            nights_available = report.capacity * len(report.nights)
+            nights_sold = report.rooms_sold.sum(axis=1)
+            revenue = report.revenue.sum(axis=1)
+            totals = {
+                "nights_available": nights_available,
+                "nights_sold": nights_sold,
+                "revenue": revenue,
+                "occupancy": nights_sold / nights_available,
+                "revpar": revenue / nights_available
+            }
+
+            # Each location's room types are listed before the location as a whole
+            location_rows = []
+            for location in locations:
+                indexes = [i for i, (location_id, _) in enumerate(report.rows) if location_id == location.id]
+                if indexes:
+                    location_rows.append((location, indexes))
+
+            return self.render(
+                "/admin/occupancy.html", form=form, report=report, totals=totals,
+                location_rows=location_rows, room_types={rt.id: rt for rt in reference_cache.all(Roomtype)},
+                ROOM_TYPES=ROOM_TYPES, CURRENCY_SYMBOLS=CURRENCY_SYMBOLS,
+                facts_refreshed=RollupWatermark.query.get(BOOKING_FACTS))
+
+        if form.end.errors:
+            flash(form.end.errors[0])
+
+        return self.render("/admin/occupancy.html", form=form)
+
+    @expose("/revenue", methods=["GET", "POST"])
+    def revenue(self):
+        form = MonthRangeAndCurrencyForm()
+
+        locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
+        currencies = reference_cache.all(Currency)
+        form.currency.choices = [(currency.id, currency.full_name) for currency in currencies]
+
+        if form.validate_on_submit():
+            months = self._month_range(form.month.data, form.end_month.data or form.month.data)
+            currency = reference_cache.get(Currency, form.currency.data)
+
+            # Every booking is priced in one pass, from a single query joining on its location and room type.
+            # The booking id keeps identical bookings from being merged into one row by the query.
+            bookings = Booking.query.with_entities(
+                Booking.id, Location, Roomtype, Booking.guests, Booking.booking_start, Booking.booking_end,
+                Booking.date_created
+            ).join(Booking.room).join(Room.location).join(Room.room_type).where(
+                Booking.booking_start.between(months[0][0], months[-1][1])
+            ).all()
+
+            prices = find_booking_prices_batch(
+                ((location, room_type, guests, booking_start, booking_end, date_created.date())
+                 for _, location, room_type, guests, booking_start, booking_end, date_created in bookings),
+                currency)
+
+            # Bookings count towards the month they start in, at the price they were charged
+            location_index = {location.id: i for i, location in enumerate(locations)}
+            first_month = months[0][0].year * 12 + months[0][0].month
+            rows = np.array([location_index[location.id] for _, location, *_ in bookings], dtype=int)
+            columns = np.array([
+                booking_start.year * 12 + booking_start.month - first_month
+                for _, _, _, _, booking_start, *_ in bookings], dtype=int)
+            charged = np.array([
+                price if discount_price is None else discount_price
+                for price, discount_price in prices], dtype=float)
+
+            revenue = np.zeros((len(locations), len(months)))
+            counts = np.zeros((len(locations), len(months)), dtype=int)
+            np.add.at(revenue, (rows, columns), charged)
+            np.add.at(counts, (rows, columns), 1)
+
+            return self.render(
+                "/admin/revenue.html", form=form, locations=locations, revenue=revenue, counts=counts,
+                location_revenue=revenue.sum(axis=1), location_counts=counts.sum(axis=1),
+                month_revenue=revenue.sum(axis=0), month_counts=counts.sum(axis=0),
+                months=[month_start.strftime("%B %Y") for month_start, _ in months],
+                symbol=CURRENCY_SYMBOLS[currency.acronym])
+
+        if form.end_month.errors:
+            flash(form.end_month.errors[0])
+
+        return self.render("/admin/revenue.html", form=form)
+
+    @staticmethod
+    def _month_range(first_month: date, last_month: date) -> List[Tuple[date, date]]:
+        """Returns the first and last day of every month from first_month to last_month."""
+        months = []
+        year, month = first_month.year, first_month.month
+        while (year, month) <= (last_month.year, last_month.month):
+            months.append((date(year, month, 1), date(year, month, monthrange(year, month)[1])))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        return months
+
+    @expose("/export_pdfs", methods=["GET", "POST"])
+    def export_pdfs(self):
+        form = MonthAndLocationForm()
+
+        locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
+        form.location.choices = [(loc.id, loc.name) for loc in locations]
+
+        if request.method == "POST":
+            if form.validate_on_submit():
+                month_start = form.month.data
+                month_end = date(
+                    year=month_start.year,
+                    month=month_start.month,
+                    day=monthrange(month_start.year, month_start.month)[1])
+
+                bookings = Booking.query.join(Booking.room).options(
+                    contains_eager(Booking.room).options(joinedload(Room.location), joinedload(Room.room_type)),
+                    joinedload(Booking.currency)
+                ).where(
+                    Room.location_id == form.location.data,
                     # Logic for testing if there is any overlap of ranges from:
                     # https://stackoverflow.com/a/3269471
                     month_start <= Booking.booking_end,
                     Booking.booking_start <= month_end
-                )
+                ).order_by(Booking.id).yield_per(100)
 
-                if room_type:
-                    subquery = subquery.join(Room.room_type).where(
-                        Roomtype.room_type == room_type)
+                location = reference_cache.get(Location, form.location.data)
+                filename = secure_filename(f"bookings_{location.name.lower()}_{month_start.strftime('%Y-%m')}.zip")
 
-                subquery = subquery.group_by(Room.location_id).subquery()
-                subquerys.append(subquery)
+                return Response(
+                    stream_with_context(stream_zip(self._rendered_pdfs(bookings))),
+                    mimetype="application/zip",
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
-            bookings = Location.query.with_entities(Location, *labels)
-            for subquery in subquerys:
-                bookings = bookings.outerjoin(subquery, Location.id == subquery.c.location_id)
-            bookings = bookings.where(Location.id.in_(form.locations.data)).all()
-
-            return self.render(
-                "/admin/compare_bookings.html", form=form, bookings=bookings,
-                month=month_start.strftime("%B %Y"), room_types=room_types,
-                ROOM_TYPES=ROOM_TYPES)
+            flash("Please enter a location.")
 
-        return self.render("/admin/compare_bookings.html", form=form)
+        return self.render("/admin/export_pdfs.html", form=form)
+
+    @staticmethod
+    def _rendered_pdfs(bookings):
+        """Yields (path, archive name) for each booking's PDF in order, keeping up to two
+        renders per worker process in flight at once.
+
+        The response has already started by the time a render fails, so failed bookings
+        are logged and left out, and listed in an errors.txt at the end of the archive.
+        """
+        window = max(current_app.config["PDF_RENDER_WORKERS"] * 2, 1)
+        rendering = deque()
+        failed = []
+
+        def finished():
+            booking_id, future = rendering.popleft()
+            try:
+                path = future.result()
+            except Exception:
+                current_app.logger.exception("Rendering the PDF for booking %s failed", booking_id)
+                failed.append(booking_id)
+                return
+
+            yield path, f"booking_{booking_id}.pdf"
+            # Only evicted once archived, so the cache can't remove a PDF before it is read
+            booking_pdf_cache.stored(booking_id, path)
+
+        for booking in bookings:
+            rendering.append((booking.id, booking_pdf_render_queue.render(booking)))
+            if len(rendering) >= window:
+                yield from finished()
+
+        while rendering:
+            yield from finished()
+
+        if failed:
+            errors = "The PDFs for these bookings could not be rendered, see the server log for details:\n"
+            errors += "".join(f"booking_{booking_id}.pdf\n" for booking_id in failed)
+            yield errors.encode(), "errors.txt"
 
     def is_accessible(self):
         return flask_login.current_user.is_authenticated and flask_login.current_user.admin
@@ -171,8 +443,7 @@ class UserView(CustomModelView):
             if form.username.data:
                 model.username = form.username.data
 
-            if form.admin.data:
-                model.admin = form.admin.data
+            model.admin = form.admin.data
 
             if form.raw_password.data:
                 model.update_password(form.raw_password.data)
@@ -188,8 +459,14 @@ class UserView(CustomModelView):
         return True
 
 
+class LocationView(CustomModelView):
+    form_args = {
+        "rooms": {"query_factory": rooms_with_names}
+    }
+
+
 class CurrencyView(CustomModelView):
-    form_excluded_columns = ["hotels"]
+    form_excluded_columns = ["hotels", "bookings"]
 
 
 class RoomtypeView(CustomModelView):
@@ -202,18 +479,53 @@ class RoomView(CustomModelView):
 
 class BookingView(CustomModelView):
     can_export = True
+    export_batch_size = 500
     form_excluded_columns = ["date_created", "date_updated"]
+    column_filters = ["booking_start", "booking_end", "date_created", "guests", "email", "country"]
 
     form_choices = {
         "country": COUNTRIES_TUPLES,
         "card_type": CARD_TYPES_TUPLES
     }
+    form_args = {
+        "room": {"query_factory": rooms_with_names}
+    }
+
+    def get_query(self):
+        # Rooms are listed and exported as their str, which shows the location and room type
+        return super().get_query().options(
+            joinedload(Booking.room).joinedload(Room.location),
+            joinedload(Booking.room).joinedload(Room.room_type))
+
+    def _export_data(self):
+        """Returns the list view's query, with its search, filters and sorting, to be read
+        export_batch_size rows at a time, rather than every booking loaded into a list.
+        """
+        # As in ModelView._export_data, macro formatters, which are named inner, can't be exported
+        exported = [column for column, _ in self._export_columns]
+        for column, formatter in self.column_formatters_export.items():
+            if column in exported and formatter.__name__ == "inner":
+                raise NotImplementedError(
+                    "Macros are not implemented in export. Exclude column in column_formatters_export, "
+                    f"column_export_list, or column_export_exclude_list. Column: {column}")
+
+        view_args = self._get_list_extra_args()
+
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+
+        count, query = self.get_list(
+            0, sort_column, view_args.sort_desc, view_args.search, view_args.filters,
+            execute=False, page_size=self.export_max_rows)
+
+        return count, query.yield_per(self.export_batch_size)
 
 
 admin = Admin(template_mode="bootstrap4", index_view=CustomIndexView())
 
 admin.add_view(UserView(User, db.session))
-admin.add_view(CustomModelView(Location, db.session))
+admin.add_view(LocationView(Location, db.session))
 admin.add_view(CurrencyView(Currency, db.session))
 admin.add_view(RoomtypeView(Roomtype, db.session))
 admin.add_view(RoomView(Room, db.session))
@@ -1,16 +1,21 @@
 # George Whittington, Student ID: 20026036, 2022
 
 from datetime import date
+from typing import Tuple
 
 from flask import Blueprint, redirect, url_for, flash, request
 from flask.templating import render_template
 from flask_login import LoginManager, login_required, current_user
 from flask_login.utils import login_user, logout_user
-from werkzeug.security import check_password_hash
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import contains_eager, joinedload
 
-from .constants import ROOM_TYPES
+from .cache import reference_cache, user_cache
+from .constants import ROOM_TYPES, CURRENCY_SYMBOLS, ACCOUNT_PAGE_SIZE
 from .forms import UsernamePasswordForm, UsernamePasswordUpdateForm
-from .models import db, User, Booking
+from .models import db, User, Currency, Room, Booking
+from .passwords import PasswordHashingBusy, password_hasher
+from .pricing import find_booking_prices_batch
 
 bp = Blueprint("auth", __name__)
 login_manager = LoginManager()
@@ -18,7 +23,10 @@ login_manager = LoginManager()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    try:
+        return user_cache.get(int(user_id))
+    except ValueError:
+        return None
 
 
 @bp.route("/login", methods=["GET", "POST"])
@@ -27,7 +35,16 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user:
-            if check_password_hash(user.password, form.password.data):
+            if password_hasher.check(user.password, form.password.data):
+                if password_hasher.needs_rehash(user.password):
+                    # The hash method has changed since the password was set, the new hash is
+                    # best effort so a busy pool doesn't stop the user logging in
+                    try:
+                        user.update_password(form.password.data)
+                        db.session.commit()
+                    except PasswordHashingBusy:
+                        pass
+
                 login_user(user)
                 flash("Logged in.")
 
@@ -68,14 +85,85 @@ def register():
     return render_template("auth/register.html", form=form)
 
 
+def page_key(value: str) -> Tuple[date, int]:
+    """Parses a "<booking start>_<booking id>" key marking the edge of a page of bookings."""
+    booking_start, booking_id = value.split("_")
+    return date.fromisoformat(booking_start), int(booking_id)
+
+
+def account_bookings(after: Tuple[date, int] = None, before: Tuple[date, int] = None) -> Tuple[list, str, str]:
+    """Returns a page of the current user's upcoming bookings in order of check in, each as
+    (booking, price, discount price, currency symbol), along with the urls of the
+    previous and next pages, which are None if there isn't one.
+    """
+    # Pages are found by check in date and booking id rather than offset, so later pages cost the same as the first
+    bookings = Booking.query.join(Booking.room).options(
+        contains_eager(Booking.room).options(joinedload(Room.location), joinedload(Room.room_type))
+    ).where(
+        Booking.user_id == current_user.id,
+        Booking.booking_end >= date.today())
+
+    if before is not None:
+        bookings = bookings.where(or_(
+            Booking.booking_start < before[0],
+            and_(Booking.booking_start == before[0], Booking.id < before[1])
+        )).order_by(Booking.booking_start.desc(), Booking.id.desc())
+    else:
+        if after is not None:
+            bookings = bookings.where(or_(
+                Booking.booking_start > after[0],
+                and_(Booking.booking_start == after[0], Booking.id > after[1])))
+        bookings = bookings.order_by(Booking.booking_start, Booking.id)
+
+    bookings = bookings.limit(ACCOUNT_PAGE_SIZE + 1).all()
+    more = len(bookings) > ACCOUNT_PAGE_SIZE
+    bookings = bookings[:ACCOUNT_PAGE_SIZE]
+
+    if before is not None:
+        bookings.reverse()
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = after is not None, more
+
+    # Each booking is priced in the currency it was made in, one batch per currency
+    prices = {}
+    for currency_id in {booking.currency_id for booking in bookings}:
+        in_currency = [booking for booking in bookings if booking.currency_id == currency_id]
+        batch = find_booking_prices_batch((
+            (booking.room.location, booking.room.room_type, booking.guests,
+             booking.booking_start, booking.booking_end, booking.date_created.date())
+            for booking in in_currency), reference_cache.get(Currency, currency_id))
+        prices.update(zip((booking.id for booking in in_currency), batch))
+
+    rows = [
+        (booking, *prices[booking.id], CURRENCY_SYMBOLS[reference_cache.get(Currency, booking.currency_id).acronym])
+        for booking in bookings]
+
+    previous_url = next_url = None
+    if bookings and has_previous:
+        previous_url = url_for(
+            "auth.my_account", before=f"{bookings[0].booking_start.isoformat()}_{bookings[0].id}")
+    if bookings and has_next:
+        next_url = url_for(
+            "auth.my_account", after=f"{bookings[-1].booking_start.isoformat()}_{bookings[-1].id}")
+
+    return rows, previous_url, next_url
+
+
+def render_my_account(form: UsernamePasswordUpdateForm) -> str:
+    # Bookings are loaded after any account changes are committed, as committing expires them
+    bookings, previous_url, next_url = account_bookings(
+        after=request.args.get("after", type=page_key),
+        before=request.args.get("before", type=page_key))
+
+    return render_template(
+        "auth/my_account.html", bookings=bookings, ROOM_TYPES=ROOM_TYPES,
+        form=form, previous_url=previous_url, next_url=next_url)
+
+
 @bp.route("/my-account", methods=["GET", "POST"])
 @login_required
 def my_account():
-    bookings = Booking.query.where(
-        Booking.user == current_user,
-        Booking.booking_end >= date.today()
-    ).order_by(Booking.booking_start).all()
-
     form = UsernamePasswordUpdateForm()
 
     if not form.username.data:
@@ -87,9 +175,7 @@ def my_account():
             if current_user.username != form.username.data:
                 if User.query.filter_by(username=form.username.data).first():
                     flash(f"The username {form.username.data} is taken.")
-                    return render_template(
-                        "auth/my_account.html", bookings=bookings,
-                        ROOM_TYPES=ROOM_TYPES, form=form)
+                    return render_my_account(form)
                 else:
                     current_user.username = form.username.data
                     change = True
@@ -106,6 +192,4 @@ def my_account():
         if form.username.errors:
             flash("Your username cannot be longer than 20 characters.")
 
-    return render_template(
-        "auth/my_account.html", bookings=bookings, ROOM_TYPES=ROOM_TYPES,
-        form=form)
+    return render_my_account(form)
@@ -0,0 +1,316 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from collections import namedtuple, OrderedDict
+from datetime import date
+from threading import Lock
+from time import monotonic
+from typing import List, Tuple, Type, Union
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from .metrics import metrics
+from .models import db, User, Currency, Roomtype, Location, RoomInventory
+
+CacheEntry = namedtuple("CacheEntry", ["version", "loaded_at", "rows"])
+
+
+def _detached_copy(row: db.Model) -> db.Model:
+    mapper = inspect(row).mapper
+    copy = mapper.class_(**{attr.key: getattr(row, attr.key) for attr in mapper.column_attrs})
+    make_transient_to_detached(copy)
+    return copy
+
+
+def _attach(row: db.Model) -> db.Model:
+    # Rows the session already holds are used as they are, so pending changes aren't overwritten
+    existing = db.session.identity_map.get(inspect(row).key)
+    if existing is not None:
+        return existing
+
+    return db.session.merge(row, load=False)
+
+
+class ReferenceCache:
+    """In-process cache of the rarely changing Currency, Roomtype and Location tables.
+
+    Rows are stored as detached copies and merged into the current request's session
+    without emitting any SQL. Each table has a version number which is bumped by
+    invalidate(), the admin views call this whenever they save or delete a row.
+    Entries are also reloaded after REFERENCE_CACHE_TIMEOUT seconds, so changes made
+    through another worker process are picked up eventually.
+    """
+    # Currencies first, so a location's currency can be found in the session without a query
+    models = (Currency, Roomtype, Location)
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("REFERENCE_CACHE_TIMEOUT", 300)
+        app.extensions["reference_cache"] = {
+            "lock": Lock(),
+            "versions": {model: 0 for model in self.models},
+            "entries": {},
+            "hits": 0,
+            "misses": 0
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["reference_cache"]
+
+    def _entry(self, model: Type[db.Model]) -> CacheEntry:
+        state = self._state
+        timeout = current_app.config["REFERENCE_CACHE_TIMEOUT"]
+
+        with state["lock"]:
+            entry = state["entries"].get(model)
+            if (entry is not None and
+                    entry.version == state["versions"][model] and
+                    monotonic() - entry.loaded_at < timeout):
+                state["hits"] += 1
+                metrics.inc("hotel_website_cache_lookups_total", cache="reference", result="hit")
+                return entry
+
+            state["misses"] += 1
+            metrics.inc("hotel_website_cache_lookups_total", cache="reference", result="miss")
+            rows = model.query.order_by(model.id).all()
+            entry = CacheEntry(
+                state["versions"][model], monotonic(),
+                [_detached_copy(row) for row in rows])
+            state["entries"][model] = entry
+
+        return entry
+
+    def all(self, model: Type[db.Model]) -> List[db.Model]:
+        """Returns every row of model ordered by id, attached to the current session."""
+        if model is Location:
+            # Lets location.currency be loaded from the session's identity map
+            self.all(Currency)
+
+        # The session only holds weak references, so attached rows are kept for the request on g
+        attached = g.setdefault("reference_rows", {})
+        entry = self._entry(model)
+        if model not in attached or attached[model][0] is not entry:
+            attached[model] = (entry, [_attach(row) for row in entry.rows])
+
+        return attached[model][1]
+
+    def get(self, model: Type[db.Model], row_id: int) -> Union[db.Model, None]:
+        """Returns the row of model with the primary key row_id, or None."""
+        return next((row for row in self.all(model) if row.id == row_id), None)
+
+    def first(self, model: Type[db.Model], **attributes) -> Union[db.Model, None]:
+        """Returns the first row of model with matching attribute values, or None."""
+        return next((
+            row for row in self.all(model)
+            if all(getattr(row, key) == value for key, value in attributes.items())), None)
+
+    def invalidate(self, model: Type[db.Model] = None) -> None:
+        """Discards the cached rows of model, or of every table if no model is given."""
+        state = self._state
+        with state["lock"]:
+            for cached_model in self.models:
+                if model is None or model is cached_model:
+                    state["versions"][cached_model] += 1
+
+    def stats(self) -> dict:
+        return {"hits": self._state["hits"], "misses": self._state["misses"]}
+
+
+reference_cache = ReferenceCache()
+
+
+SearchEntry = namedtuple("SearchEntry", ["loaded_at", "version", "rows"])
+
+
+class SearchCache:
+    """In-process LRU cache of the result rows computed by the search view.
+
+    Keys are (location_id, booking_start, booking_end, guests, currency_id), plus
+    the current date as advance booking discounts depend on it. Each entry keeps
+    the version of the nights it covers, see version(), and is only used while that
+    is unchanged. Versions are kept in the database, so a booking committed by any
+    worker process invalidates the entries for its location whose dates overlap it,
+    and no others. Entries for bookings committed by this process are also dropped
+    straight away. Entries expire after SEARCH_CACHE_TIMEOUT seconds, as changes to
+    rooms and prices don't change the version.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("SEARCH_CACHE_SIZE", 1024)
+        app.config.setdefault("SEARCH_CACHE_TIMEOUT", 60)
+        app.extensions["search_cache"] = {
+            "lock": Lock(),
+            "entries": OrderedDict(),
+            "hits": 0,
+            "misses": 0
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["search_cache"]
+
+    @staticmethod
+    def key(location_id: int, booking_start: date, booking_end: date, guests: int, currency_id: int) -> tuple:
+        return (date.today(), location_id, booking_start, booking_end, guests, currency_id)
+
+    @staticmethod
+    def version(location_id: int, booking_start: date, booking_end: date) -> int:
+        """Returns the highest inventory version among a location's nights from
+        booking_start to booking_end, which changes whenever a booking overlapping
+        them is committed.
+
+        Read it in the same transaction as the results and before them, then pass it
+        to get() and set(). Results which include a booking committed in between are
+        then stored against the version from before it, and never used.
+        """
+        return db.session.query(func.coalesce(func.max(RoomInventory.version), 0)).where(
+            RoomInventory.location_id == location_id,
+            RoomInventory.night.between(booking_start, booking_end)
+        ).scalar()
+
+    def get(self, key: tuple, version: int) -> Union[List[tuple], None]:
+        state = self._state
+        timeout = current_app.config["SEARCH_CACHE_TIMEOUT"]
+
+        with state["lock"]:
+            entry = state["entries"].get(key)
+            if entry is None or entry.version != version or monotonic() - entry.loaded_at >= timeout:
+                state["misses"] += 1
+                metrics.inc("hotel_website_cache_lookups_total", cache="search", result="miss")
+                return None
+
+            state["entries"].move_to_end(key)
+            state["hits"] += 1
+            metrics.inc("hotel_website_cache_lookups_total", cache="search", result="hit")
+            return entry.rows
+
+    def set(self, key: tuple, rows: List[tuple], version: int) -> None:
+        state = self._state
+
+        with state["lock"]:
+            state["entries"][key] = SearchEntry(monotonic(), version, rows)
+            state["entries"].move_to_end(key)
+            while len(state["entries"]) > current_app.config["SEARCH_CACHE_SIZE"]:
+                state["entries"].popitem(last=False)
+
+    def invalidate(self, location_id: int, start: date, end: date) -> None:
+        """Drops the entries for a location with dates overlapping start to end (inclusive)."""
+        state = self._state
+
+        with state["lock"]:
+            stale = [
+                key for key in state["entries"]
+                if key[1] == location_id and key[2] <= end and start <= key[3]]
+            for key in stale:
+                del state["entries"][key]
+
+    def stats(self) -> dict:
+        return {"hits": self._state["hits"], "misses": self._state["misses"], "size": len(self._state["entries"])}
+
+
+search_cache = SearchCache()
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_searches(session) -> None:
+    booking_changes: List[Tuple[int, int, date, date]] = session.info.pop("booking_changes", [])
+    if has_app_context() and "search_cache" in current_app.extensions:
+        for location_id, _, start, end in booking_changes:
+            search_cache.invalidate(location_id, start, end)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def discard_booking_changes(session, previous_transaction) -> None:
+    session.info.pop("booking_changes", None)
+
+
+UserEntry = namedtuple("UserEntry", ["loaded_at", "user"])
+
+
+class UserCache:
+    """In-process LRU cache of the users Flask-Login loads at the start of each request.
+
+    Users are stored as detached copies and merged into the current request's session
+    without emitting any SQL. Once a transaction changing or deleting a user is
+    committed their entry is dropped, so a new password or revoked admin rights take
+    effect on their next request. Entries also expire after USER_CACHE_TIMEOUT
+    seconds, as users changed through another worker process can't invalidate this
+    one's cache.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("USER_CACHE_SIZE", 1024)
+        app.config.setdefault("USER_CACHE_TIMEOUT", 30)
+        app.extensions["user_cache"] = {
+            "lock": Lock(),
+            "entries": OrderedDict(),
+            "generations": {},
+            "hits": 0,
+            "misses": 0
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["user_cache"]
+
+    def get(self, user_id: int) -> Union[User, None]:
+        """Returns the user with the id user_id attached to the current session, or None."""
+        state = self._state
+        timeout = current_app.config["USER_CACHE_TIMEOUT"]
+
+        with state["lock"]:
+            entry = state["entries"].get(user_id)
+            if entry is not None and monotonic() - entry.loaded_at < timeout:
+                state["entries"].move_to_end(user_id)
+                state["hits"] += 1
+                metrics.inc("hotel_website_cache_lookups_total", cache="user", result="hit")
+                return _attach(entry.user)
+
+            state["misses"] += 1
+            metrics.inc("hotel_website_cache_lookups_total", cache="user", result="miss")
+            generation = state["generations"].get(user_id, 0)
+
+        user = User.get(user_id)
+        if user is None:
+            return None
+
+        with state["lock"]:
+            # Skipped if the user was changed while they were being loaded
+            if state["generations"].get(user_id, 0) == generation:
+                state["entries"][user_id] = UserEntry(monotonic(), _detached_copy(user))
+                state["entries"].move_to_end(user_id)
+                while len(state["entries"]) > current_app.config["USER_CACHE_SIZE"]:
+                    state["entries"].popitem(last=False)
+
+        return user
+
+    def invalidate(self, user_id: int) -> None:
+        state = self._state
+        with state["lock"]:
+            state["generations"][user_id] = state["generations"].get(user_id, 0) + 1
+            state["entries"].pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {"hits": self._state["hits"], "misses": self._state["misses"], "size": len(self._state["entries"])}
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(db.session, "before_flush")
+def record_user_changes(session, flush_context, instances) -> None:
+    session.info.setdefault("user_changes", set()).update(
+        user.id for user in list(session.dirty) + list(session.deleted)
+        if isinstance(user, User) and user.id is not None)
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_users(session) -> None:
+    user_changes = session.info.pop("user_changes", set())
+    if has_app_context() and "user_cache" in current_app.extensions:
+        for user_id in user_changes:
+            user_cache.invalidate(user_id)
+
+
+@event.listens_for(db.session, "after_soft_rollback")
+def discard_user_changes(session, previous_transaction) -> None:
+    session.info.pop("user_changes", None)
@@ -1,9 +1,16 @@
 # George Whittington, Student ID: 20026036, 2022
 
+from collections import Counter
+from datetime import timedelta
+
 import click
 from flask import Blueprint
+from sqlalchemy import func, inspect
 
-from .models import db, User, Location, Currency, Roomtype, Room, Booking  # noqa: F401
+from . import load_data, rollups
+from .load_data import room_rows
+from .models import (  # noqa: F401
+    db, User, Location, Currency, Roomtype, Room, Booking, RoomInventory, LocationPopularity, next_inventory_version)
 
 bp = Blueprint("commands", __name__)
 
@@ -13,6 +20,28 @@ def create_db_manually():
     db.create_all()
 
 
+def create_indexes_manually() -> list:
+    """Creates any indexes defined in hotel_website/models.py which are missing from the
+    database, for databases whose tables were created before the indexes were added.
+    Indexes which already exist are left alone, so it is safe to run more than once.
+
+    Returns the names of the indexes created.
+    """
+    inspector = inspect(db.engine)
+    created = []
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue  # Created along with its indexes by create-db
+
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+
+    return created
+
+
 def fill_db_manually():
     """Populates the database with data, run after the tables are created."""
     currencies = [
@@ -88,30 +117,74 @@ def fill_db_manually():
         "Swansea": 80
     }
 
-    # Room type: proportion of total rooms of a type
-    room_types = {
-        "S": 0.3,
-        "D": 0.5,
-        "F": 0.2
-    }
+    room_type_ids = {rt.room_type: rt.id for rt in Roomtype.query.all()}
+    location_ids = dict(Location.query.with_entities(Location.name, Location.id))
+
+    # Inserted in one executemany rather than a session.add per room
+    db.session.execute(Room.__table__.insert(), [
+        row for city, no_rooms in hotels.items()
+        for row in room_rows(location_ids[city], no_rooms, room_type_ids)])
 
-    room_type_query = Roomtype.query.all()
-    room_type_lookup = {rt.room_type: rt for rt in room_type_query}
+    db.session.commit()
+
+
+def rebuild_inventory_manually():
+    """Recalculates the room_inventory table from the bookings table, use if the two have drifted apart."""
+    bookings = Booking.query.with_entities(
+        Room.location_id, Room.room_type_id, Booking.booking_start, Booking.booking_end
+    ).join(Booking.room)
+
+    rooms_sold = Counter()
+    for location_id, room_type_id, booking_start, booking_end in bookings:
+        for i in range((booking_end - booking_start).days + 1):
+            rooms_sold[(location_id, room_type_id, booking_start + timedelta(days=i))] += 1
+
+    # Every location's nights are marked as changed, so cached searches are dropped by every process
+    connection = db.session.connection()
+    versions = {
+        location_id: next_inventory_version(connection, location_id)
+        for location_id, in Location.query.with_entities(Location.id).order_by(Location.id)}
+
+    db.session.execute(RoomInventory.__table__.delete())
+    if rooms_sold:
+        db.session.execute(RoomInventory.__table__.insert(), [
+            {"location_id": location_id, "room_type_id": room_type_id, "night": night, "rooms_sold": sold,
+             "version": versions[location_id]}
+            for (location_id, room_type_id, night), sold in rooms_sold.items()])
+    db.session.commit()
 
-    for city, no_rooms in hotels.items():
-        calculated_room_types = {
-            room_type: int(percent * no_rooms)
-            for room_type, percent in room_types.items()}
+    return len(rooms_sold)
 
-        location = Location.query.filter_by(name=city).first()
 
-        for room_type in calculated_room_types.keys():
-            for _ in range(calculated_room_types[room_type]):
-                room = Room(location=location, room_type=room_type_lookup[room_type])
-                db.session.add(room)
+def reconcile_popularity_manually():
+    """Recounts the bookings at each location into the location_popularity table."""
+    totals = Location.query.with_entities(Location.id, func.count(Booking.id)).outerjoin(
+        Location.rooms).outerjoin(Room.bookings).group_by(Location.id).all()
 
+    db.session.execute(LocationPopularity.__table__.delete())
+    if totals:
+        db.session.execute(LocationPopularity.__table__.insert(), [
+            {"location_id": location_id, "total_bookings": total_bookings}
+            for location_id, total_bookings in totals])
     db.session.commit()
 
+    return len(totals)
+
+
+def refresh_booking_facts_manually(full: bool = False):
+    """Brings the booking_daily_fact rollup table up to date, see rollups.refresh_booking_facts."""
+    return rollups.refresh_booking_facts(full=full)
+
+
+def generate_load_data_manually(**options) -> dict:
+    """Adds synthetic data for load testing, see load_data.generate_load_data, then
+    rebuilds the room_inventory and location_popularity tables to match.
+    """
+    added = load_data.generate_load_data(**options)
+    rebuild_inventory_manually()
+    reconcile_popularity_manually()
+    return added
+
 
 @bp.cli.command()
 def create_db():
@@ -120,8 +193,63 @@ def create_db():
     click.echo("All tables created.")
 
 
+@bp.cli.command()
+def create_indexes():
+    """Creates any indexes missing from an existing database, safe to run more than once."""
+    created = create_indexes_manually()
+    if created:
+        click.echo(f"Created {len(created)} indexes: {', '.join(created)}.")
+    else:
+        click.echo("All indexes already exist.")
+
+
 @bp.cli.command()
 def fill_db():
     """Populates the database with data, run after the tables are created."""
     fill_db_manually()
     click.echo("Database populated.")
+
+
+@bp.cli.command()
+def rebuild_inventory():
+    """Recalculates the room_inventory table from the bookings table, use if the two have drifted apart."""
+    nights = rebuild_inventory_manually()
+    click.echo(f"Room inventory rebuilt, {nights} nights recorded.")
+
+
+@bp.cli.command()
+def reconcile_popularity():
+    """Recounts the bookings at each location into the location_popularity table."""
+    locations = reconcile_popularity_manually()
+    click.echo(f"Booking totals recounted for {locations} locations.")
+
+
+@bp.cli.command()
+@click.option("--full", is_flag=True, help="Rebuild the table from every booking rather than only those changed.")
+def refresh_booking_facts(full):
+    """Updates the booking_daily_fact table with the bookings changed since it was last refreshed."""
+    counted, removed = refresh_booking_facts_manually(full=full)
+    click.echo(f"Booking facts refreshed, {counted} bookings counted and {removed} deleted bookings removed.")
+
+
+@bp.cli.command()
+@click.option("--locations", default=10, show_default=True, help="Number of locations to add.")
+@click.option("--rooms-per-location", default=100, show_default=True, help="Number of rooms at each added location.")
+@click.option("--users", default=1000, show_default=True, help="Number of users to add.")
+@click.option("--bookings", default=100000, show_default=True, help="Number of bookings to add, across every room.")
+@click.option("--days", default=730, show_default=True, help="Number of nights the bookings are spread over.")
+@click.option("--start", type=click.DateTime(formats=["%Y-%m-%d"]), help="First night bookings may start on.")
+@click.option("--seed", default=0, show_default=True, help="Seed for the random numbers, the same seed gives the same data.")
+@click.option("--batch-size", default=10000, show_default=True, help="Number of rows inserted at once.")
+def generate_load_data(locations, rooms_per_location, users, bookings, days, start, seed, batch_size):
+    """Adds synthetic locations, rooms, users and bookings for load testing, run after fill-db."""
+    try:
+        added = generate_load_data_manually(
+            locations=locations, rooms_per_location=rooms_per_location, users=users, bookings=bookings,
+            days=days, start=start.date() if start else None, seed=seed, batch_size=batch_size)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    click.echo(
+        f"Added {added['locations']} locations, {added['rooms']} rooms, {added['users']} users "
+        f"and {added['bookings']} bookings. Run refresh-booking-facts --full to update the analytics.")
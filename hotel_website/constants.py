@@ -17,6 +17,18 @@ PEAK_PRICING = {
 
 MAX_GUESTS = 6
 
+# Number of bookings listed on each page of the admin analytics reports
+ANALYTICS_PAGE_SIZE = 50
+
+# Number of bookings listed on each page of My Account
+ACCOUNT_PAGE_SIZE = 20
+
+# Largest number of months the compare bookings report covers at once
+MAX_COMPARE_MONTHS = 24
+
+# Largest number of nights the occupancy report covers at once
+MAX_OCCUPANCY_DAYS = 366
+
 LOCATION_ERR = "Please select a location from the list provided."
 DURATION_ERR = "Please select a valid booking duration."
 GUESTS_ERR = "Please select a number of guests between 1 and 6."
@@ -33,6 +45,13 @@ CURRENCY_SYMBOLS = {
     "EUR": "€"
 }
 
+# Proportion of the rooms at each location of each room type
+ROOM_TYPE_PROPORTIONS = {
+    "S": 0.3,
+    "D": 0.5,
+    "F": 0.2
+}
+
 ROOM_TYPES = {
     "S": "Standard",
     "D": "Double",
@@ -6,9 +6,11 @@ from flask import flash
 from flask_wtf import Form, FlaskForm
 from wtforms import Field, PasswordField, SelectField, FormField, ValidationError, MonthField, SelectMultipleField
 from wtforms_components import DateField, IntegerField, DateRange, EmailField, StringField
-from wtforms.validators import InputRequired, Length, NumberRange, Regexp
+from wtforms.validators import InputRequired, Length, NumberRange, Optional, Regexp
 
-from .constants import COUNTRIES_TUPLES, CARD_TYPES_TUPLES, MAX_GUESTS, LOCATION_ERR, DURATION_ERR, GUESTS_ERR
+from .constants import (
+    COUNTRIES_TUPLES, CARD_TYPES_TUPLES, MAX_GUESTS, MAX_COMPARE_MONTHS, MAX_OCCUPANCY_DAYS,
+    LOCATION_ERR, DURATION_ERR, GUESTS_ERR)
 
 
 class UsernamePasswordForm(FlaskForm):
@@ -186,3 +188,34 @@ class MonthAndLocationForm(FlaskForm):
 class MonthAndLocationsForm(FlaskForm):
     month = MonthField("Month", validators=[InputRequired()])
     locations = SelectMultipleField("Hotel Locations", coerce=int, render_kw={"aria-describedby": "locationHelp"}, validators=[InputRequired()])
+    end_month = MonthField("To Month", render_kw={"aria-describedby": "endMonthHelp"}, validators=[Optional()])
+
+    def validate_end_month(self, field: Field) -> None:
+        if self.month.data is None:
+            return
+
+        months = (field.data.year - self.month.data.year) * 12 + field.data.month - self.month.data.month
+        if not 0 <= months < MAX_COMPARE_MONTHS:
+            raise ValidationError(f"Please select an end month up to {MAX_COMPARE_MONTHS - 1} months after the start month.")
+
+
+class MonthRangeAndCurrencyForm(FlaskForm):
+    month = MonthField("Month", validators=[InputRequired()])
+    end_month = MonthField("To Month", render_kw={"aria-describedby": "endMonthHelp"}, validators=[Optional()])
+    currency = SelectField("Currency", coerce=int, validators=[InputRequired()])
+
+    validate_end_month = MonthAndLocationsForm.validate_end_month
+
+
+class DateRangeAndLocationsForm(FlaskForm):
+    start = DateField("From", format="%Y-%m-%d", validators=[InputRequired()])
+    end = DateField("To", format="%Y-%m-%d", validators=[InputRequired()])
+    locations = SelectMultipleField(
+        "Hotel Locations", coerce=int, render_kw={"aria-describedby": "locationHelp"}, validators=[InputRequired()])
+
+    def validate_end(self, field: Field) -> None:
+        if self.start.data is None:
+            return
+
+        if not 0 <= (field.data - self.start.data).days < MAX_OCCUPANCY_DAYS:
+            raise ValidationError(f"Please select an end date up to {MAX_OCCUPANCY_DAYS - 1} days after the start date.")
@@ -3,14 +3,15 @@
 from datetime import date, timedelta
 import calendar
 
-from sqlalchemy import or_, and_, not_, func, text
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file
 from flask_login import login_required, current_user
-from flask_weasyprint import HTML, render_pdf
 from wtforms.validators import Length
 
-from .models import db, Location, Booking, Room, Roomtype, Currency
+from .cache import reference_cache, search_cache
+from .models import db, Location, Booking, Roomtype, Currency, LocationPopularity, allocate_room, free_rooms
 from .forms import WhereToForm, BookingForm
+from .pdfs import booking_pdf_cache, booking_pdf_render_queue, render_booking_pdf
+from .pricing import find_room_prices_batch
 from .constants import CURRENCY_SYMBOLS, ROOM_TYPES, LOCATION_ERR, DURATION_ERR, GUESTS_ERR
 
 bp = Blueprint("hotels", __name__)
@@ -19,7 +20,7 @@ bp = Blueprint("hotels", __name__)
 @bp.route("/", methods=["GET", "POST"])
 def home():
     form = WhereToForm()
-    locations = Location.query.order_by(Location.name).all()
+    locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
     form.location.choices = [(l.id, l.name) for l in locations]
 
     if request.method == "POST":
@@ -35,11 +36,15 @@ def home():
     start_date = date(next_month.year, next_month.month, 1)
     end_date = date(next_month.year, next_month.month, last_day)
 
-    top_5 = db.session.query(Location, func.count(Booking.id).label("total_bookings"))
-    top_5 = top_5.join(Location.rooms).outerjoin(Room.bookings)
-    top_5 = top_5.group_by(Location).order_by(text("total_bookings DESC"))
-    top_5 = top_5.order_by(Location.name).limit(5).all()
-    top_5 = [location for location, _ in top_5]
+    top_5 = LocationPopularity.query.with_entities(LocationPopularity.location_id).join(
+        LocationPopularity.location
+    ).where(
+        LocationPopularity.total_bookings > 0
+    ).order_by(LocationPopularity.total_bookings.desc(), Location.name).limit(5).all()
+    top_5 = [reference_cache.get(Location, location_id) for location_id, in top_5]
+
+    # Locations without bookings make up the rest, in alphabetical order
+    top_5 += [location for location in locations if location not in top_5][:5 - len(top_5)]
 
     return render_template(
         "hotels/home.html", form=form, locations=top_5,
@@ -50,7 +55,7 @@ def home():
 @bp.route("/search", methods=["GET", "POST"])
 def search():
     form = WhereToForm()
-    locations = Location.query.order_by(Location.name).all()
+    locations = sorted(reference_cache.all(Location), key=lambda loc: loc.name)
     location_ids = [loc.id for loc in locations]
     form.location.choices = [(loc.id, loc.name) for loc in locations]
 
@@ -91,39 +96,40 @@ def search():
     if any(item is None for item in [location, booking_start, booking_end, guests]):
         return render_template("hotels/search.html", form=form, room_types=ROOM_TYPES)
 
-    # Find all rooms matching filters
-    # Logic for testing if there is any overlap of ranges comes from:
-    # https://stackoverflow.com/a/3269471
-    results = Room.query.with_entities(Location, Roomtype)
-    results = results.join(Room.location).join(Room.room_type).join(Room.bookings, isouter=True)
-    results = results.where(
-        Roomtype.max_occupants >= guests,
-        or_(
-            Booking.id == None,  # noqa: E711
-            not_(and_(
-                booking_start <= Booking.booking_end,
-                Booking.booking_start <= booking_end
-            ))  # NOT (x1 <= y2 AND y1 <= x2)
-        )
-    ).group_by(Roomtype.id, Location.id)
-
-    if location:
-        results = results.where(Location.id == location)
-
-    results = results.all()
-
     currency_acronym = request.cookies.get("current_currency", default="GBP")
-    currency = Currency.query.filter_by(acronym=currency_acronym).first()
+    currency = reference_cache.first(Currency, acronym=currency_acronym)
 
-    rooms = []
-    for location, room_type in results:
-        symbol = CURRENCY_SYMBOLS[currency_acronym]
+    symbol = CURRENCY_SYMBOLS[currency_acronym]
+
+    cache_key = search_cache.key(location, booking_start, booking_end, guests, currency.id)
+    version = search_cache.version(location, booking_start, booking_end)
+    results = search_cache.get(cache_key, version)
+
+    if results is None:
+
+        # Find all room types at the location that have a room free on every night
+        room_type_ids = [
+            rtype.id for rtype in sorted(reference_cache.all(Roomtype), key=lambda rtype: rtype.id)
+            if rtype.max_occupants >= guests]
+        free = free_rooms(location, booking_start, booking_end, room_type_ids)
 
-        price, discount_price = location.find_room_prices(
-            room_type=room_type, booking_start=booking_start,
-            booking_end=booking_end, currency=currency, guests=guests)
+        results = [(location, rtype_id, free[rtype_id]) for rtype_id in room_type_ids if free.get(rtype_id)]
 
-        rooms.append((location, room_type, guests, price, discount_price, symbol))
+        prices = find_room_prices_batch(
+            [(reference_cache.get(Location, loc_id), reference_cache.get(Roomtype, rtype_id), guests)
+             for loc_id, rtype_id, _ in results],
+            booking_start=booking_start, booking_end=booking_end, currency=currency)
+
+        results = [
+            (loc_id, rtype_id, left, price, discount_price)
+            for (loc_id, rtype_id, left), (price, discount_price) in zip(results, prices)]
+        search_cache.set(cache_key, results, version)
+
+    rooms = []
+    for loc_id, rtype_id, left, price, discount_price in results:
+        rooms.append((
+            reference_cache.get(Location, loc_id), reference_cache.get(Roomtype, rtype_id),
+            guests, price, discount_price, symbol, left))
 
     # Get duration string, cut off HH:MM:SS data at the end
     booking_duration = str(booking_end - booking_start + timedelta(days=1))[:-9]
@@ -136,8 +142,8 @@ def search():
 @bp.route("/room", methods=["GET", "POST"])
 @login_required
 def room():
-    location_ids = [loc_id for loc_id, in Location.query.with_entities(Location.id).all()]
-    room_type_ids = [rtype_id for rtype_id, in Roomtype.query.with_entities(Roomtype.id).all()]
+    location_ids = [loc.id for loc in reference_cache.all(Location)]
+    room_type_ids = [rtype.id for rtype in reference_cache.all(Roomtype)]
 
     location = request.args.get("location", type=int)
     room_type = request.args.get("room_type", type=int)
@@ -165,24 +171,14 @@ def room():
     if None in (location, room_type, booking_start, booking_end, guests):
         return redirect(url_for("hotels.home"))
 
-    location_obj = Location.query.get(location)
-    room_type_obj = Roomtype.query.get(room_type)
+    location_obj = reference_cache.get(Location, location)
+    room_type_obj = reference_cache.get(Roomtype, room_type)
 
     if room_type_obj.max_occupants < guests:
         flash("Too many guests for the room type selected.")
         return redirect(url_for("hotels.home"))
 
-    rooms = Room.query.outerjoin(Room.bookings).where(
-        Room.room_type_id == room_type,
-        Room.location_id == location,
-        or_(
-            Booking.id == None,  # noqa: E711
-            not_(and_(
-                booking_start <= Booking.booking_end,
-                Booking.booking_start <= booking_end)))
-    ).group_by(Room).all()
-
-    if len(rooms) == 0:
+    if location_obj.rooms_available(booking_start, booking_end, room_types=(room_type_obj,)) == 0:
         flash("No {room_type} rooms at {location} in the period {start} - {end}".format(
             room_type=ROOM_TYPES[room_type_obj.room_type],
             location=location_obj.name,
@@ -192,7 +188,7 @@ def room():
         return redirect(url_for("hotels.home"))
 
     currency_acronym = request.cookies.get("current_currency", default="GBP")
-    currency = Currency.query.filter_by(acronym=currency_acronym).first()
+    currency = reference_cache.first(Currency, acronym=currency_acronym)
 
     symbol = CURRENCY_SYMBOLS[currency_acronym]
 
@@ -221,10 +217,13 @@ def room():
                     month=form.card_details.expiry_date.expiry_month.data,
                     day=1),
                 currency=currency,
-                room=rooms[0],  # Select first of available rooms
                 user=current_user)
-            db.session.add(booking)
-            db.session.commit()
+
+            if not allocate_room(booking, location, room_type):
+                flash("Sorry, the last {room_type} room at {location} was just booked.".format(
+                    room_type=ROOM_TYPES[room_type_obj.room_type],
+                    location=location_obj.name))
+                return redirect(url_for("hotels.home"))
 
             return redirect(url_for("hotels.room_confirm", booking_id=booking.id))
 
@@ -235,7 +234,7 @@ def room():
             flash("Please enter a valid 3 or 4 digit security code.")
 
     return render_template(
-        "hotels/room.html", rooms=rooms, room_types=ROOM_TYPES,
+        "hotels/room.html", room_types=ROOM_TYPES,
         location=location_obj, room_type=room_type_obj, form=form,
         booking_start=booking_start, booking_end=booking_end,
         symbol=symbol, price=price, discount_price=discount_price,
@@ -255,6 +254,9 @@ def room_confirm(booking_id):
         flash("That booking is in the past.")
         return redirect(url_for("hotels.home"))
 
+    # Rendered in the background so the first download of the PDF is instant
+    booking_pdf_render_queue.enqueue(booking)
+
     return render_template("/hotels/room_confirm.html", booking_id=booking_id)
 
 
@@ -271,17 +273,17 @@ def booking_pdf(booking_id):
         flash("That booking is in the past.")
         return redirect(url_for("hotels.home"))
 
-    if not (current_user.admin or booking.user.id == current_user.id):
+    if not (current_user.admin or booking.user_id == current_user.id):
         flash("You are not authorised to view this booking.")
         return redirect(url_for("hotels.home"))
 
-    symbol = CURRENCY_SYMBOLS[booking.currency.acronym]
-    price, discount_price = booking.find_room_prices()
+    pdf_path = booking_pdf_cache.get(booking)
+    if pdf_path is None:
+        # Not pre-rendered yet, so render it now rather than wait for the queue
+        booking_pdf_render_queue.cancel(booking)
+        pdf_path = booking_pdf_cache.put(booking, render_booking_pdf(booking))
 
-    html = render_template(
-        "/pdf/booking.html", booking=booking, ROOM_TYPES=ROOM_TYPES,
-        price=price, discount_price=discount_price, symbol=symbol)
-    return render_pdf(HTML(string=html))
+    return send_file(pdf_path, mimetype="application/pdf")
 
 
 @bp.route("/delete_booking/<booking_id>", methods=["GET", "POST"])
@@ -0,0 +1,154 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import heapq
+import json
+import logging
+from time import perf_counter
+
+from flask import current_app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .metrics import metrics
+
+logger = logging.getLogger("hotel_website.requests")
+
+
+def _stats():
+    """Returns the current request's stats, or None outside of an instrumented request."""
+    return g.get("request_stats") if has_request_context() else None
+
+
+class TimedTemplate(Template):
+    """Jinja template which adds the time spent rendering it onto the request's stats."""
+    def render(self, *args, **kwargs) -> str:
+        started = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = _stats()
+            if stats is not None:
+                stats["render_time"] += perf_counter() - started
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault("query_started", []).append(perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany) -> None:
+    started = conn.info.get("query_started")
+    stats = _stats()
+    if not started or stats is None:
+        if started:
+            started.pop()
+        return
+
+    duration = perf_counter() - started.pop()
+
+    stats["queries"] += 1
+    stats["db_time"] += duration
+    # Only the slowest few statements are kept, in a heap with the quickest at the top
+    slowest = stats["slowest"]
+    entry = (duration, stats["queries"], statement)
+    if len(slowest) < current_app.config["REQUEST_SLOWEST_QUERIES"]:
+        heapq.heappush(slowest, entry)
+    elif slowest and entry > slowest[0]:
+        heapq.heapreplace(slowest, entry)
+
+
+@event.listens_for(Engine, "handle_error")
+def discard_query_timer(exception_context) -> None:
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+class RequestInstrumentation:
+    """Records how many SQL statements each request runs, the time spent in the database
+    and rendering templates, and its slowest statements.
+
+    Render time includes any queries lazily loaded by the template. In debug mode, or
+    when REQUEST_INSTRUMENTATION_HEADERS is set, the results are added to the response
+    as a Server-Timing header and X-Query-Count and X-Slowest-Queries headers.
+    Otherwise each request is logged as a line of JSON to the hotel_website.requests
+    logger. Streamed responses are measured up to the point they start streaming.
+    Each request's duration and database time are also added to the app's metrics.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("REQUEST_INSTRUMENTATION", True)
+        app.config.setdefault("REQUEST_INSTRUMENTATION_HEADERS", None)  # None follows app.debug
+        app.config.setdefault("REQUEST_SLOWEST_QUERIES", 3)
+
+        if not app.config["REQUEST_INSTRUMENTATION"]:
+            return
+
+        app.jinja_env.template_class = TimedTemplate
+
+        # Flask only attaches its default handler, which the request lines propagate to, once app.logger is used
+        app.logger.debug("Request instrumentation enabled")
+        if logger.level == logging.NOTSET:
+            logger.setLevel(logging.INFO)
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    @staticmethod
+    def start() -> None:
+        g.request_stats = {
+            "started": perf_counter(),
+            "queries": 0,
+            "db_time": 0.0,
+            "render_time": 0.0,
+            "slowest": []
+        }
+
+    @staticmethod
+    def summary(stats: dict) -> dict:
+        """Returns stats for a request with times in milliseconds and the slowest statements first."""
+        return {
+            "duration_ms": round((perf_counter() - stats["started"]) * 1000, 2),
+            "queries": stats["queries"],
+            "db_ms": round(stats["db_time"] * 1000, 2),
+            "render_ms": round(stats["render_time"] * 1000, 2),
+            "slowest": [
+                {"ms": round(duration * 1000, 2), "statement": " ".join(statement.split())}
+                for duration, _, statement in sorted(stats["slowest"], reverse=True)]
+        }
+
+    def finish(self, response):
+        stats = g.pop("request_stats", None)
+        if stats is None:
+            return response
+
+        summary = self.summary(stats)
+        metrics.record_request(
+            request.endpoint, request.method, response.status_code,
+            summary["duration_ms"] / 1000, summary["db_ms"] / 1000)
+
+        show_headers = current_app.config["REQUEST_INSTRUMENTATION_HEADERS"]
+        if show_headers is None:
+            show_headers = current_app.debug
+
+        if show_headers:
+            response.headers["Server-Timing"] = (
+                f'db;dur={summary["db_ms"]};desc="{summary["queries"]} queries", '
+                f'render;dur={summary["render_ms"]}, total;dur={summary["duration_ms"]}')
+            response.headers["X-Query-Count"] = str(summary["queries"])
+            response.headers["X-Slowest-Queries"] = " | ".join(
+                f'{query["ms"]}ms {query["statement"][:200]}' for query in summary["slowest"])
+        else:
+            logger.info(json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": response.status_code,
+                **summary
+            }))
+
+        return response
+
+
+request_instrumentation = RequestInstrumentation()
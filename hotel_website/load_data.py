@@ -0,0 +1,192 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from datetime import date, timedelta
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy import select
+
+from .constants import PEAK_PRICING, ROOM_TYPE_PROPORTIONS, COUNTRIES
+from .models import db, User, Location, Currency, Roomtype, Room, Booking
+from .passwords import password_hasher
+
+# Longest stay generated, in nights
+MAX_STAY = 14
+
+CARD_NUMBERS = {
+    "V": "4111111111111111",
+    "M": "5555555555554444"
+}
+
+
+def room_rows(location_id: int, total_rooms: int, room_type_ids: Dict[str, int]) -> List[dict]:
+    """Returns rows for the room table splitting total_rooms at a location between the
+    room types in ROOM_TYPE_PROPORTIONS, rounding down.
+    """
+    return [
+        {"location_id": location_id, "room_type_id": room_type_ids[room_type]}
+        for room_type, proportion in ROOM_TYPE_PROPORTIONS.items()
+        for _ in range(int(proportion * total_rooms))]
+
+
+def _night_weights(first_night: date, days: int) -> np.ndarray:
+    """Returns how popular each night from first_night is, peak months being busier."""
+    months = (np.datetime64(first_night, "D") + np.arange(days)).astype("datetime64[M]").astype(int) % 12 + 1
+    return np.where(np.array([PEAK_PRICING[month] for month in range(1, 13)])[months - 1], 1.5, 1.0)
+
+
+def generate_load_data(
+        locations: int,
+        rooms_per_location: int,
+        users: int,
+        bookings: int,
+        days: int = 730,
+        start: date = None,
+        seed: int = 0,
+        batch_size: int = 10000) -> dict:
+    """Adds synthetic locations, rooms, users and bookings for load testing, using bulk
+    inserts rather than the ORM. The same seed always gives the same data.
+
+    Bookings are spread over every room, the old and the new, and over a number of
+    nights from start given by days. By default that is the year either side of today.
+    No room is booked twice on a night, rooms which already have bookings in those
+    nights are left out, so running it again needs new locations or other nights.
+    Bookings go to the users added, or to every load test user if none are. Check in
+    dates favour peak months, most stays are a few nights long and are booked a few
+    weeks ahead, though never after the middle night, and a few users make many of the
+    bookings, like corporate accounts. Every new user's password is "password".
+
+    Rows are inserted without the ORM, so the room_inventory and location_popularity
+    tables have to be rebuilt afterwards. Returns the number of rows added to each table.
+    """
+    rng = np.random.default_rng(seed)
+    if start is None:
+        start = date.today() - timedelta(days=days // 2)
+
+    currency_ids = [currency_id for currency_id, in Currency.query.with_entities(Currency.id).order_by(Currency.id)]
+    room_type_ids = {room_type.room_type: room_type.id for room_type in Roomtype.query}
+    images = Location.query.with_entities(Location.image, Location.image_alt_text).order_by(Location.id).all()
+    if not currency_ids or not room_type_ids:
+        raise ValueError("Run fill-db before generating load data.")
+
+    # Numbered on from any load data already generated, so names stay unique
+    location_offset = Location.query.where(Location.name.like("Load Test Hotel %")).count()
+    peak_prices = rng.integers(10, 26, size=locations) * 10
+    new_locations = [{
+        "name": f"Load Test Hotel {location_offset + i + 1}",
+        "currency_id": currency_ids[rng.integers(len(currency_ids))],
+        "peak_price": float(peak_price),
+        "off_peak_price": float(round(peak_price * rng.uniform(0.4, 0.6), -1)),
+        "image": images[i % len(images)].image if images else None,
+        "image_alt_text": images[i % len(images)].image_alt_text if images else None
+    } for i, peak_price in enumerate(peak_prices)]
+    if new_locations:
+        db.session.execute(Location.__table__.insert(), new_locations)
+
+    location_ids = [location_id for location_id, in Location.query.with_entities(Location.id).where(
+        Location.name.in_([location["name"] for location in new_locations]))]
+    new_rooms = [row for location_id in location_ids for row in room_rows(location_id, rooms_per_location, room_type_ids)]
+    if new_rooms:
+        db.session.execute(Room.__table__.insert(), new_rooms)
+
+    user_offset = User.query.where(User.username.like("load_%")).count()
+    # One hash shared by every user, hashing each would take far longer than the inserts
+    password = password_hasher.hash("password")
+    usernames = [f"load_{user_offset + i + 1}" for i in range(users)]
+    for i in range(0, users, batch_size):
+        db.session.execute(User.__table__.insert(), [
+            {"username": username, "password": password, "admin": False}
+            for username in usernames[i:i + batch_size]])
+    db.session.commit()
+
+    load_user_ids = [user_id for user_id, in User.query.with_entities(User.id).where(
+        User.username.like("load_%")).order_by(User.id)]
+    user_ids = load_user_ids[user_offset:] or load_user_ids
+    if bookings and not user_ids:
+        raise ValueError("There are no load test users to make the bookings, add users.")
+
+    # Stays are only kept apart from each other, so rooms already booked in the period are skipped
+    end = start + timedelta(days=days - 1)
+    booked = select(Booking.room_id).where(Booking.booking_start <= end, start <= Booking.booking_end)
+    rooms = Room.query.with_entities(
+        Room.id, Location.currency_id, Roomtype.max_occupants
+    ).join(Room.location).join(Room.room_type).where(Room.id.not_in(booked)).order_by(Room.id).all()
+    if bookings and not rooms:
+        raise ValueError("There are no rooms without bookings in the days given, add locations or pick other days.")
+
+    if bookings:
+        _insert_bookings(rng, rooms, user_ids, currency_ids, bookings, days, start, batch_size)
+
+    return {"locations": len(new_locations), "rooms": len(new_rooms), "users": users, "bookings": bookings}
+
+
+def _insert_bookings(
+        rng: np.random.Generator,
+        rooms: list,
+        user_ids: List[int],
+        currency_ids: List[int],
+        bookings: int,
+        days: int,
+        start: date,
+        batch_size: int) -> None:
+    # Every room gets an even share of the bookings, with the remainder going to random rooms
+    per_room = np.full(len(rooms), bookings // len(rooms))
+    per_room[rng.choice(len(rooms), bookings % len(rooms), replace=False)] += 1
+    room_index = np.repeat(np.arange(len(rooms)), per_room)
+
+    nights = np.minimum(rng.geometric(0.4, size=bookings), MAX_STAY)
+    free = days - np.bincount(room_index, weights=nights, minlength=len(rooms)).astype(int)
+    if (free < 0).any():
+        raise ValueError("Too many bookings for the rooms and days given, add rooms or days.")
+
+    # Each room's stays are placed in order along the nights left free once they are
+    # all added up, then pushed back by the length of the stays before them, so no
+    # two stays in a room overlap
+    weights = _night_weights(start, days)
+    positions = np.searchsorted(np.cumsum(weights) / weights.sum(), rng.random(bookings), side="right")
+    positions = np.minimum(positions, days - 1) * free[room_index] // days
+
+    order = np.lexsort((positions, room_index))
+    positions, nights = positions[order], nights[order]
+    stayed_before = np.cumsum(nights) - nights
+    stayed_before -= stayed_before[np.repeat(np.cumsum(per_room) - per_room, per_room)]
+    starts = np.datetime64(start, "D") + positions + stayed_before
+    ends = starts + nights - 1
+
+    # Most bookings are made a few weeks ahead, and none after the middle of the period,
+    # which is today by default. Taken from start rather than the clock, so reruns match
+    lead_days = np.minimum(rng.geometric(1 / 30, size=bookings), 365)
+    created = (starts - lead_days).astype("datetime64[s]") + rng.integers(0, 24 * 60 * 60, size=bookings)
+    created = np.minimum(created, np.datetime64(start, "s") + np.timedelta64(days // 2, "D"))
+
+    max_occupants = np.array([room.max_occupants for room in rooms])[room_index]
+    guests = 1 + rng.binomial(max_occupants - 1, 0.6)
+    # Favours the first users, so a few accounts hold hundreds of bookings
+    users = np.minimum((rng.random(bookings) ** 2 * len(user_ids)).astype(int), len(user_ids) - 1)
+    own_currency = rng.random(bookings) < 0.9
+    other_currencies = rng.integers(len(currency_ids), size=bookings)
+    countries = rng.choice(sorted(COUNTRIES), size=bookings)
+    countries[rng.random(bookings) < 0.7] = "GB"
+    card_types = rng.choice(sorted(CARD_NUMBERS), size=bookings)
+
+    for i in range(0, bookings, batch_size):
+        batch = slice(i, i + batch_size)
+        rows = []
+        for j, booking_start, booking_end, date_created, guest_count, user, currency, country, card_type in zip(
+                range(i, i + batch_size), starts[batch].tolist(), ends[batch].tolist(), created[batch].tolist(),
+                guests[batch].tolist(), users[batch].tolist(), other_currencies[batch].tolist(),
+                countries[batch].tolist(), card_types[batch].tolist()):
+            room = rooms[room_index[j]]
+            rows.append({
+                "guests": guest_count, "booking_start": booking_start, "booking_end": booking_end,
+                "date_created": date_created, "name": f"Load Test {user + 1}",
+                "email": f"load_{user + 1}@example.com", "address_1": f"{user + 1} Test Street",
+                "postcode": "AB1 2CD", "country": country, "card_type": card_type,
+                "card_number": CARD_NUMBERS[card_type],
+                "expiry_date": date(booking_end.year + 1, 1, 1),
+                "currency_id": room.currency_id if own_currency[j] else currency_ids[currency],
+                "room_id": room.id,
+                "user_id": user_ids[user]})
+
+        db.session.execute(Booking.__table__.insert(), rows)
+        db.session.commit()
@@ -0,0 +1,354 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import glob
+import hmac
+import json
+import math
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from threading import Lock
+from typing import Dict, Iterator, Tuple
+
+from flask import Response, current_app, request
+from flask_login import current_user
+
+# Upper bounds, in seconds, of the latency histograms' buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Size a process's metrics file starts at, it doubles whenever it fills up
+METRICS_FILE_BYTES = 64 * 1024
+
+Family = namedtuple("Family", ["type", "help", "buckets"])
+
+FAMILIES = {
+    "hotel_website_requests_total": Family(
+        "counter", "Requests answered, by endpoint, method and status.", None),
+    "hotel_website_request_duration_seconds": Family(
+        "histogram", "Time taken to answer requests, by endpoint.", LATENCY_BUCKETS),
+    "hotel_website_request_db_seconds": Family(
+        "histogram", "Time requests spent running SQL statements, by endpoint.", LATENCY_BUCKETS),
+    "hotel_website_pdf_render_seconds": Family(
+        "histogram", "Time taken to render booking PDFs, in the request or in the render pool including time queued.",
+        LATENCY_BUCKETS),
+    "hotel_website_password_hash_seconds": Family(
+        "histogram", "Time taken to hash and check passwords, including time queued.", LATENCY_BUCKETS),
+    "hotel_website_password_hash_rejected_total": Family(
+        "counter", "Passwords turned away because too many were waiting to be hashed.", None),
+    "hotel_website_cache_lookups_total": Family(
+        "counter", "Cache lookups, by cache and whether they were a hit or a miss.", None),
+    "hotel_website_cache_hit_ratio": Family(
+        "gauge", "Share of lookups answered by each cache, taken from hotel_website_cache_lookups_total.", None)
+}
+
+# A sample's name and its labels, as sorted (name, value) pairs
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_HEADER = struct.Struct("<Q")  # Number of bytes of the file in use
+_KEY_LENGTH = struct.Struct("<I")
+_VALUE = struct.Struct("<d")
+
+
+def _encode_key(key: SampleKey) -> bytes:
+    return json.dumps([key[0], key[1]]).encode()
+
+
+def _decode_key(data: bytes) -> SampleKey:
+    name, labels = json.loads(data)
+    return name, tuple((label, value) for label, value in labels)
+
+
+def _read_entries(buffer, used: int) -> Iterator[Tuple[SampleKey, int]]:
+    """Yields the key of each sample in a metrics file and the position of its value.
+
+    Each entry is the length of its key, the key as JSON, padding up to a multiple of
+    8 bytes and then its value as a double.
+    """
+    position = _HEADER.size
+    while position + _KEY_LENGTH.size <= used:
+        length, = _KEY_LENGTH.unpack_from(buffer, position)
+        key_start = position + _KEY_LENGTH.size
+        value_position = key_start + length + (-(_KEY_LENGTH.size + length) % 8)
+        if value_position + _VALUE.size > used:
+            break
+
+        yield _decode_key(bytes(buffer[key_start:key_start + length])), value_position
+        position = value_position + _VALUE.size
+
+
+def read_metrics_file(path: str) -> Iterator[Tuple[SampleKey, float]]:
+    """Yields each sample in a metrics file written by another process, with its value."""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < _HEADER.size:
+        return
+
+    used = min(_HEADER.unpack_from(data)[0], len(data))
+    for key, position in _read_entries(data, used):
+        yield key, _VALUE.unpack_from(data, position)[0]
+
+
+class _MemoryValues:
+    """Sample values of this process, when it is the only one serving the app."""
+    def __init__(self):
+        self._values = defaultdict(float)
+
+    def inc(self, key: SampleKey, amount: float) -> None:
+        self._values[key] += amount
+
+    def items(self) -> Iterator[Tuple[SampleKey, float]]:
+        return iter(list(self._values.items()))
+
+
+class _MmapValues:
+    """Sample values of this process, kept in a memory mapped file so that the other
+    processes of a multi-process server can add them to their own.
+
+    Only this process writes to the file. A new sample is written in full before the
+    header is updated to include it, so readers never see half of one.
+    """
+    def __init__(self, path: str):
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size < METRICS_FILE_BYTES:
+            self._file.truncate(METRICS_FILE_BYTES)
+
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        # Carries on from a file left by an earlier process with the same pid
+        self._used = _HEADER.unpack_from(self._mmap)[0] or _HEADER.size
+        self._positions = dict(_read_entries(self._mmap, self._used))
+
+    def inc(self, key: SampleKey, amount: float) -> None:
+        position = self._positions.get(key)
+        if position is None:
+            position = self._add(key)
+
+        _VALUE.pack_into(self._mmap, position, _VALUE.unpack_from(self._mmap, position)[0] + amount)
+
+    def _add(self, key: SampleKey) -> int:
+        encoded = _encode_key(key)
+        padding = -(_KEY_LENGTH.size + len(encoded)) % 8
+        size = _KEY_LENGTH.size + len(encoded) + padding + _VALUE.size
+        if self._used + size > len(self._mmap):
+            self._grow(self._used + size)
+
+        start = self._used
+        position = start + _KEY_LENGTH.size + len(encoded) + padding
+        _KEY_LENGTH.pack_into(self._mmap, start, len(encoded))
+        self._mmap[start + _KEY_LENGTH.size:start + _KEY_LENGTH.size + len(encoded)] = encoded
+        _VALUE.pack_into(self._mmap, position, 0.0)
+
+        self._used += size
+        _HEADER.pack_into(self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, needed: int) -> None:
+        size = len(self._mmap)
+        while size < needed:
+            size *= 2
+
+        self._mmap.close()
+        self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+    def items(self) -> Iterator[Tuple[SampleKey, float]]:
+        return iter([(key, _VALUE.unpack_from(self._mmap, position)[0]) for key, position in self._positions.items()])
+
+    def close(self) -> None:
+        self._mmap.close()
+        self._file.close()
+
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample_line(name: str, labels: tuple, value: float) -> str:
+    if not labels:
+        return f"{name} {_format_value(value)}"
+
+    label_text = ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+    return f"{name}{{{label_text}}} {_format_value(value)}"
+
+
+def cache_hit_ratios(samples: Dict[SampleKey, float]) -> Dict[SampleKey, float]:
+    """Returns a hit ratio sample for each cache with lookups in samples."""
+    lookups = defaultdict(lambda: {"hit": 0.0, "miss": 0.0})
+    for (name, labels), value in samples.items():
+        if name == "hotel_website_cache_lookups_total":
+            labels = dict(labels)
+            lookups[labels["cache"]][labels["result"]] += value
+
+    return {
+        ("hotel_website_cache_hit_ratio", (("cache", cache),)): counts["hit"] / (counts["hit"] + counts["miss"])
+        for cache, counts in lookups.items() if counts["hit"] + counts["miss"]}
+
+
+def exposition(samples: Dict[SampleKey, float]) -> str:
+    """Returns samples in the Prometheus text exposition format.
+
+    Histogram buckets are stored uncumulated, each only counting the values that fell
+    in it, and are added up here.
+    """
+    by_name = defaultdict(dict)
+    for (name, labels), value in samples.items():
+        by_name[name][labels] = value
+
+    lines = []
+    for name, family in FAMILIES.items():
+        lines.append(f"# HELP {name} {family.help}")
+        lines.append(f"# TYPE {name} {family.type}")
+
+        if family.type != "histogram":
+            lines.extend(_sample_line(name, labels, value) for labels, value in sorted(by_name[name].items()))
+            continue
+
+        buckets = by_name[name + "_bucket"]
+        for labels, count in sorted(by_name[name + "_count"].items()):
+            cumulative = 0.0
+            for bound in family.buckets + (math.inf,):
+                bucket_labels = labels + (("le", _format_value(bound)),)
+                cumulative += buckets.get(bucket_labels, 0.0)
+                lines.append(_sample_line(name + "_bucket", bucket_labels, cumulative))
+
+            lines.append(_sample_line(name + "_sum", labels, by_name[name + "_sum"].get(labels, 0.0)))
+            lines.append(_sample_line(name + "_count", labels, count))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRegistry:
+    """Sample values of one app, which can be recorded without an app context, such
+    as from a future's done callbacks, by holding on to the registry itself.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.lock = Lock()
+        self.pid = None
+        self.values = None
+
+    def _values(self):
+        # Opened by the process which first records a value, as servers fork their workers after create_app
+        pid = os.getpid()
+        if self.pid != pid:
+            directory = self.config["METRICS_MULTIPROCESS_DIR"]
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+                self.values = _MmapValues(os.path.join(directory, f"metrics_{pid}.db"))
+            else:
+                self.values = _MemoryValues()
+            self.pid = pid
+
+        return self.values
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        if not self.config["METRICS_ENABLED"]:
+            return
+
+        key = (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+        with self.lock:
+            self._values().inc(key, amount)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Adds value to the histogram name."""
+        if not self.config["METRICS_ENABLED"]:
+            return
+
+        buckets = FAMILIES[name].buckets
+        index = bisect_left(buckets, value)
+        bound = buckets[index] if index < len(buckets) else math.inf
+        labels = tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+        with self.lock:
+            values = self._values()
+            values.inc((name + "_bucket", labels + (("le", _format_value(bound)),)), 1)
+            values.inc((name + "_sum", labels), value)
+            values.inc((name + "_count", labels), 1)
+
+    def items(self) -> Dict[SampleKey, float]:
+        """Returns the value of every sample recorded by this process."""
+        with self.lock:
+            return dict(self._values().items())
+
+
+class Metrics:
+    """Counters and histograms of the app's performance, served from /metrics in the
+    Prometheus text exposition format.
+
+    /metrics is only served to logged in admins, or to scrapers sending the bearer
+    token METRICS_TOKEN, which defaults to the METRICS_TOKEN environment variable.
+
+    Each process keeps its own values. A server running the app in several processes
+    should set METRICS_MULTIPROCESS_DIR, or the PROMETHEUS_MULTIPROC_DIR environment
+    variable, to a directory shared by them which is emptied before the server starts.
+    Each process then keeps its values in its own memory mapped file there, and
+    /metrics adds up the files of every process, including ones which have exited.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("METRICS_ENABLED", True)
+        app.config.setdefault("METRICS_MULTIPROCESS_DIR", os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+        app.config.setdefault("METRICS_TOKEN", os.environ.get("METRICS_TOKEN"))
+        app.extensions["metrics"] = MetricsRegistry(app.config)
+
+        if app.config["METRICS_ENABLED"]:
+            app.add_url_rule("/metrics", "metrics", self.view)
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        """The current app's registry, to record to from outside of its app context."""
+        return current_app.extensions["metrics"]
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        self.registry.inc(name, amount, **labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Adds value to the histogram name."""
+        self.registry.observe(name, value, **labels)
+
+    def record_request(self, endpoint: str, method: str, status: int, duration: float, db_time: float) -> None:
+        endpoint = endpoint or "none"
+        self.inc("hotel_website_requests_total", endpoint=endpoint, method=method, status=status)
+        self.observe("hotel_website_request_duration_seconds", duration, endpoint=endpoint, method=method)
+        self.observe("hotel_website_request_db_seconds", db_time, endpoint=endpoint, method=method)
+
+    def collect(self) -> Dict[SampleKey, float]:
+        """Returns the value of every sample, added up over every process's file in
+        METRICS_MULTIPROCESS_DIR if it is set.
+        """
+        directory = current_app.config["METRICS_MULTIPROCESS_DIR"]
+        if not directory:
+            return self.registry.items()
+
+        samples = defaultdict(float)
+        for path in glob.glob(os.path.join(directory, "metrics_*.db")):
+            for key, value in read_metrics_file(path):
+                samples[key] += value
+
+        return dict(samples)
+
+    @staticmethod
+    def _authorised() -> bool:
+        token = current_app.config["METRICS_TOKEN"]
+        if token and hmac.compare_digest(
+                request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+            return True
+
+        return current_user.is_authenticated and current_user.admin
+
+    def view(self) -> Response:
+        if not self._authorised():
+            return Response("Unauthorized\n", status=401, headers={"WWW-Authenticate": 'Bearer realm="metrics"'})
+
+        samples = self.collect()
+        samples.update(cache_hit_ratios(samples))
+        return Response(exposition(samples), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+metrics = Metrics()
@@ -4,12 +4,14 @@ from typing import Union, Type, Tuple
 from datetime import date, timedelta
 import calendar
 
+from sqlalchemy import event, select, exists
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.sql import expression, func
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash
 
 from .constants import PEAK_PRICING, SINGLE_ROOM, DOUBLE_ROOM_ONE_GUEST, DOUBLE_ROOM_TWO_GUESTS, FAMILY_ROOM
+from .passwords import password_hasher
 
 db = SQLAlchemy()
 
@@ -37,15 +39,11 @@ class User(db.Model, UserMixin):
 
     @staticmethod
     def generate_password_hash(raw_password: str) -> str:
-        return generate_password_hash(
-            raw_password,
-            method="pbkdf2:sha256:15000",
-            salt_length=16)
+        return password_hasher.hash(raw_password)
 
     @staticmethod
     def create_user(username: str, raw_password: str, admin: bool = False) -> Type["User"]:
         """Returns a new user created with parameters provided, the raw_password is hashed."""
-        # Specifying exact hash parameters incase the default changes
         return User(
             username=username,
             password=User.generate_password_hash(raw_password),
@@ -166,6 +164,9 @@ class Roomtype(db.Model):
 
 
 class Room(db.Model):
+    # Lets bookings at a location be found through the booking table's room and date index
+    __table_args__ = (db.Index("ix_room_location_id_room_type_id", "location_id", "room_type_id"),)
+
     id = db.Column(db.Integer, primary_key=True)
 
     location_id = db.Column(db.Integer, db.ForeignKey("location.id"))
@@ -182,7 +183,15 @@ class Booking(db.Model):
 
     Card information is stored here, but *not* cvc, as storing this
     is illegal.
+
+    Bookings are mostly looked up by room and date range, to find clashes, or by
+    user and check out date, for the account page, which the two indexes cover.
     """
+    __table_args__ = (
+        db.Index("ix_booking_room_id_booking_start_booking_end", "room_id", "booking_start", "booking_end"),
+        db.Index("ix_booking_user_id_booking_end", "user_id", "booking_end")
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     guests = db.Column(db.Integer, nullable=False)
     booking_start = db.Column(db.Date, nullable=False)
@@ -222,38 +231,347 @@ class Booking(db.Model):
                 day=self.date_created.day))
 
 
+class RoomInventory(db.Model):
+    """Table for the number of rooms of a type sold at a location on each night.
+
+    Rows are kept in step with the booking table by the before_flush listener
+    below, so room types that are fully sold, or not sold at all, on the nights
+    searched can be told apart by reading one row per night rather than testing
+    every booking for overlap. Nights are inclusive of both the booking start
+    and end dates, matching the overlap tests used elsewhere.
+
+    Each night also records the location's InventoryVersion it was last changed
+    at, so whether any night in a range has changed can be told from the highest
+    version among them.
+    """
+    __tablename__ = "room_inventory"
+
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id"), primary_key=True)
+    room_type_id = db.Column(db.Integer, db.ForeignKey("roomtype.id"), primary_key=True)
+    night = db.Column(db.Date, primary_key=True)
+    rooms_sold = db.Column(db.Integer, server_default="0", nullable=False)
+    version = db.Column(db.Integer, server_default="0", nullable=False)
+
+
+class InventoryVersion(db.Model):
+    """Table for a counter per location, bumped once by every transaction which
+    changes its room inventory.
+
+    The search cache of every worker process compares the versions recorded in
+    room_inventory against those its entries were computed at.
+    """
+    __tablename__ = "inventory_version"
+
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id"), primary_key=True)
+    version = db.Column(db.Integer, server_default="0", nullable=False)
+
+
+def next_inventory_version(connection, location_id: int) -> int:
+    """Bumps a location's inventory version, inserting its row if missing, and returns it.
+
+    The row stays locked until the transaction ends, so no two transactions can
+    record the same version.
+    """
+    versions = InventoryVersion.__table__
+    updated = connection.execute(
+        versions.update().where(versions.c.location_id == location_id).values(version=versions.c.version + 1))
+
+    if updated.rowcount == 0:
+        connection.execute(versions.insert().values(location_id=location_id, version=1))
+
+    return connection.execute(select(versions.c.version).where(versions.c.location_id == location_id)).scalar_one()
+
+
+def adjust_inventory(
+        connection, location_id: int, room_type_id: int, start: date, end: date, delta: int, version: int) -> None:
+    """Adds delta to the rooms sold on every night from start to end (inclusive),
+    marking them as changed at version.
+
+    Missing nights are inserted first, then all nights are updated with a single
+    statement, so the change happens inside whichever transaction owns connection.
+    """
+    inventory = RoomInventory.__table__
+    in_range = (
+        inventory.c.location_id == location_id,
+        inventory.c.room_type_id == room_type_id,
+        inventory.c.night.between(start, end))
+
+    existing = {night for night, in connection.execute(select(inventory.c.night).where(*in_range))}
+    nights = (start + timedelta(days=i) for i in range((end - start).days + 1))
+    missing = [
+        {"location_id": location_id, "room_type_id": room_type_id, "night": night, "rooms_sold": 0}
+        for night in nights if night not in existing]
+
+    if missing:
+        connection.execute(inventory.insert(), missing)
+
+    connection.execute(
+        inventory.update().where(*in_range).values(rooms_sold=inventory.c.rooms_sold + delta, version=version))
+
+
+class LocationPopularity(db.Model):
+    """Table for the total number of bookings ever made at each location.
+
+    Counts are kept in step with the booking table by the before_flush listener
+    below, so the most popular locations can be read through the index rather
+    than by counting every booking.
+    """
+    __tablename__ = "location_popularity"
+    __table_args__ = (db.Index("ix_location_popularity_total_bookings", "total_bookings"),)
+
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id"), primary_key=True)
+    location = db.relationship("Location")
+    total_bookings = db.Column(db.Integer, server_default="0", nullable=False)
+
+
+def adjust_popularity(connection, location_id: int, delta: int) -> None:
+    """Adds delta to the total bookings at a location, inserting its row if missing."""
+    popularity = LocationPopularity.__table__
+    updated = connection.execute(
+        popularity.update().where(popularity.c.location_id == location_id).values(
+            total_bookings=popularity.c.total_bookings + delta))
+
+    if updated.rowcount == 0:
+        connection.execute(popularity.insert().values(location_id=location_id, total_bookings=delta))
+
+
+class BookingDailyFact(db.Model):
+    """Rollup table of the bookings at each location, for each room type and night.
+
+    Holds the rooms sold, guests staying and revenue on each night, along with the
+    bookings and guests arriving that night. The number of bookings overlapping a
+    period is the rooms sold on its first night plus the arrivals on the nights after,
+    so the analytics reports can be answered from here rather than from every booking.
+    Revenue is in the location's own currency.
+
+    Unlike room_inventory this is not updated as bookings change, it is brought up
+    to date by the refresh-booking-facts command, see rollups.py.
+    """
+    __tablename__ = "booking_daily_fact"
+
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id"), primary_key=True)
+    room_type_id = db.Column(db.Integer, db.ForeignKey("roomtype.id"), primary_key=True)
+    night = db.Column(db.Date, primary_key=True)
+    rooms_sold = db.Column(db.Integer, server_default="0", nullable=False)
+    guests = db.Column(db.Integer, server_default="0", nullable=False)
+    revenue = db.Column(db.Numeric(precision=12, scale=2), server_default="0", nullable=False)
+    arrivals = db.Column(db.Integer, server_default="0", nullable=False)
+    arrival_guests = db.Column(db.Integer, server_default="0", nullable=False)
+
+
+class BookingFactSource(db.Model):
+    """Table of what each booking last added to booking_daily_fact.
+
+    Kept so a booking's old contribution can be taken away again once it is
+    changed or deleted, even though the booking row itself may be gone.
+    """
+    __tablename__ = "booking_fact_source"
+
+    booking_id = db.Column(db.Integer, primary_key=True)  # No foreign key, rows outlive deleted bookings
+    location_id = db.Column(db.Integer, nullable=False)
+    room_type_id = db.Column(db.Integer, nullable=False)
+    booking_start = db.Column(db.Date, nullable=False)
+    booking_end = db.Column(db.Date, nullable=False)
+    guests = db.Column(db.Integer, nullable=False)
+    peak_rate = db.Column(db.Numeric(precision=10, scale=2), nullable=False)
+    off_peak_rate = db.Column(db.Numeric(precision=10, scale=2), nullable=False)
+
+
+class RollupWatermark(db.Model):
+    """Table recording how far each rollup table has been brought up to date."""
+    __tablename__ = "rollup_watermark"
+
+    name = db.Column(db.String(50), primary_key=True)
+    processed_until = db.Column(db.DateTime(timezone=True), nullable=False)
+
+
+def _inventory_key(connection, room_id: int, start: date, end: date) -> Union[Tuple[int, int, date, date], None]:
+    """Returns the (location_id, room_type_id, start, end) a booking of room_id counts against."""
+    if None in (room_id, start, end):
+        return None
+
+    room = connection.execute(
+        select(Room.location_id, Room.room_type_id).where(Room.id == room_id)).first()
+
+    if room is None:
+        return None
+
+    return room.location_id, room.room_type_id, start, end
+
+
+@event.listens_for(db.session, "before_flush")
+def update_booking_counts(session, flush_context, instances) -> None:
+    """Keeps RoomInventory, InventoryVersion and LocationPopularity in step with
+    bookings that are being added, changed or deleted.
+
+    The previous state of changed and deleted bookings is read from the database,
+    as it is still unchanged at this point of the flush.
+    """
+    connection = session.connection()
+    changes = []
+
+    for booking in session.new:
+        if isinstance(booking, Booking):
+            room_id = booking.room.id if booking.room is not None else booking.room_id
+            changes.append((None, _inventory_key(connection, room_id, booking.booking_start, booking.booking_end)))
+
+    for booking in list(session.dirty) + list(session.deleted):
+        if not isinstance(booking, Booking):
+            continue
+
+        old = connection.execute(
+            select(Booking.room_id, Booking.booking_start, Booking.booking_end).where(
+                Booking.id == booking.id)).first()
+        old_key = _inventory_key(connection, *old) if old else None
+
+        if booking in session.deleted:
+            changes.append((old_key, None))
+        else:
+            room_id = booking.room.id if booking.room is not None else booking.room_id
+            new_key = _inventory_key(connection, room_id, booking.booking_start, booking.booking_end)
+            if new_key != old_key:
+                changes.append((old_key, new_key))
+
+    changed_locations = {key[0] for change in changes for key in change if key}
+    versions = {location_id: next_inventory_version(connection, location_id) for location_id in sorted(changed_locations)}
+
+    for old_key, new_key in changes:
+        if old_key:
+            adjust_inventory(connection, *old_key, delta=-1, version=versions[old_key[0]])
+            adjust_popularity(connection, old_key[0], delta=-1)
+        if new_key:
+            adjust_inventory(connection, *new_key, delta=1, version=versions[new_key[0]])
+            adjust_popularity(connection, new_key[0], delta=1)
+
+    # Read by the search cache once the transaction is committed
+    session.info.setdefault("booking_changes", []).extend(
+        key for change in changes for key in change if key)
+
+
+def allocate_room(booking: Booking, location_id: int, room_type_id: int, attempts: int = 5) -> Union[Room, None]:
+    """Assigns a free room of a type at a location to booking, then commits it.
+
+    The room is picked with a locking read and checked again for clashing bookings
+    once the booking has been inserted, so two requests racing for the same room
+    can't both be committed. On a clash, or a lock conflict from the database, the
+    transaction is rolled back and another room is tried.
+
+    Returns the room booked, or None if no free room could be claimed.
+    """
+    for _ in range(attempts):
+        # Logic for testing if there is any overlap of ranges from:
+        # https://stackoverflow.com/a/3269471
+        overlapping = exists().where(
+            Booking.room_id == Room.id,
+            booking.booking_start <= Booking.booking_end,
+            Booking.booking_start <= booking.booking_end)
+
+        with db.session.no_autoflush:
+            room = Room.query.where(
+                Room.location_id == location_id,
+                Room.room_type_id == room_type_id,
+                ~overlapping
+            ).order_by(Room.id).with_for_update().first()
+
+        if room is None:
+            db.session.rollback()
+            return None
+
+        booking.room = room
+        db.session.add(booking)
+
+        try:
+            db.session.flush()
+
+            clash = Booking.query.with_entities(Booking.id).where(
+                Booking.room_id == room.id,
+                Booking.id != booking.id,
+                booking.booking_start <= Booking.booking_end,
+                Booking.booking_start <= booking.booking_end
+            ).with_for_update().first()
+
+            if clash is None:
+                db.session.commit()
+                return room
+        except (IntegrityError, OperationalError):
+            pass
+
+        db.session.rollback()
+
+    return None
+
+
+def free_rooms(location_id: int, start: date, end: date, room_type_ids: list = None) -> dict:
+    """Finds the number of rooms of each type at a location free on every night of a period
+
+    Each booking holds one room for its whole stay, so a room type can have a free
+    room on every night without any single room being free for all of them. Room
+    inventory is only used to skip the room types that are fully sold on some night,
+    or have nothing sold at all; the rest are counted room by room.
+
+    Returns a dict of room type id to the number of rooms free.
+    """
+    # The busiest night in the period limits how many rooms of each type can be free
+    rooms_used = RoomInventory.query.with_entities(
+        RoomInventory.room_type_id, func.max(RoomInventory.rooms_sold).label("rooms_sold")
+    ).where(
+        RoomInventory.location_id == location_id,
+        RoomInventory.night.between(start, end)
+    ).group_by(RoomInventory.room_type_id).subquery()
+
+    rooms = Room.query.with_entities(
+        Room.room_type_id, func.count(Room.id), func.coalesce(func.max(rooms_used.c.rooms_sold), 0)
+    ).outerjoin(
+        rooms_used, rooms_used.c.room_type_id == Room.room_type_id
+    ).where(Room.location_id == location_id).group_by(Room.room_type_id)
+
+    if room_type_ids is not None:
+        rooms = rooms.where(Room.room_type_id.in_(room_type_ids))
+
+    rooms = rooms.all()
+
+    free = {room_type_id: 0 for room_type_id, _, _ in rooms}
+    partly_sold = []
+    for room_type_id, total, used in rooms:
+        if used == 0:
+            free[room_type_id] = total
+        elif used < total:
+            partly_sold.append(room_type_id)
+
+    if partly_sold:
+        # Logic for testing if there is any overlap of ranges from:
+        # https://stackoverflow.com/a/3269471
+        overlapping = exists().where(
+            Booking.room_id == Room.id,
+            Booking.booking_start <= end,
+            start <= Booking.booking_end)
+
+        free.update(Room.query.with_entities(Room.room_type_id, func.count(Room.id)).where(
+            Room.location_id == location_id,
+            Room.room_type_id.in_(partly_sold),
+            ~overlapping
+        ).group_by(Room.room_type_id).all())
+
+    return free
+
+
 def rooms_available(self, start: date, end: date, **kwargs: dict) -> int:
     """Finds the number of rooms available at a location during a time period
 
     Keyword Arguments:
         room_types: A tuple of Roomtype objects, by default all room types are selected
     """
-    room_types = kwargs.get("room_types", [rt for rt in Roomtype.query.all()])
-    try:
-        _ = list(room_types)[0]
-    except TypeError:
-        raise ValueError("Invalid room_types value, a list/tuple of room_types must be provided") from TypeError
-
-    if isinstance(room_types[0], Roomtype):
-        room_types = [rt.id for rt in room_types]
-
-    rooms = Room.query.with_entities(func.count(Room.id)).where(
-        Room.location_id == self.id,
-        Room.room_type_id.in_(room_types)
-    ).first()[0]
-
-    rooms_used = Room.query.with_entities(func.count(Room.id))
-    rooms_used = rooms_used.outerjoin(Room.bookings).where(
-        Room.location_id == self.id,
-        Room.room_type_id.in_(room_types),
-        Booking.id != None,  # noqa: E711
-        # Logic for testing if there is any overlap of ranges from:
-        # https://stackoverflow.com/a/3269471
-        start <= Booking.booking_end,
-        Booking.booking_start <= end
-    ).first()[0]
+    room_types = kwargs.get("room_types")
+    if room_types is not None:
+        try:
+            _ = list(room_types)[0]
+        except TypeError:
+            raise ValueError("Invalid room_types value, a list/tuple of room_types must be provided") from TypeError
+
+        if isinstance(room_types[0], Roomtype):
+            room_types = [rt.id for rt in room_types]
 
-    return rooms - rooms_used
+    return sum(free_rooms(self.id, start, end, room_types).values())
 
 
 Location.rooms_available = rooms_available
@@ -0,0 +1,152 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import partial
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+from .metrics import MetricsRegistry, metrics
+
+# Number of recent hashes per operation that latency percentiles are taken from
+LATENCY_SAMPLES = 1000
+
+
+class PasswordHashingBusy(Exception):
+    """Raised when too many passwords are already waiting to be hashed."""
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a pool of PASSWORD_HASH_WORKERS threads.
+
+    Each pbkdf2 hash keeps a CPU busy for its whole run, so a burst of logins hashed
+    on the request threads would starve every other request. hashlib releases the GIL
+    while hashing, so the pool's threads run in parallel while leaving the remaining
+    CPU to the rest of the site. At most PASSWORD_HASH_QUEUE_SIZE hashes wait or run
+    at once, beyond that PasswordHashingBusy is raised straight away rather than
+    queueing, and the app answers with a 503.
+
+    Passwords are hashed with PASSWORD_HASH_METHOD. When it changes, hashes made with
+    the old method still check, and needs_rehash() reports them so they can be
+    replaced the next time the user logs in.
+    """
+    operations = ("hash", "check")
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("PASSWORD_HASH_METHOD", "pbkdf2:sha256:15000")
+        app.config.setdefault("PASSWORD_HASH_WORKERS", 4)
+        app.config.setdefault("PASSWORD_HASH_QUEUE_SIZE", 32)
+        app.config.setdefault("PASSWORD_HASH_TIMEOUT", 10)
+        app.extensions["password_hasher"] = {
+            "lock": Lock(),
+            "executor": None,
+            "pending": 0,
+            "rejected": 0,
+            "counts": {operation: 0 for operation in self.operations},
+            "latencies": {operation: deque(maxlen=LATENCY_SAMPLES) for operation in self.operations}
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["password_hasher"]
+
+    def _run(self, operation: str, function: Callable, *args):
+        state = self._state
+        with state["lock"]:
+            if state["pending"] >= current_app.config["PASSWORD_HASH_QUEUE_SIZE"]:
+                state["rejected"] += 1
+                metrics.inc("hotel_website_password_hash_rejected_total")
+                raise PasswordHashingBusy()
+
+            if state["executor"] is None:
+                state["executor"] = ThreadPoolExecutor(
+                    max_workers=current_app.config["PASSWORD_HASH_WORKERS"],
+                    thread_name_prefix="password_hasher")
+
+            state["pending"] += 1
+            future = state["executor"].submit(function, *args)
+
+        # The hash is only counted as finished once it leaves the pool, even if the request gave up on it
+        future.add_done_callback(
+            partial(self._finished, metrics.registry, state, operation, perf_counter()))
+
+        try:
+            return future.result(timeout=current_app.config["PASSWORD_HASH_TIMEOUT"])
+        except TimeoutError:
+            raise PasswordHashingBusy()
+
+    @staticmethod
+    def _finished(registry: MetricsRegistry, state: dict, operation: str, submitted_at: float, future: Future) -> None:
+        # Run without an app context, as it is called in the request's thread if the hash
+        # has already finished, where popping another one would remove the request's session
+        latency = perf_counter() - submitted_at
+        with state["lock"]:
+            state["pending"] -= 1
+            state["counts"][operation] += 1
+            state["latencies"][operation].append(latency)
+
+        registry.observe("hotel_website_password_hash_seconds", latency, operation=operation)
+
+    def hash(self, raw_password: str) -> str:
+        # Specifying exact hash parameters incase the default changes
+        return self._run(
+            "hash", partial(generate_password_hash, method=current_app.config["PASSWORD_HASH_METHOD"], salt_length=16),
+            raw_password)
+
+    def check(self, password_hash: str, raw_password: str) -> bool:
+        return self._run("check", check_password_hash, password_hash, raw_password)
+
+    @staticmethod
+    def _method_prefix() -> str:
+        """Returns the part before the salt of hashes made with PASSWORD_HASH_METHOD.
+
+        werkzeug fills in the number of pbkdf2 iterations when the method leaves it out,
+        so it is filled in the same way here, as hashing to find it would block the
+        request outside of the pool.
+        """
+        method = current_app.config["PASSWORD_HASH_METHOD"]
+        if not method.startswith("pbkdf2:"):
+            return method
+
+        args = method[len("pbkdf2:"):].split(":")
+        iterations = int(args[1] or 0) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return f"pbkdf2:{args[0]}:{iterations}"
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Returns True if password_hash wasn't made with the current PASSWORD_HASH_METHOD."""
+        return password_hash.split("$", 1)[0] != self._method_prefix()
+
+    def stats(self) -> dict:
+        """Returns the number of hashes waiting or running, the number rejected and, for
+        each operation, how many have finished along with the 50th and 95th percentile
+        and maximum of recent latencies in milliseconds, including time spent queued.
+        """
+        state = self._state
+        with state["lock"]:
+            stats = {"pending": state["pending"], "rejected": state["rejected"]}
+            for operation in self.operations:
+                latencies = sorted(state["latencies"][operation])
+                stats[operation] = {"count": state["counts"][operation]}
+                if latencies:
+                    stats[operation].update({
+                        "p50_ms": latencies[len(latencies) // 2] * 1000,
+                        "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                        "max_ms": latencies[-1] * 1000
+                    })
+
+        return stats
+
+    def shutdown(self) -> None:
+        state = self._state
+        with state["lock"]:
+            executor, state["executor"] = state["executor"], None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher()
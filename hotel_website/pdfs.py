@@ -0,0 +1,426 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import hashlib
+import io
+import multiprocessing
+import os
+import tempfile
+import zipfile
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+from typing import Iterable, Iterator, Tuple, Type, Union
+
+import weasyprint
+from flask import current_app, render_template, request
+from flask_weasyprint import HTML
+from werkzeug.security import safe_join
+
+from .constants import CURRENCY_SYMBOLS, ROOM_TYPES
+from .metrics import MetricsRegistry, metrics
+from .models import db, Booking, Location, Currency, Roomtype, Room
+
+# Files which change how a booking PDF looks, relative to the package directory
+PDF_TEMPLATE_FILES = (
+    "templates/pdf/booking.html",
+    "static/css/pdf_booking.css",
+    "static/svgs/phone-solid.svg",
+    "static/svgs/envelope-solid.svg",
+    "static/svgs/globe-solid.svg"
+)
+
+# Columns of a booking printed on, or used to price, its PDF
+PDF_BOOKING_FIELDS = ("name", "email", "guests", "booking_start", "booking_end", "date_created", "room_id", "currency_id")
+
+# Tables whose rows are printed on, or used to price, a booking PDF
+PDF_SOURCE_MODELS = (Location, Currency, Roomtype, Room)
+
+
+def render_booking_html(booking: Booking) -> str:
+    symbol = CURRENCY_SYMBOLS[booking.currency.acronym]
+    price, discount_price = booking.find_room_prices()
+
+    return render_template(
+        "/pdf/booking.html", booking=booking, ROOM_TYPES=ROOM_TYPES,
+        price=price, discount_price=discount_price, symbol=symbol)
+
+
+def render_booking_pdf(booking: Booking) -> bytes:
+    started = perf_counter()
+    pdf = HTML(string=render_booking_html(booking)).write_pdf()
+    metrics.observe("hotel_website_pdf_render_seconds", perf_counter() - started, mode="request")
+    return pdf
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Writes data to a temporary file next to path then moves it into place,
+    so that a half written file is never served.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def render_pdf_file(html: str, base_url: str, static_url: str, static_folder: str, path: str) -> str:
+    """Lays out already rendered booking html as a PDF and writes it to path.
+
+    Run in a worker process without an app, so links under static_url are read
+    straight from static_folder rather than fetched through flask_weasyprint.
+    """
+    def url_fetcher(url: str) -> dict:
+        if url.startswith(static_url):
+            url = Path(safe_join(static_folder, url[len(static_url):])).as_uri()
+        return weasyprint.default_url_fetcher(url)
+
+    write_atomic(path, weasyprint.HTML(string=html, base_url=base_url, url_fetcher=url_fetcher).write_pdf())
+    return path
+
+
+class _ZipStream(io.RawIOBase):
+    """Unseekable file that zipfile writes into, emptied as each member is streamed out."""
+    def __init__(self):
+        super().__init__()
+        self.buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        return len(data)
+
+    def take(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def stream_zip(files: Iterable[Tuple[Union[str, bytes], str]]) -> Iterator[bytes]:
+    """Yields a zip archive of (path or contents, name in archive) pairs one file at
+    a time, so only a single file is held in memory however many are archived.
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for source, name in files:
+            if isinstance(source, bytes):
+                archive.writestr(name, source)
+            else:
+                archive.write(source, arcname=name)
+            yield stream.take()
+
+    yield stream.take()
+
+
+CacheSettings = namedtuple("CacheSettings", ["directory", "max_bytes", "lock"])
+
+
+class BookingPdfCache:
+    """On disk cache of rendered booking PDFs.
+
+    Files are named after a hash of the booking id, the booking fields the PDF
+    shows and a hash of the PDF template files, so an edited booking or template
+    is rendered again rather than served stale. The least recently served files
+    are removed once the cache grows beyond PDF_CACHE_MAX_BYTES. Changes to the
+    locations, currencies, room types or rooms a booking is priced from clear the
+    whole cache.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("PDF_CACHE_DIR", os.path.join(app.instance_path, "pdf_cache"))
+        app.config.setdefault("PDF_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+
+        template_hash = hashlib.sha256()
+        for filename in PDF_TEMPLATE_FILES:
+            with open(os.path.join(app.root_path, filename), "rb") as f:
+                template_hash.update(f.read())
+
+        app.extensions["booking_pdf_cache"] = {
+            "lock": Lock(),
+            "template_version": template_hash.hexdigest()
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["booking_pdf_cache"]
+
+    @property
+    def directory(self) -> str:
+        return current_app.config["PDF_CACHE_DIR"]
+
+    def path(self, booking: Booking) -> str:
+        """Returns the path the PDF for the current version of booking is stored at."""
+        # Taken from the fields themselves, date_updated only changes once a second
+        fields = ":".join(repr(getattr(booking, field)) for field in PDF_BOOKING_FIELDS)
+        key = hashlib.sha256(f"{booking.id}:{fields}:{self._state['template_version']}".encode()).hexdigest()
+
+        return os.path.join(self.directory, f"booking_{booking.id}_{key[:32]}.pdf")
+
+    def get(self, booking: Booking) -> Union[str, None]:
+        """Returns the path of the cached PDF for booking, or None if it hasn't been rendered."""
+        path = self.path(booking)
+        try:
+            os.utime(path)  # Marks the file as recently used for eviction
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, booking: Booking, pdf: bytes) -> str:
+        """Stores a rendered PDF for booking, replacing older versions, and returns its path."""
+        path = self.path(booking)
+        write_atomic(path, pdf)
+        self.stored(booking.id, path)
+        return path
+
+    def settings(self) -> CacheSettings:
+        """Returns the current app's cache directory, size limit and lock, to pass to
+        stored() from outside of its app context.
+        """
+        return CacheSettings(self.directory, current_app.config["PDF_CACHE_MAX_BYTES"], self._state["lock"])
+
+    def stored(self, booking_id: int, path: str, settings: CacheSettings = None) -> None:
+        """Removes older versions of a booking's PDF once path has been written, then evicts."""
+        settings = settings or self.settings()
+        prefix = f"booking_{booking_id}_"
+        for entry in os.scandir(settings.directory):
+            if entry.name.startswith(prefix) and entry.name.endswith(".pdf") and entry.path != path:
+                self._remove(entry.path)
+
+        self.evict(settings)
+
+    def evict(self, settings: CacheSettings = None) -> None:
+        """Removes the least recently used PDFs until the cache fits in PDF_CACHE_MAX_BYTES."""
+        settings = settings or self.settings()
+
+        with settings.lock:
+            entries = []
+            for entry in os.scandir(settings.directory):
+                if entry.name.endswith(".pdf"):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= settings.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    def clear(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf"):
+                self._remove(entry.path)
+
+    def invalidate(self, model: Type[db.Model]) -> None:
+        """Clears the cache if rows of model may be shown on booking PDFs."""
+        if model in PDF_SOURCE_MODELS:
+            self.clear()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+booking_pdf_cache = BookingPdfCache()
+
+
+RenderJob = namedtuple("RenderJob", ["path", "future"])
+
+# Number of recently failed renders remembered, so their status can be reported
+FAILED_RENDERS_KEPT = 256
+
+
+class BookingPdfRenderQueue:
+    """Renders booking PDFs into the booking PDF cache ahead of time, using a pool
+    of PDF_RENDER_WORKERS worker processes.
+
+    The html is rendered in the request, as it needs the database, and only the
+    WeasyPrint layout is done in the pool. At most PDF_RENDER_QUEUE_SIZE renders
+    wait or run at once, further bookings are skipped and rendered when first
+    downloaded instead. Setting PDF_RENDER_WORKERS to 0 disables pre-rendering.
+
+    Jobs are only kept until they finish or are cancelled. The paths of the last
+    FAILED_RENDERS_KEPT failed renders are kept so status() can report them.
+    """
+    def init_app(self, app) -> None:
+        app.config.setdefault("PDF_RENDER_WORKERS", 2)
+        app.config.setdefault("PDF_RENDER_QUEUE_SIZE", 32)
+        app.extensions["booking_pdf_render_queue"] = {
+            "lock": Lock(),
+            "executor": None,
+            "jobs": {},
+            "queued": 0,
+            "failed": OrderedDict()
+        }
+
+    @property
+    def _state(self) -> dict:
+        return current_app.extensions["booking_pdf_render_queue"]
+
+    def _executor(self) -> ProcessPoolExecutor:
+        state = self._state
+        if state["executor"] is None:
+            # Worker processes are spawned rather than forked, so they don't inherit database connections
+            state["executor"] = ProcessPoolExecutor(
+                max_workers=current_app.config["PDF_RENDER_WORKERS"],
+                mp_context=multiprocessing.get_context("spawn"))
+
+        return state["executor"]
+
+    def _submit(self, html: str, path: str) -> Future:
+        submitted_at = perf_counter()
+        future = self._executor().submit(
+            render_pdf_file, html, request.host_url,
+            request.host_url + current_app.static_url_path.lstrip("/") + "/",
+            current_app.static_folder, path)
+        future.add_done_callback(partial(self._rendered, metrics.registry, submitted_at))
+        return future
+
+    @staticmethod
+    def _rendered(registry: MetricsRegistry, submitted_at: float, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        registry.observe("hotel_website_pdf_render_seconds", perf_counter() - submitted_at, mode="pool")
+
+    @staticmethod
+    def _queued(state: dict, booking_id: int, path: str) -> bool:
+        job = state["jobs"].get(booking_id)
+        return job is not None and job.path == path and not job.future.done()
+
+    def enqueue(self, booking: Booking) -> bool:
+        """Queues booking's PDF to be rendered, returns False if it couldn't be queued."""
+        if current_app.config["PDF_RENDER_WORKERS"] == 0:
+            return False
+
+        path = booking_pdf_cache.path(booking)
+        if os.path.exists(path):
+            return True
+
+        state = self._state
+        with state["lock"]:
+            if self._queued(state, booking.id, path):
+                return True
+
+        # Rendered outside of the lock, which status() and the done callbacks also take
+        html = render_booking_html(booking)
+
+        with state["lock"]:
+            if self._queued(state, booking.id, path):
+                return True
+
+            if state["queued"] >= current_app.config["PDF_RENDER_QUEUE_SIZE"]:
+                return False
+
+            future = self._submit(html, path)
+            state["jobs"][booking.id] = RenderJob(path, future)
+            state["failed"].pop(booking.id, None)
+            state["queued"] += 1
+
+        future.add_done_callback(partial(
+            self._finished, state, booking_pdf_cache.settings(), current_app.logger, booking.id))
+        return True
+
+    @staticmethod
+    def _finished(state: dict, cache_settings: CacheSettings, logger, booking_id: int, future: Future) -> None:
+        # Run without an app context, as cancelling calls this in the request's thread,
+        # where pushing and popping another one would remove the request's session
+        error = None if future.cancelled() else future.exception()
+
+        with state["lock"]:
+            state["queued"] -= 1
+            job = state["jobs"].get(booking_id)
+            if job is not None and job.future is future:
+                del state["jobs"][booking_id]
+                if error is not None:
+                    state["failed"][booking_id] = job.path
+                    while len(state["failed"]) > FAILED_RENDERS_KEPT:
+                        state["failed"].popitem(last=False)
+
+        if error is not None:
+            logger.error("Rendering the PDF for booking %s failed", booking_id, exc_info=error)
+        elif not future.cancelled():
+            booking_pdf_cache.stored(booking_id, future.result(), cache_settings)
+
+    def render(self, booking: Booking) -> Future:
+        """Returns a future for the path of booking's rendered PDF, rendering it in the
+        pool unless it is already cached.
+
+        Unlike enqueue() this isn't limited by PDF_RENDER_QUEUE_SIZE, so callers must
+        limit how many renders they have waiting at once. With no workers the PDF is
+        rendered before returning. A render already queued for booking is shared rather
+        than started again. Errors are raised from the future's result rather than
+        from this call.
+        """
+        path = booking_pdf_cache.path(booking)
+
+        state = self._state
+        with state["lock"]:
+            job = state["jobs"].get(booking.id)
+        if job is not None and job.path == path and not job.future.cancelled():
+            return job.future
+
+        future = Future()
+        try:
+            if current_app.config["PDF_RENDER_WORKERS"] != 0 and not os.path.exists(path):
+                return self._submit(render_booking_html(booking), path)
+
+            if not os.path.exists(path):
+                write_atomic(path, render_booking_pdf(booking))
+        except Exception as error:
+            future.set_exception(error)
+            return future
+
+        future.set_result(path)
+        return future
+
+    def status(self, booking: Booking) -> Union[str, None]:
+        """Returns one of "ready", "queued", "rendering" or "failed" for booking's
+        current PDF, or None if it hasn't been queued.
+        """
+        path = booking_pdf_cache.path(booking)
+        if os.path.exists(path):
+            return "ready"
+
+        state = self._state
+        with state["lock"]:
+            job = state["jobs"].get(booking.id)
+            failed = state["failed"].get(booking.id) == path
+
+        if job is None or job.path != path or job.future.cancelled():
+            return "failed" if failed else None
+        if job.future.running():
+            return "rendering"
+        if not job.future.done():
+            return "queued"
+        return "failed" if job.future.exception() else "ready"
+
+    def cancel(self, booking: Booking) -> None:
+        """Cancels booking's render if it hasn't started, used when it is rendered inline instead."""
+        job = self._state["jobs"].get(booking.id)
+        if job is not None:
+            job.future.cancel()
+
+    def shutdown(self) -> None:
+        state = self._state
+        if state["executor"] is not None:
+            state["executor"].shutdown(cancel_futures=True)
+            state["executor"] = None
+
+
+booking_pdf_render_queue = BookingPdfRenderQueue()
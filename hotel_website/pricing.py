@@ -0,0 +1,129 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from datetime import date
+from typing import Iterable, List, Tuple, Union
+
+import numpy as np
+
+from .constants import PEAK_PRICING, SINGLE_ROOM, DOUBLE_ROOM_ONE_GUEST, DOUBLE_ROOM_TWO_GUESTS, FAMILY_ROOM
+from .models import Location, Roomtype, Currency
+
+# Indexed by month number, index 0 is unused
+PEAK_MONTHS = np.array([False] + [PEAK_PRICING[month] for month in range(1, 13)])
+
+
+def room_multiplier(room_type: Roomtype, guests: int) -> float:
+    """Returns the cost multiplier for a room type, as used by Location.find_room_prices."""
+    if room_type.room_type == "D":
+        return DOUBLE_ROOM_ONE_GUEST if guests == 1 else DOUBLE_ROOM_TWO_GUESTS
+    if room_type.room_type == "F":
+        return FAMILY_ROOM
+    return SINGLE_ROOM
+
+
+def discount_multiplier(booking_start: date, date_booked: date) -> Union[float, None]:
+    """Returns the advance booking discount multiplier, or None if no discount applies."""
+    days_in_advance = (booking_start - date_booked).days
+    if days_in_advance >= 80:
+        return 0.80
+    elif days_in_advance >= 60:
+        return 0.90
+    elif days_in_advance >= 45:
+        return 0.95
+    return None
+
+
+def find_room_prices_batch(
+        rooms: Iterable[Tuple[Location, Roomtype, int]],
+        booking_start: date,
+        booking_end: date,
+        currency: Currency,
+        date_booked: date = None) -> List[Tuple[float, Union[float, None]]]:
+    """Calculates the normal and discounted prices for many (location, room type, guests)
+    combinations over the same booking period, in the currency supplied.
+
+    Results are identical to calling Location.find_room_prices for each combination,
+    the arithmetic is done in the same order so floating point rounding matches.
+    """
+    rooms = list(rooms)
+    if not rooms:
+        return []
+
+    if not date_booked:
+        date_booked = date.today()
+
+    # One entry per night of the stay, inclusive of the end date, grouped into months
+    nights = np.arange(np.datetime64(booking_start, "D"), np.datetime64(booking_end, "D") + 1)
+    months, days = np.unique(nights.astype("datetime64[M]"), return_counts=True)
+    peak = PEAK_MONTHS[months.astype(int) % 12 + 1]
+
+    peak_prices = np.array([float(location.peak_price) for location, _, _ in rooms])
+    off_peak_prices = np.array([float(location.off_peak_price) for location, _, _ in rooms])
+    multipliers = np.array([room_multiplier(room_type, guests) for _, room_type, guests in rooms])
+    converted = np.array([location.currency_id != currency.id for location, _, _ in rooms])
+
+    base_prices = np.where(peak, peak_prices[:, np.newaxis], off_peak_prices[:, np.newaxis])
+    month_prices = base_prices * multipliers[:, np.newaxis] * days
+
+    # cumsum adds months left to right, matching the running total in find_room_prices
+    total_prices = np.cumsum(month_prices, axis=1)[:, -1]
+    total_prices = np.where(converted, total_prices * float(currency.conversion_rate), total_prices)
+
+    discount = discount_multiplier(booking_start, date_booked)
+    if discount is None:
+        return [(price, None) for price in total_prices.tolist()]
+
+    discount_prices = total_prices * discount
+    return list(zip(total_prices.tolist(), discount_prices.tolist()))
+
+
+def find_booking_prices_batch(
+        bookings: Iterable[Tuple[Location, Roomtype, int, date, date, date]],
+        currency: Currency) -> List[Tuple[float, Union[float, None]]]:
+    """Calculates the normal and discounted prices of many bookings, each given as
+    (location, room type, guests, booking start, booking end, date booked), in the
+    currency supplied.
+
+    Unlike find_room_prices_batch every booking may cover a different period. Results
+    are identical to calling Booking.find_room_prices for each booking.
+    """
+    bookings = list(bookings)
+    if not bookings:
+        return []
+
+    starts = np.array([booking[3] for booking in bookings], dtype="datetime64[D]")
+    ends = np.array([booking[4] for booking in bookings], dtype="datetime64[D]")
+    booked = np.array([booking[5] for booking in bookings], dtype="datetime64[D]")
+
+    # One column per month, from the month each booking starts in up to the longest stay
+    first_months = starts.astype("datetime64[M]")
+    month_spans = (ends.astype("datetime64[M]") - first_months).astype(int) + 1
+    months = first_months[:, np.newaxis] + np.arange(month_spans.max())
+
+    # Nights of each stay falling in each month, zero once the stay has ended
+    first_days = np.maximum(months.astype("datetime64[D]"), starts[:, np.newaxis])
+    last_days = np.minimum((months + 1).astype("datetime64[D]") - 1, ends[:, np.newaxis])
+    days = np.maximum((last_days - first_days).astype(int) + 1, 0)
+    peak = PEAK_MONTHS[months.astype(int) % 12 + 1]
+
+    peak_prices = np.array([float(location.peak_price) for location, *_ in bookings])
+    off_peak_prices = np.array([float(location.off_peak_price) for location, *_ in bookings])
+    multipliers = np.array([room_multiplier(room_type, guests) for _, room_type, guests, *_ in bookings])
+    converted = np.array([location.currency_id != currency.id for location, *_ in bookings])
+
+    base_prices = np.where(peak, peak_prices[:, np.newaxis], off_peak_prices[:, np.newaxis])
+    month_prices = base_prices * multipliers[:, np.newaxis] * days
+
+    # cumsum adds months left to right, matching the running total in find_room_prices,
+    # and adding the zeros after a stay ends leaves its total unchanged
+    total_prices = np.cumsum(month_prices, axis=1)[:, -1]
+    total_prices = np.where(converted, total_prices * float(currency.conversion_rate), total_prices)
+
+    days_in_advance = (starts - booked).astype(int)
+    discounts = np.select(
+        [days_in_advance >= 80, days_in_advance >= 60, days_in_advance >= 45], [0.80, 0.90, 0.95], np.nan)
+    discount_prices = total_prices * discounts
+
+    return [
+        (price, None if np.isnan(discount_price) else discount_price)
+        for price, discount_price in zip(total_prices.tolist(), discount_prices.tolist())]
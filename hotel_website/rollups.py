@@ -0,0 +1,241 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from collections import defaultdict, namedtuple
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+from sqlalchemy import and_, bindparam, exists, select
+from sqlalchemy.sql import func
+
+from .constants import PEAK_PRICING
+from .models import db, Location, Roomtype, Room, Booking, BookingDailyFact, BookingFactSource, RollupWatermark
+from .pricing import room_multiplier, discount_multiplier
+
+BOOKING_FACTS = "booking_daily_fact"
+
+# Bookings changed up to this long before the watermark are read again on each refresh,
+# so transactions which committed after a refresh but were timestamped before it aren't missed.
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Number of booking ids put in each IN (...) clause
+ID_BATCH_SIZE = 500
+
+FactKey = Tuple[int, int, date]
+FACT_MEASURES = ("rooms_sold", "guests", "revenue", "arrivals", "arrival_guests")
+
+
+def booking_fact_source(
+        booking_id: int,
+        location: Location,
+        room_type: Roomtype,
+        booking_start: date,
+        booking_end: date,
+        guests: int,
+        date_created: datetime) -> dict:
+    """Returns the booking_fact_source row for a booking, with the revenue it earns on
+    a peak and an off peak night in the location's currency.
+    """
+    multiplier = room_multiplier(room_type, guests) * (discount_multiplier(booking_start, date_created.date()) or 1.0)
+
+    return {
+        "booking_id": booking_id,
+        "location_id": location.id,
+        "room_type_id": room_type.id,
+        "booking_start": booking_start,
+        "booking_end": booking_end,
+        "guests": guests,
+        "peak_rate": round(float(location.peak_price) * multiplier, 2),
+        "off_peak_rate": round(float(location.off_peak_price) * multiplier, 2)
+    }
+
+
+def booking_facts(source: dict) -> Iterator[Tuple[FactKey, Tuple[int, int, float, int, int]]]:
+    """Yields the (location_id, room_type_id, night) keys a booking counts towards, with the
+    (rooms_sold, guests, revenue, arrivals, arrival_guests) it adds to each.
+    """
+    for i in range((source["booking_end"] - source["booking_start"]).days + 1):
+        night = source["booking_start"] + timedelta(days=i)
+        revenue = float(source["peak_rate"] if PEAK_PRICING[night.month] else source["off_peak_rate"])
+        arrival_guests = source["guests"] if i == 0 else 0
+
+        yield (
+            (source["location_id"], source["room_type_id"], night),
+            (1, source["guests"], revenue, int(i == 0), arrival_guests))
+
+
+def _batches(ids: List[int]) -> Iterator[List[int]]:
+    for i in range(0, len(ids), ID_BATCH_SIZE):
+        yield ids[i:i + ID_BATCH_SIZE]
+
+
+def _apply_fact_deltas(deltas: Dict[FactKey, List[float]]) -> None:
+    """Adds each key's measures onto booking_daily_fact, then removes nights left with no rooms sold."""
+    facts = BookingDailyFact.__table__
+
+    rows = []
+    for (location_id, room_type_id, night), measures in deltas.items():
+        measures = dict(zip(FACT_MEASURES, measures))
+        measures["revenue"] = round(measures["revenue"], 2)
+        if any(measures.values()):
+            rows.append({"location_id": location_id, "room_type_id": room_type_id, "night": night, **measures})
+    if not rows:
+        return
+
+    existing = set(db.session.execute(
+        select(facts.c.location_id, facts.c.room_type_id, facts.c.night).where(
+            facts.c.location_id.in_({row["location_id"] for row in rows}),
+            facts.c.night.between(min(row["night"] for row in rows), max(row["night"] for row in rows)))
+    ).all())
+
+    inserts = [row for row in rows if (row["location_id"], row["room_type_id"], row["night"]) not in existing]
+    if inserts:
+        db.session.execute(facts.insert(), inserts)
+
+    updates = [
+        {f"delta_{key}": value for key, value in row.items()}
+        for row in rows if (row["location_id"], row["room_type_id"], row["night"]) in existing]
+    if updates:
+        db.session.execute(
+            facts.update().where(
+                facts.c.location_id == bindparam("delta_location_id"),
+                facts.c.room_type_id == bindparam("delta_room_type_id"),
+                facts.c.night == bindparam("delta_night")
+            ).values({measure: facts.c[measure] + bindparam(f"delta_{measure}") for measure in FACT_MEASURES}),
+            updates)
+
+    db.session.execute(facts.delete().where(facts.c.rooms_sold <= 0))
+
+
+def refresh_booking_facts(full: bool = False) -> Tuple[int, int]:
+    """Brings the booking_daily_fact table up to date with the booking table.
+
+    Only bookings created or updated since the last refresh are read, using
+    date_created/date_updated, along with any bookings which have since been
+    deleted. Their old contribution is taken from booking_fact_source and their
+    new one added. With full the table is rebuilt from every booking instead, use
+    this after changing a location's prices or moving rooms between locations.
+
+    Returns the number of bookings counted and the number of deleted bookings removed.
+    """
+    watermark = RollupWatermark.query.get(BOOKING_FACTS)
+    processed_until = watermark.processed_until if watermark is not None and not full else None
+    # Read from the database's clock, as date_created and date_updated are
+    started_at = db.session.execute(select(func.now())).scalar()
+
+    if full:
+        db.session.execute(BookingDailyFact.__table__.delete())
+        db.session.execute(BookingFactSource.__table__.delete())
+
+    last_changed = func.coalesce(Booking.date_updated, Booking.date_created)
+    changed = Booking.query.with_entities(
+        Booking.id, Room.location_id, Room.room_type_id, Booking.booking_start,
+        Booking.booking_end, Booking.guests, Booking.date_created, last_changed.label("last_changed")
+    ).join(Booking.room)
+    if processed_until is not None:
+        changed = changed.where(last_changed >= processed_until - WATERMARK_OVERLAP)
+    changed = changed.all()
+
+    deleted_ids = [booking_id for booking_id, in BookingFactSource.query.with_entities(
+        BookingFactSource.booking_id
+    ).where(~exists().where(Booking.id == BookingFactSource.booking_id))]
+
+    # After a full delete no booking has an old contribution to take away
+    old_sources = []
+    stale_ids = [] if full else [row.id for row in changed] + deleted_ids
+    for batch in _batches(stale_ids):
+        old_sources += [
+            {column.key: getattr(source, column.key) for column in BookingFactSource.__table__.columns}
+            for source in BookingFactSource.query.where(BookingFactSource.booking_id.in_(batch))]
+
+    locations = {location.id: location for location in Location.query}
+    room_types = {room_type.id: room_type for room_type in Roomtype.query}
+    new_sources = [
+        booking_fact_source(
+            row.id, locations[row.location_id], room_types[row.room_type_id],
+            row.booking_start, row.booking_end, row.guests, row.date_created)
+        for row in changed]
+
+    deltas = defaultdict(lambda: [0, 0, 0.0, 0, 0])
+    for sources, sign in ((old_sources, -1), (new_sources, 1)):
+        for source in sources:
+            for key, measures in booking_facts(source):
+                for i, measure in enumerate(measures):
+                    deltas[key][i] += sign * measure
+
+    _apply_fact_deltas(deltas)
+
+    for batch in _batches(stale_ids):
+        db.session.execute(BookingFactSource.__table__.delete().where(BookingFactSource.booking_id.in_(batch)))
+    if new_sources:
+        db.session.execute(BookingFactSource.__table__.insert(), new_sources)
+
+    if watermark is None:
+        watermark = RollupWatermark(name=BOOKING_FACTS)
+        db.session.add(watermark)
+    watermark.processed_until = started_at
+    db.session.commit()
+
+    return len(changed), len(deleted_ids)
+
+
+OccupancyReport = namedtuple("OccupancyReport", [
+    "nights", "rows", "capacity", "rooms_sold", "revenue", "occupancy", "revpar"])
+
+
+def occupancy_report(location_ids: Iterable[int], start: date, end: date) -> OccupancyReport:
+    """Calculates occupancy and revenue per available room (RevPAR) for each night from
+    start to end (inclusive), from booking_daily_fact and the rooms at each location.
+
+    rows holds a (location_id, room_type_id) pair for every room type at the locations,
+    followed by a (location_id, None) pair for each location as a whole. capacity is the
+    number of rooms for each row, and rooms_sold, revenue, occupancy and revpar are
+    arrays with a row for each of those and a column for each night. RevPAR is in each
+    location's own currency.
+    """
+    capacity = Room.query.with_entities(
+        Room.location_id, Room.room_type_id, func.count(Room.id).label("rooms")
+    ).where(Room.location_id.in_(list(location_ids))).group_by(Room.location_id, Room.room_type_id).subquery()
+
+    # Room types without any sales still return a row, with no night
+    results = BookingDailyFact.query.with_entities(
+        capacity.c.location_id, capacity.c.room_type_id, capacity.c.rooms,
+        BookingDailyFact.night, BookingDailyFact.rooms_sold, BookingDailyFact.revenue
+    ).select_from(capacity).outerjoin(BookingDailyFact, and_(
+        BookingDailyFact.location_id == capacity.c.location_id,
+        BookingDailyFact.room_type_id == capacity.c.room_type_id,
+        BookingDailyFact.night.between(start, end)
+    )).all()
+
+    nights = np.arange(np.datetime64(start, "D"), np.datetime64(end, "D") + 1)
+    rooms = {(location_id, room_type_id): total for location_id, room_type_id, total, *_ in results}
+    rows = sorted(rooms)
+    row_index = {row: i for i, row in enumerate(rows)}
+
+    sales = [result for result in results if result.night is not None]
+    sale_rows = np.array([row_index[(result.location_id, result.room_type_id)] for result in sales], dtype=int)
+    sale_nights = (np.array([result.night for result in sales], dtype="datetime64[D]") - nights[0]).astype(int)
+
+    rooms_sold = np.zeros((len(rows), len(nights)))
+    revenue = np.zeros((len(rows), len(nights)))
+    rooms_sold[sale_rows, sale_nights] = [result.rooms_sold for result in sales]
+    revenue[sale_rows, sale_nights] = [float(result.revenue) for result in sales]
+    capacity = np.array([rooms[row] for row in rows], dtype=float)
+
+    # Each location's totals are the sum of its room types, found by multiplying with
+    # a matrix holding a 1 where a location (row) has a room type (column)
+    locations = sorted({location_id for location_id, _ in rows})
+    membership = np.equal.outer(locations, [location_id for location_id, _ in rows]).astype(float)
+    rooms_sold = np.vstack((rooms_sold, membership @ rooms_sold))
+    revenue = np.vstack((revenue, membership @ revenue))
+    capacity = np.concatenate((capacity, membership @ capacity))
+    rows += [(location_id, None) for location_id in locations]
+
+    return OccupancyReport(
+        nights=nights.astype(date).tolist(),
+        rows=rows,
+        capacity=capacity,
+        rooms_sold=rooms_sold,
+        revenue=revenue,
+        occupancy=rooms_sold / capacity[:, np.newaxis],
+        revpar=revenue / capacity[:, np.newaxis])
@@ -1,25 +1,94 @@
 # George Whittington, Student ID: 20026036, 2022
 
+import shutil
+from contextlib import contextmanager
+
 import pytest
+from sqlalchemy import event
 from werkzeug.test import TestResponse
 
 from hotel_website import create_app
-from hotel_website.commands import create_db_manually, fill_db_manually
+from hotel_website.commands import (
+    create_db_manually, fill_db_manually, generate_load_data_manually, refresh_booking_facts_manually)
 from hotel_website.models import db, User
 
 
-@pytest.fixture
-def app():
+def make_app(tmp_path, database=None):
+    """Returns an app for testing, backed by the sqlite file database if given, or
+    else an in-memory database.
+    """
     app = create_app(testing=True)
+    if database is not None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{database}"
+    app.config["PDF_CACHE_DIR"] = str(tmp_path / "pdf_cache")
+    app.config["PDF_RENDER_WORKERS"] = 0  # Only the render queue tests use worker processes
+    return app
+
+
+def fill_test_db() -> None:
+    create_db_manually()
+    fill_db_manually()
+    db.session.add(User.create_user(username="test", raw_password="password"))
+    db.session.commit()
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = make_app(tmp_path)
+    with app.app_context():
+        fill_test_db()
+
+    yield app
+
+
+@pytest.fixture
+def file_app(tmp_path):
+    """An app like the app fixture backed by an sqlite file, so that each thread, or
+    another app using the same file, gets its own connection.
+    """
+    app = make_app(tmp_path, tmp_path / "hotel_website.db")
+    with app.app_context():
+        fill_test_db()
+
+    yield app
+
+    with app.app_context():
+        db.engine.dispose()
+
+
+@pytest.fixture(scope="session")
+def load_database(tmp_path_factory):
+    """Path of a SQLite database holding the fill-db data and generated load data, with
+    the test user. Built once, load_app gives each test its own copy.
+    """
+    directory = tmp_path_factory.mktemp("load_data")
+    path = directory / "hotel_website.db"
+    app = make_app(directory, path)
 
     with app.app_context():
         create_db_manually()
         fill_db_manually()
+        generate_load_data_manually(locations=4, rooms_per_location=50, users=40, bookings=6000)
+        refresh_booking_facts_manually(full=True)
         db.session.add(User.create_user(username="test", raw_password="password"))
         db.session.commit()
+        db.engine.dispose()
+
+    return path
+
+
+@pytest.fixture
+def load_app(load_database, tmp_path):
+    """An app like the app fixture, using a copy of the larger load_database."""
+    path = tmp_path / "hotel_website.db"
+    shutil.copyfile(load_database, path)
+    app = make_app(tmp_path, path)
 
     yield app
 
+    with app.app_context():
+        db.engine.dispose()
+
 
 @pytest.fixture
 def client(app):
@@ -43,3 +112,30 @@ class AuthActions:
 @pytest.fixture
 def auth(client):
     return AuthActions(client)
+
+
+class QueryCounter:
+    """Records the SQL statements run against an app's database, and their parameters."""
+    def __init__(self, app):
+        self.statements = []
+        self.parameters = []
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    @contextmanager
+    def at_most(self, limit: int):
+        """Fails if more than limit statements are run in the block, listing them."""
+        first = len(self.statements)
+        yield
+        statements = self.statements[first:]
+        assert len(statements) <= limit, (
+            f"{len(statements)} statements run, expected at most {limit}:\n" + "\n".join(statements))
+
+
+@pytest.fixture
+def queries(app):
+    return QueryCounter(app)
@@ -1,6 +1,21 @@
 # George Whittington, Student ID: 20026036, 2022
 
+import csv
+import io
+import zipfile
+from calendar import monthrange
+from datetime import date, timedelta
+
 import pytest  # noqa: F401
+from sqlalchemy import event
+
+from hotel_website.commands import refresh_booking_facts_manually
+from hotel_website.admin import admin
+from hotel_website import pdfs
+from hotel_website.models import db, Currency, Location, Room, Booking
+from hotel_website.pdfs import booking_pdf_render_queue
+
+from .test_models import make_booking, start, end
 
 
 @pytest.mark.parametrize(("path"), (
@@ -28,3 +43,312 @@ def test_admin_get(client, auth, path):
 ))
 def test_admin_unauthorized(client, path):
     assert client.get(path).status_code == 302
+
+
+@pytest.mark.parametrize(("workers"), (0, 2))
+def test_export_pdfs(app, client, auth, workers):
+    app.config["PDF_RENDER_WORKERS"] = workers
+    start = date.today().replace(day=1) + timedelta(days=40)
+
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1).limit(3).all()
+        bookings = [make_booking(room, start, start + timedelta(days=2)) for room in rooms]
+        bookings.append(make_booking(Room.query.filter_by(location_id=2).first(), start, start))
+        db.session.add_all(bookings)
+        db.session.commit()
+        booking_ids = [booking.id for booking in bookings]
+        engine = db.engine
+
+    auth.login(username="admin", password="password")
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    response = client.post("/admin/analytics/export_pdfs", data={
+        "month": start.strftime("%Y-%m"),
+        "location": 1
+    })
+    response.get_data()  # The bookings are read as the zip is streamed
+
+    with app.app_context():
+        booking_pdf_render_queue.shutdown()
+
+    assert response.status_code == 200
+    assert response.mimetype == "application/zip"
+
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.namelist() == [f"booking_{booking_id}.pdf" for booking_id in booking_ids[:3]]
+    assert all(archive.read(name).startswith(b"%PDF") for name in archive.namelist())
+
+    # The room the bookings are filtered on is the one they are loaded with
+    exported = [statement for statement in statements if "FROM booking JOIN room " in statement]
+    assert len(exported) == 1
+    assert exported[0].count("JOIN room ") == 1
+
+
+def test_export_pdfs_render_failure(app, client, auth, monkeypatch, caplog):
+    start = date.today().replace(day=1) + timedelta(days=40)
+
+    with app.app_context():
+        Location.query.get(1).name = "Aberdeen Old Town"
+        bookings = [make_booking(room, start, start) for room in Room.query.filter_by(location_id=1).limit(3)]
+        db.session.add_all(bookings)
+        db.session.commit()
+        booking_ids = [booking.id for booking in bookings]
+
+    render_booking_pdf = pdfs.render_booking_pdf
+
+    def fail_second(booking):
+        if booking.id == booking_ids[1]:
+            raise RuntimeError("Layout failed")
+        return render_booking_pdf(booking)
+
+    monkeypatch.setattr(pdfs, "render_booking_pdf", fail_second)
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/export_pdfs", data={"month": start.strftime("%Y-%m"), "location": 1})
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == (
+        f'attachment; filename="bookings_aberdeen_old_town_{start.strftime("%Y-%m")}.zip"')
+
+    # The rest of the archive is still whole, with the failed booking listed
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    assert archive.namelist() == [f"booking_{booking_ids[0]}.pdf", f"booking_{booking_ids[2]}.pdf", "errors.txt"]
+    assert f"booking_{booking_ids[1]}.pdf" in archive.read("errors.txt").decode()
+    assert f"Rendering the PDF for booking {booking_ids[1]} failed" in caplog.text
+
+
+def test_monthly_bookings(app, client, auth, monkeypatch):
+    start = date.today().replace(day=1) + timedelta(days=40)
+    month = start.strftime("%Y-%m")
+
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1).limit(5).all()
+        bookings = [make_booking(room, start, start + timedelta(days=1)) for room in rooms]
+        db.session.add_all(bookings)
+        db.session.commit()
+        booking_ids = [booking.id for booking in bookings]
+        refresh_booking_facts_manually()
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/monthly_bookings", data={"month": month, "location": 1})
+    assert response.status_code == 302
+    assert response.location.endswith(f"/admin/analytics/monthly_bookings?location=1&month={month}")
+
+    monkeypatch.setattr("hotel_website.admin.ANALYTICS_PAGE_SIZE", 2)
+    url = f"/admin/analytics/monthly_bookings?location=1&month={month}"
+    first = client.get(url)
+    second = client.get(f"{url}&after={booking_ids[1]}")
+    last = client.get(f"{url}&after={booking_ids[3]}")
+    previous = client.get(f"{url}&before={booking_ids[4]}")
+
+    assert b"<strong>Total Bookings:</strong> 5" in first.data
+    assert b"<strong>Total Guests:</strong> 5" in first.data
+    assert b"<strong>Total Bookings:</strong> 5" in last.data
+
+    def listed(response):
+        return [
+            booking_id for booking_id in booking_ids
+            if f'<th scope="row">{booking_id}</th>'.encode() in response.data]
+
+    assert listed(first) == booking_ids[:2]
+    assert listed(second) == booking_ids[2:4]
+    assert listed(last) == booking_ids[4:]
+    assert listed(previous) == booking_ids[2:4]
+
+    assert f"after={booking_ids[1]}".encode() in first.data
+    assert b"before=" not in first.data
+    assert f"before={booking_ids[4]}".encode() in last.data
+    assert b"after=" not in last.data
+
+
+def test_compare_bookings(app, client, auth):
+    first_month = (date.today().replace(day=1) + timedelta(days=40)).replace(day=1)
+    month_end = first_month.replace(day=monthrange(first_month.year, first_month.month)[1])
+
+    with app.app_context():
+        london = Room.query.filter_by(location_id=1).order_by(Room.room_type_id).all()
+        bookings = [
+            make_booking(london[0], first_month, first_month),
+            make_booking(london[-1], first_month, first_month),
+            # Overlaps both months, so is counted in each of them
+            make_booking(london[1], month_end, month_end + timedelta(days=1)),
+            make_booking(Room.query.filter_by(location_id=2).first(), month_end, month_end)
+        ]
+        db.session.add_all(bookings)
+        db.session.commit()
+        refresh_booking_facts_manually()
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/compare_bookings", data={
+        "month": first_month.strftime("%Y-%m"),
+        "end_month": (month_end + timedelta(days=40)).strftime("%Y-%m"),
+        "locations": [1, 2]
+    })
+    assert response.status_code == 200
+
+    html = response.data.decode()
+    sections = html.split("<h2>Bookings in ")[1:]
+    assert len(sections) == 3
+    assert sections[0].startswith(first_month.strftime("%B %Y"))
+
+    def row(section, location_id):
+        cells = section.split(f'<th scope="row">{location_id}</th>')[1].split("</tr>")[0]
+        return [cell.split("</td>")[0] for cell in cells.split("<td>")[2:-1]]
+
+    assert row(sections[0], 1) == ["3", "2", "0", "1"]
+    assert row(sections[0], 2) == ["1", "1", "0", "0"]
+    assert row(sections[1], 1) == ["1", "1", "0", "0"]
+    assert row(sections[1], 2) == ["0", "0", "0", "0"]
+    assert row(sections[2], 1) == ["0", "0", "0", "0"]
+
+
+def test_compare_bookings_month_range(client, auth):
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/compare_bookings", data={
+        "month": "2022-05",
+        "end_month": "2022-04",
+        "locations": [1]
+    }, follow_redirects=True)
+
+    assert response.status_code == 200
+    assert b"Please select an end month" in response.data
+    assert b"<h2>Bookings in" not in response.data
+
+
+def test_export_bookings_csv(app, client, auth):
+    with app.app_context():
+        for i, room in enumerate(Room.query.limit(30)):
+            booking = make_booking(room)
+            booking.country = "FR" if i % 3 == 0 else "GB"
+            db.session.add(booking)
+        db.session.commit()
+        engine = db.engine
+
+    with app.test_request_context():
+        view = next(view for view in admin._views if getattr(view, "model", None) is Booking)
+        country_filter = next(
+            f"flt0_{view.get_filter_arg(index, flt)}" for index, flt in enumerate(view._filters)
+            if flt.column.key == "country" and str(flt.operation()) == "equals")
+
+    auth.login(username="admin", password="password")
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+    response = client.get("/admin/booking/export/csv/", query_string={country_filter: "FR"})
+    assert response.is_streamed
+
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+
+    assert rows[0][:3] == ["Currency", "Room", "User"]
+    assert len(rows) == 11
+    assert all(row[13] == "FR" for row in rows[1:])
+    # A count and the bookings with their rooms, however many are exported, the user is cached
+    assert len(statements) == 2
+
+
+def test_export_bookings_macro_formatter(app, monkeypatch):
+    def inner(view, context, model, name):
+        return ""
+
+    with app.test_request_context("/admin/booking/export/csv/"):
+        view = next(view for view in admin._views if getattr(view, "model", None) is Booking)
+        monkeypatch.setattr(view, "column_formatters_export", {"email": inner})
+
+        with pytest.raises(NotImplementedError, match="Column: email"):
+            view._export_data()
+
+
+def test_occupancy(app, client, auth):
+    with app.app_context():
+        room = Room.query.filter_by(location_id=1, room_type_id=1).first()
+        db.session.add(make_booking(room, start, end))
+        db.session.add(make_booking(room, end, end))
+        db.session.commit()
+        refresh_booking_facts_manually()
+        single_rooms = Room.query.filter_by(location_id=1, room_type_id=1).count()
+        all_rooms = Room.query.filter_by(location_id=1).count()
+        location = room.location
+        revenue = sum(
+            location.find_room_prices(room.room_type, booking_start, booking_end, location.currency, 1)[0]
+            for booking_start, booking_end in ((start, end), (end, end)))
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/occupancy", data={
+        "start": start.isoformat(),
+        "end": (start + timedelta(days=4)).isoformat(),
+        "locations": [1]
+    })
+    assert response.status_code == 200
+
+    html = response.data.decode()
+    assert html.count("<h2>") == 1
+
+    single = html.split('<th scope="row">Standard</th>')[1].split("</tr>")[0]
+    assert [cell.split("</td>")[0] for cell in single.split("<td>")[1:5]] == [
+        str(single_rooms), "4", str(single_rooms * 5), f"{4 / (single_rooms * 5) * 100:.1f}%"]
+
+    total = html.split('<th scope="row">All</th>')[1].split("</tr>")[0]
+    assert f"<td>{all_rooms * 5}</td>" in total
+    assert f"{revenue / (all_rooms * 5):.2f}</td>" in total
+
+    # The last night of the second booking holds two of the single rooms
+    night = html.split(f'<th scope="row">{end.isoformat()}</th>')[1].split("</tr>")[0]
+    assert f"<td>{2 / single_rooms * 100:.1f}%</td>" in night
+
+
+def test_occupancy_date_range(client, auth):
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/occupancy", data={
+        "start": "2022-05-02",
+        "end": "2022-05-01",
+        "locations": [1]
+    })
+
+    assert response.status_code == 200
+    assert b"Please select an end date" in response.data
+    assert b"<h2>" not in response.data
+
+
+def test_revenue(app, client, auth):
+    first_month = (date.today().replace(day=1) + timedelta(days=40)).replace(day=1)
+    second_month = (first_month + timedelta(days=32)).replace(day=1)
+
+    with app.app_context():
+        london = Room.query.filter_by(location_id=1).order_by(Room.room_type_id).all()
+        bookings = [
+            make_booking(london[0], first_month, first_month + timedelta(days=2)),
+            # Identical to the booking above, so must not be merged with it
+            make_booking(london[0], first_month, first_month + timedelta(days=2)),
+            make_booking(london[-1], first_month + timedelta(days=5), first_month + timedelta(days=5)),
+            make_booking(london[1], second_month, second_month + timedelta(days=40)),
+            # Starts before the report, so isn't counted
+            make_booking(london[2], first_month - timedelta(days=1), first_month + timedelta(days=1))
+        ]
+        db.session.add_all(bookings)
+        db.session.commit()
+
+        currency = Currency.query.filter_by(acronym="EUR").first()
+        currency_id = currency.id
+        expected = []
+        for booking in bookings[:4]:
+            price, discount_price = booking.room.location.find_room_prices(
+                booking.room.room_type, booking.booking_start, booking.booking_end,
+                currency, booking.guests, booking.date_created.date())
+            expected.append(price if discount_price is None else discount_price)
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/analytics/revenue", data={
+        "month": first_month.strftime("%Y-%m"),
+        "end_month": second_month.strftime("%Y-%m"),
+        "currency": currency_id
+    })
+    assert response.status_code == 200
+
+    html = response.data.decode()
+    cells = html.split('<th scope="row">1</th>')[1].split("</tr>")[0].split("<td")[2:]
+    amounts = [cell.split("€")[1].split("</td>")[0] for cell in cells]
+    assert amounts == [f"{sum(expected[:3]):.2f}", f"{expected[3]:.2f}", f"{sum(expected):.2f}"]
+    assert 'title="3 bookings"' in cells[0]
+
+    footer = html.split("<tfoot>")[1]
+    assert f"€{sum(expected):.2f}</td>" in footer
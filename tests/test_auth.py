@@ -1,8 +1,13 @@
 # George Whittington, Student ID: 20026036, 2022
 
+from datetime import timedelta
+
 import pytest  # noqa: F401
+from sqlalchemy import event
+
+from hotel_website.models import db, User, Currency, Room
 
-from hotel_website.models import User
+from .test_models import make_booking, start, end
 
 
 def test_login_get(client):
@@ -73,3 +78,61 @@ def test_register_validation(app, client, username, password, message):
 def test_my_account_get(client, auth):
     auth.login()
     assert client.get("/my-account").status_code == 200
+
+
+def test_my_account_bookings(app, client, auth, monkeypatch):
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1).order_by(Room.room_type_id).all()
+        bookings = [
+            make_booking(rooms[0], start + timedelta(days=3), end + timedelta(days=3)),
+            make_booking(rooms[1], start, end),
+            make_booking(rooms[2], start, end),
+            make_booking(rooms[-1], start + timedelta(days=1), end + timedelta(days=1)),
+            make_booking(Room.query.filter_by(location_id=2).first(), start + timedelta(days=2), end),
+            # Already over, so isn't listed
+            make_booking(rooms[3], start - timedelta(days=20), start - timedelta(days=15))
+        ]
+        bookings[4].currency = Currency.query.filter_by(acronym="EUR").first()
+        db.session.add_all(bookings)
+        db.session.commit()
+
+        # In order of check in, then booking id
+        booking_ids = [bookings[i].id for i in (1, 2, 3, 4, 0)]
+        prices = [bookings[i].find_room_prices() for i in (1, 2, 3, 4, 0)]
+
+    auth.login()
+    monkeypatch.setattr("hotel_website.auth.ACCOUNT_PAGE_SIZE", 2)
+
+    def listed(response):
+        return [
+            booking_id for booking_id in booking_ids
+            if f"/booking_{booking_id}.pdf".encode() in response.data]
+
+    first = client.get("/my-account")
+    assert listed(first) == booking_ids[:2]
+    assert b"before=" not in first.data
+    next_url = first.data.decode().split('href="/my-account?after=')[1].split('"')[0]
+
+    second = client.get(f"/my-account?after={next_url}")
+    assert listed(second) == booking_ids[2:4]
+    assert f"€{prices[3][0]:.2f}".encode() in second.data
+    assert f"£{prices[2][0]:.2f}".encode() in second.data
+
+    last_url = second.data.decode().split('href="/my-account?after=')[1].split('"')[0]
+    last = client.get(f"/my-account?after={last_url}")
+    assert listed(last) == booking_ids[4:]
+    assert b"after=" not in last.data
+
+    previous_url = last.data.decode().split('href="/my-account?before=')[1].split('"')[0]
+    assert listed(client.get(f"/my-account?before={previous_url}")) == booking_ids[2:4]
+
+    # Rooms, locations and room types are loaded with the bookings, not one at a time
+    statements = []
+    event.listen(db.get_engine(app), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    client.get("/my-account")
+    page_statements = len(statements)
+
+    monkeypatch.setattr("hotel_website.auth.ACCOUNT_PAGE_SIZE", 5)
+    statements.clear()
+    assert len(listed(client.get("/my-account"))) == 5
+    assert len(statements) == page_statements
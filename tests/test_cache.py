@@ -0,0 +1,210 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from datetime import date, timedelta
+
+import pytest  # noqa: F401
+from sqlalchemy import event
+
+from hotel_website.cache import reference_cache, search_cache, user_cache
+from hotel_website.models import db, User, Currency, Location, Roomtype, Room
+
+from .conftest import AuthActions, make_app
+from .test_models import make_booking
+
+today = date.today()
+start = today + timedelta(days=10)
+end = today + timedelta(days=12)
+search_args = {"location": 1, "booking_start": start.isoformat(), "booking_end": end.isoformat(), "guests": 1}
+
+
+def test_reference_cache_no_queries(app):
+    with app.app_context():
+        reference_cache.all(Location)
+        reference_cache.all(Roomtype)
+
+    statements = []
+    event.listen(db.get_engine(app), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    with app.app_context():
+        locations = reference_cache.all(Location)
+        assert [loc.name for loc in locations][:2] == ["Aberdeen", "Belfast"]
+        assert locations[0].currency.acronym == "GBP"
+        assert reference_cache.get(Roomtype, 3).room_type == "F"
+        assert reference_cache.first(Currency, acronym="EUR").full_name == "Euro"
+        assert reference_cache.first(Currency, acronym="JPY") is None
+
+    assert statements == []
+    with app.app_context():
+        assert reference_cache.stats()["misses"] == 3
+
+
+def test_reference_cache_invalidate(app):
+    with app.app_context():
+        assert len(reference_cache.all(Currency)) == 3
+
+        db.session.add(Currency(full_name="Japanese Yen", acronym="JPY", conversion_rate=150.0))
+        db.session.commit()
+        assert len(reference_cache.all(Currency)) == 3
+
+        reference_cache.invalidate(Currency)
+        assert len(reference_cache.all(Currency)) == 4
+
+
+def test_reference_cache_admin_invalidate(client, auth):
+    assert b"JPY" not in client.get("/").data
+
+    auth.login(username="admin", password="password")
+    response = client.post("/admin/currency/new/", data={
+        "full_name": "Japanese Yen",
+        "acronym": "JPY",
+        "conversion_rate": "150.00"
+    })
+    assert response.status_code == 302
+
+    assert b"JPY" in client.get("/").data
+
+
+def test_search_cache_hit(app, client):
+    assert b"24 Rooms left" in client.get("/search", query_string=search_args).data
+    assert b"24 Rooms left" in client.get("/search", query_string=search_args).data
+
+    with app.app_context():
+        assert search_cache.stats() == {"hits": 1, "misses": 1, "size": 1}
+
+
+@pytest.mark.parametrize(("booking_start", "booking_end", "location", "invalidated"), (
+    (start, end, 1, True),
+    (end, end + timedelta(days=3), 1, True),
+    (start - timedelta(days=3), start, 1, True),
+    (end + timedelta(days=1), end + timedelta(days=3), 1, False),
+    (start, end, 2, False)
+))
+def test_search_cache_invalidate(app, client, booking_start, booking_end, location, invalidated):
+    client.get("/search", query_string=search_args)
+
+    with app.app_context():
+        room = Room.query.filter_by(location_id=location, room_type_id=1).first()
+        db.session.add(make_booking(room, booking_start, booking_end))
+        db.session.commit()
+        assert search_cache.stats()["size"] == (0 if invalidated else 1)
+
+    expected = b"23 Rooms left" if invalidated else b"24 Rooms left"
+    assert expected in client.get("/search", query_string=search_args).data
+
+
+def test_search_cache_rollback(app, client):
+    client.get("/search", query_string=search_args)
+
+    with app.app_context():
+        db.session.add(make_booking(Room.query.filter_by(location_id=1).first()))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        assert search_cache.stats()["size"] == 1
+
+
+def test_search_cache_lru(app, client):
+    app.config["SEARCH_CACHE_SIZE"] = 2
+
+    for location in (1, 2, 1, 3):
+        client.get("/search", query_string={**search_args, "location": location})
+
+    with app.app_context():
+        assert search_cache.stats() == {"hits": 1, "misses": 3, "size": 2}
+        assert search_cache.get(search_cache.key(2, start, end, 1, 1), search_cache.version(2, start, end)) is None
+        assert search_cache.get(search_cache.key(1, start, end, 1, 1), search_cache.version(1, start, end)) is not None
+
+
+@pytest.mark.parametrize(("booking_start", "booking_end", "location", "invalidated"), (
+    (start, end, 1, True),
+    (end, end + timedelta(days=3), 1, True),
+    (end + timedelta(days=1), end + timedelta(days=3), 1, False),
+    (start, end, 2, False)
+))
+def test_search_cache_other_process(file_app, tmp_path, booking_start, booking_end, location, invalidated):
+    client = file_app.test_client()
+    client.get("/search", query_string=search_args)
+
+    # Another worker process, with its own cache, books a room
+    other = make_app(tmp_path, tmp_path / "hotel_website.db")
+    with other.app_context():
+        room = Room.query.filter_by(location_id=location, room_type_id=1).first()
+        db.session.add(make_booking(room, booking_start, booking_end))
+        db.session.commit()
+        db.engine.dispose()
+
+    with file_app.app_context():
+        assert search_cache.stats()["size"] == 1
+
+    expected = b"23 Rooms left" if invalidated else b"24 Rooms left"
+    assert expected in client.get("/search", query_string=search_args).data
+    with file_app.app_context():
+        assert search_cache.stats()["hits"] == (0 if invalidated else 1)
+
+
+def test_search_cache_booking_while_searching(app):
+    with app.app_context():
+        key = search_cache.key(1, start, end, 1, 1)
+        version = search_cache.version(1, start, end)
+
+        # A booking committed after the version was read but before the results were stored
+        db.session.add(make_booking(Room.query.filter_by(location_id=1).first()))
+        db.session.commit()
+        search_cache.set(key, [], version)
+
+        assert search_cache.get(key, search_cache.version(1, start, end)) is None
+
+
+def test_user_cache_no_queries(app, client, auth):
+    auth.login()
+    client.get("/my-account")
+
+    statements = []
+    event.listen(db.get_engine(app), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    assert b'value="test"' in client.get("/my-account").data
+
+    assert not any('FROM user' in statement for statement in statements)
+    with app.app_context():
+        assert user_cache.stats() == {"hits": 2, "misses": 1, "size": 1}
+
+
+def test_user_cache_my_account(app, client, auth):
+    auth.login()
+    client.get("/my-account")
+    client.post("/my-account", data={"username": "renamed", "password": ""})
+
+    assert b'value="renamed"' in client.get("/my-account").data
+    with app.app_context():
+        assert User.query.filter_by(username="renamed").first() is not None
+
+
+def test_user_cache_admin_revoked(app, client, auth):
+    with app.app_context():
+        user = User.query.filter_by(username="test").first()
+        user_id, password_hash = user.id, user.password
+
+    user_client = app.test_client()
+    AuthActions(user_client).login()
+    assert user_client.get("/admin/user/").status_code == 302
+
+    auth.login(username="admin", password="password")
+    edit_url = f"/admin/user/edit/?id={user_id}"
+    form = {"username": "test", "password": password_hash}
+    assert client.post(edit_url, data={**form, "admin": "y"}).status_code == 302
+    assert user_client.get("/admin/user/").status_code == 200
+
+    # Unticking admin takes the rights away on the user's next request
+    assert client.post(edit_url, data=form).status_code == 302
+    assert user_client.get("/admin/user/").status_code == 302
+
+
+def test_user_cache_lru(app, client, auth):
+    app.config["USER_CACHE_SIZE"] = 1
+    auth.login()
+    client.get("/my-account")
+
+    with app.app_context():
+        admin_id = User.query.filter_by(username="admin").first().id
+        assert user_cache.get(admin_id).username == "admin"
+        assert user_cache.stats()["size"] == 1
+        assert user_cache.get(admin_id + 1000) is None
@@ -0,0 +1,189 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from collections import Counter
+from datetime import date, timedelta
+
+import pytest  # noqa: F401
+from sqlalchemy import inspect
+
+from hotel_website import create_app
+from hotel_website.commands import (
+    create_db_manually, create_indexes_manually, fill_db_manually, generate_load_data_manually,
+    rebuild_inventory_manually, reconcile_popularity_manually)
+from hotel_website.models import db, User, Location, Room, Booking, RoomInventory, LocationPopularity
+
+from .test_models import make_booking
+
+
+def test_rebuild_inventory(app):
+    with app.app_context():
+        room = Room.query.first()
+        db.session.add(make_booking(room))
+        db.session.commit()
+
+        expected = {(row.night, row.rooms_sold) for row in RoomInventory.query.all()}
+
+        db.session.execute(RoomInventory.__table__.update().values(rooms_sold=7))
+        db.session.commit()
+
+        assert rebuild_inventory_manually() == 3
+        assert {(row.night, row.rooms_sold) for row in RoomInventory.query.all()} == expected
+
+
+def test_rebuild_inventory_cli(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["rebuild-inventory"])
+    assert "Room inventory rebuilt, 0 nights recorded." in result.output
+
+
+def test_reconcile_popularity(app):
+    with app.app_context():
+        for room in Room.query.filter_by(location_id=2).limit(3):
+            db.session.add(make_booking(room))
+        db.session.commit()
+
+        db.session.execute(LocationPopularity.__table__.update().values(total_bookings=9))
+        db.session.commit()
+
+        assert reconcile_popularity_manually() == 15
+        totals = dict(LocationPopularity.query.with_entities(
+            LocationPopularity.location_id, LocationPopularity.total_bookings).all())
+        assert totals[2] == 3
+        assert sum(totals.values()) == 3
+
+
+def test_refresh_booking_facts_cli(app):
+    with app.app_context():
+        db.session.add(make_booking(Room.query.first()))
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["refresh-booking-facts"])
+    assert "Booking facts refreshed, 1 bookings counted and 0 deleted bookings removed." in result.output
+
+    result = runner.invoke(args=["refresh-booking-facts", "--full"])
+    assert "Booking facts refreshed, 1 bookings counted and 0 deleted bookings removed." in result.output
+
+
+def generated_bookings() -> list:
+    return Booking.query.with_entities(
+        Booking.room_id, User.username, Booking.booking_start, Booking.booking_end,
+        Booking.guests, Booking.date_created, Booking.currency_id
+    ).join(Booking.user).order_by(Booking.id).all()
+
+
+def test_generate_load_data(app):
+    options = {
+        "locations": 2, "rooms_per_location": 10, "users": 5, "bookings": 400,
+        "days": 120, "start": date(2022, 3, 1), "seed": 3, "batch_size": 150}
+
+    with app.app_context():
+        rooms = Room.query.count()
+        assert generate_load_data_manually(**options) == {"locations": 2, "rooms": 20, "users": 5, "bookings": 400}
+        assert Room.query.count() == rooms + 20
+        assert Location.query.filter(Location.name.like("Load Test Hotel %")).count() == 2
+        assert User.query.filter(User.username.like("load_%")).count() == 5
+
+        bookings = generated_bookings()
+        assert len(bookings) == 400
+
+        # No room is booked twice on the same night, and the inventory was rebuilt to match
+        nights = Counter(
+            (booking.room_id, booking.booking_start + timedelta(days=i))
+            for booking in bookings for i in range((booking.booking_end - booking.booking_start).days + 1))
+        assert max(nights.values()) == 1
+        assert sum(row.rooms_sold for row in RoomInventory.query.all()) == len(nights)
+        assert sum(row.total_bookings for row in LocationPopularity.query.all()) == 400
+
+        assert min(booking.booking_start for booking in bookings) >= date(2022, 3, 1)
+        assert max(booking.booking_end for booking in bookings) < date(2022, 3, 1) + timedelta(days=120)
+        assert all(booking.date_created.date() <= booking.booking_start for booking in bookings)
+
+    # The same seed gives the same data
+    other = create_app(testing=True)
+    with other.app_context():
+        create_db_manually()
+        fill_db_manually()
+        generate_load_data_manually(**options)
+        assert generated_bookings() == bookings
+
+        # While more data gets new names
+        generate_load_data_manually(**{**options, "bookings": 0})
+        assert Location.query.filter(Location.name.like("Load Test Hotel %")).count() == 4
+
+
+def test_generate_load_data_again(app):
+    options = {"locations": 1, "rooms_per_location": 10, "days": 60, "start": date(2022, 3, 1), "batch_size": 150}
+
+    with app.app_context():
+        # At least one booking in every room
+        first_run = Room.query.count() + 10
+        generate_load_data_manually(**options, users=3, bookings=first_run)
+
+        # Every room has bookings in those nights, so only the new location's rooms are booked
+        with pytest.raises(ValueError, match="no rooms without bookings"):
+            generate_load_data_manually(**{**options, "locations": 0}, users=0, bookings=10)
+
+        assert generate_load_data_manually(**options, users=0, bookings=20)["bookings"] == 20
+        rooms = {room.id for room in Room.query.join(Room.location).where(Location.name == "Load Test Hotel 2")}
+
+        bookings = Booking.query.order_by(Booking.id).all()
+        new_bookings = bookings[first_run:]
+        assert {booking.room_id for booking in new_bookings} <= rooms
+        # Which go to the users made by the first run
+        assert {booking.user.username for booking in new_bookings} <= {"load_1", "load_2", "load_3"}
+
+        nights = Counter(
+            (booking.room_id, booking.booking_start + timedelta(days=i))
+            for booking in bookings for i in range((booking.booking_end - booking.booking_start).days + 1))
+        assert max(nights.values()) == 1
+
+        # While another period is free in every room
+        assert generate_load_data_manually(
+            **{**options, "locations": 0, "start": date(2023, 3, 1)}, users=0, bookings=50)["bookings"] == 50
+
+
+def test_generate_load_data_without_users(app):
+    with app.app_context():
+        with pytest.raises(ValueError, match="no load test users"):
+            generate_load_data_manually(locations=0, rooms_per_location=0, users=0, bookings=10)
+
+
+def test_generate_load_data_cli(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=[
+        "generate-load-data", "--locations", "1", "--rooms-per-location", "10", "--users", "3",
+        "--bookings", "50", "--start", "2022-01-01"])
+    assert "Added 1 locations, 10 rooms, 3 users and 50 bookings." in result.output
+
+    result = runner.invoke(args=["generate-load-data", "--locations", "0", "--bookings", "10000000", "--days", "10"])
+    assert result.exit_code == 1
+    assert "Too many bookings" in result.output
+
+
+def test_create_indexes(app):
+    with app.app_context():
+        inspector = inspect(db.engine)
+        expected = {index["name"] for index in inspector.get_indexes("booking")}
+        assert "ix_booking_room_id_booking_start_booking_end" in expected
+
+        db.session.execute("DROP INDEX ix_booking_room_id_booking_start_booking_end")
+        db.session.execute("DROP INDEX ix_booking_user_id_booking_end")
+        db.session.commit()
+
+        assert create_indexes_manually() == ["ix_booking_room_id_booking_start_booking_end", "ix_booking_user_id_booking_end"]
+        assert {index["name"] for index in inspect(db.engine).get_indexes("booking")} == expected
+        assert create_indexes_manually() == []
+
+
+def test_create_indexes_cli(app):
+    with app.app_context():
+        db.session.execute("DROP INDEX ix_room_location_id_room_type_id")
+        db.session.commit()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=["create-indexes"])
+    assert "Created 1 indexes: ix_room_location_id_room_type_id." in result.output
+
+    result = runner.invoke(args=["create-indexes"])
+    assert "All indexes already exist." in result.output
@@ -5,6 +5,9 @@ from datetime import date, timedelta
 import pytest  # noqa: F401
 
 from hotel_website.constants import LOCATION_ERR, DURATION_ERR, GUESTS_ERR
+from hotel_website.models import db, Booking, Location, Room
+
+from .test_models import make_booking
 
 today = date.today()
 tomorrow = today + timedelta(days=1)
@@ -165,3 +168,76 @@ def test_room_get(client, auth):
         "guests": 1,
         "room_type": 1
     }).status_code == 200
+
+
+def test_room_get_split_stays(client, auth, app):
+    stay_start = tomorrow
+    stay_end = tomorrow + timedelta(days=3)
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1, room_type_id=1).all()
+        for room in rooms[:-2]:
+            db.session.add(make_booking(room, stay_start, stay_end))
+        db.session.add(make_booking(rooms[-2], stay_start, stay_start + timedelta(days=1)))
+        db.session.add(make_booking(rooms[-1], stay_start + timedelta(days=2), stay_end))
+        db.session.commit()
+
+    query_string = {
+        "location": 1,
+        "booking_start": stay_start.isoformat(),
+        "booking_end": stay_end.isoformat(),
+        "guests": 1
+    }
+    response = client.get("/search", query_string=query_string)
+    assert response.status_code == 200
+    assert b"room_type=1&" not in response.data
+    assert b"room_type=2&" in response.data
+
+    auth.login()
+    response = client.get("/room", query_string={**query_string, "room_type": 1}, follow_redirects=True)
+    assert b"No Standard rooms at " in response.data
+
+
+def test_room_post(client, auth, app):
+    auth.login()
+    query_string = {
+        "location": 1,
+        "booking_start": tomorrow.isoformat(),
+        "booking_end": (tomorrow + timedelta(days=2)).isoformat(),
+        "guests": 1,
+        "room_type": 1
+    }
+    response = client.post("/room", query_string=query_string, data={
+        "full_name": "Test User",
+        "email": "test@example.com",
+        "address-address_1": "1 Test Street",
+        "address-postcode": "AB1 2CD",
+        "address-country": "GB",
+        "card_details-card_type": "V",
+        "card_details-card_number": "4111 1111 1111 1111",
+        "card_details-security_code": "123",
+        "card_details-expiry_date-expiry_month": 1,
+        "card_details-expiry_date-expiry_year": today.year + 1
+    })
+    assert response.status_code == 302
+    assert "/room_confirm/" in response.headers["Location"]
+
+    with app.app_context():
+        booking = Booking.query.first()
+        assert booking.room.location_id == 1
+        assert booking.room.room_type_id == 1
+        assert Location.query.get(1).rooms_available(
+            booking.booking_start, booking.booking_end, room_types=(booking.room.room_type,)) == 23
+
+
+def test_home_popular_locations(client, app):
+    with app.app_context():
+        for location_id, bookings in ((3, 2), (12, 1), (8, 1)):
+            for room in Room.query.filter_by(location_id=location_id).limit(bookings):
+                db.session.add(make_booking(room))
+        db.session.commit()
+
+    response = client.get("/")
+    names = [b"Birmingham", b"London", b"Nottingham", b"Aberdeen", b"Belfast"]
+    positions = [response.data.index(b"<h5>" + name + b"</h5>") for name in names]
+    assert positions == sorted(positions)
+    assert b"<h5>Bristol</h5>" not in response.data
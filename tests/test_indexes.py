@@ -0,0 +1,130 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import re
+from datetime import date, timedelta
+
+import pytest
+
+from hotel_website.commands import create_indexes_manually
+from hotel_website.models import db
+
+from .test_query_counts import booking_form, where_to
+
+today = date.today()
+month = today.strftime("%Y-%m")
+
+room_dates_index = "ix_booking_room_id_booking_start_booking_end"
+user_index = "ix_booking_user_id_booking_end"
+room_index = "ix_room_location_id_room_type_id"
+
+# A line of a query plan, which older SQLite versions print as "SCAN TABLE booking"
+# rather than "SCAN booking", and may name an alias after the table
+PLAN_LINE = re.compile(r"^(SCAN|SEARCH) (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?")
+
+
+@pytest.fixture
+def app(load_app):
+    return load_app
+
+
+def booking_plans(app, queries, first: int = 0) -> list:
+    """Returns the SQLite query plan of each SELECT reading the booking table run since
+    the first'th statement, as the plan's lines joined together.
+    """
+    plans = []
+    with app.app_context():
+        connection = db.session.connection()
+        for statement, parameters in zip(queries.statements[first:], queries.parameters[first:]):
+            if statement.lstrip().startswith("SELECT") and re.search(r"\bFROM booking\b", statement):
+                rows = connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+                plans.append("\n".join(row[3] for row in rows))
+
+    return plans
+
+
+def scanned(plan: str) -> set:
+    """Returns the tables a plan reads every row of, through an index or not."""
+    return {match[2] for match in map(PLAN_LINE.match, plan.splitlines()) if match and match[1] == "SCAN"}
+
+
+def searched_indexes(plan: str) -> dict:
+    """Returns the named index a plan searches each table with, leaving out tables
+    searched by primary key.
+    """
+    return {
+        match[2]: match[3] for match in map(PLAN_LINE.match, plan.splitlines())
+        if match and match[1] == "SEARCH" and match[3]}
+
+
+def assert_no_scans(plans: list) -> None:
+    for plan in plans:
+        assert not scanned(plan) & {"booking", "room"}, plan
+
+
+def test_allocate_room_plans(client, auth, queries, app):
+    auth.login(username="load_1")
+    first = len(queries.statements)
+    response = client.post("/room", query_string={**where_to, "room_type": 1}, data=booking_form)
+    assert response.status_code == 302
+
+    plans = booking_plans(app, queries, first)
+    assert_no_scans(plans)
+
+    # The search for a free room, and the check for a clash once the booking is inserted
+    indexes = [searched_indexes(plan) for plan in plans]
+    assert {"room": room_index, "booking": room_dates_index} in indexes
+    assert {"booking": room_dates_index} in indexes
+
+
+def test_search_plans(client, queries, app):
+    first = len(queries.statements)
+    assert client.get("/search", query_string=where_to).status_code == 200
+
+    # The count of rooms with no booking overlapping the stay
+    plans = booking_plans(app, queries, first)
+    assert_no_scans(plans)
+    assert [searched_indexes(plan) for plan in plans] == [{"room": room_index, "booking": room_dates_index}]
+
+
+def test_my_account_plans(client, auth, queries, app):
+    auth.login(username="load_1")
+    first = len(queries.statements)
+    assert client.get("/my-account").status_code == 200
+
+    plans = booking_plans(app, queries, first)
+    assert_no_scans(plans)
+    assert [searched_indexes(plan) for plan in plans] == [{"booking": user_index}]
+
+
+def test_analytics_plans(client, auth, queries, app):
+    auth.login(username="admin")
+    first = len(queries.statements)
+    response = client.get("/admin/analytics/monthly_bookings", query_string={"location": 1, "month": month})
+    assert response.status_code == 200
+    response = client.post("/admin/analytics/export_pdfs", data={"month": month, "location": 1})
+    response.get_data()  # The bookings are read as the zip is streamed
+    assert response.status_code == 200
+
+    plans = booking_plans(app, queries, first)
+    assert_no_scans(plans)
+    # The monthly bookings page, then the bookings exported
+    assert [searched_indexes(plan) for plan in plans] == [{"room": room_index, "booking": room_dates_index}] * 2
+
+
+def test_plans_before_create_indexes(client, auth, queries, app):
+    with app.app_context():
+        for name in [room_dates_index, user_index, room_index]:
+            db.session.execute(f"DROP INDEX {name}")
+        db.session.commit()
+
+    auth.login(username="load_1")
+    first = len(queries.statements)
+    client.get("/my-account")
+    assert "booking" in scanned(booking_plans(app, queries, first)[0])
+
+    with app.app_context():
+        assert sorted(create_indexes_manually()) == sorted([room_dates_index, user_index, room_index])
+
+    first = len(queries.statements)
+    client.get("/my-account", query_string={"after": f"{(today + timedelta(days=1)).isoformat()}_1"})
+    assert_no_scans(booking_plans(app, queries, first))
@@ -0,0 +1,54 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import json
+import logging
+from datetime import date, timedelta
+
+import pytest  # noqa: F401
+from sqlalchemy import event
+
+from hotel_website.models import db
+
+search_args = {
+    "location": 1,
+    "booking_start": (date.today() + timedelta(days=10)).isoformat(),
+    "booking_end": (date.today() + timedelta(days=12)).isoformat(),
+    "guests": 1
+}
+
+
+def test_instrumentation_headers(app, client):
+    app.debug = True
+
+    statements = []
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    response = client.get("/search", query_string=search_args)
+    assert response.status_code == 200
+
+    assert int(response.headers["X-Query-Count"]) == len(statements) > 0
+    timing = dict(
+        metric.split(";")[:2] for metric in response.headers["Server-Timing"].split(", "))
+    assert set(timing) == {"db", "render", "total"}
+    assert float(timing["render"].split("=")[1]) > 0
+
+    slowest = response.headers["X-Slowest-Queries"].split(" | ")
+    assert 0 < len(slowest) <= app.config["REQUEST_SLOWEST_QUERIES"]
+    assert all("SELECT" in query for query in slowest)
+
+
+def test_instrumentation_log(app, client, caplog):
+    with caplog.at_level(logging.INFO, logger="hotel_website.requests"):
+        response = client.get("/search", query_string=search_args)
+
+    assert "X-Query-Count" not in response.headers
+    lines = [json.loads(record.getMessage()) for record in caplog.records if record.name == "hotel_website.requests"]
+    assert len(lines) == 1
+
+    line = lines[0]
+    assert (line["method"], line["path"], line["endpoint"], line["status"]) == ("GET", "/search", "hotels.search", 200)
+    assert line["queries"] > 0
+    assert line["duration_ms"] >= line["db_ms"] > 0
+    assert line["slowest"] == sorted(line["slowest"], key=lambda query: query["ms"], reverse=True)
+    assert all("\n" not in query["statement"] for query in line["slowest"])
@@ -0,0 +1,178 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import multiprocessing
+import re
+from datetime import date, timedelta
+
+import pytest  # noqa: F401
+from flask import Flask
+
+from hotel_website import create_app
+from hotel_website.metrics import METRICS_FILE_BYTES, metrics, read_metrics_file, _MmapValues
+from hotel_website.models import db, Room
+
+from .test_models import make_booking, start, end
+
+
+TOKEN = "a metrics token for testing"
+
+
+def scrape(client):
+    return client.get("/metrics", headers={"Authorization": f"Bearer {TOKEN}"})
+
+
+def samples(response) -> dict:
+    """Parses an exposition into a dict of sample lines to values, skipping comments."""
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain; version=0.0.4")
+
+    values = {}
+    for line in response.get_data(as_text=True).splitlines():
+        if not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            values[sample] = float(value)
+    return values
+
+
+def test_request_metrics(app, client):
+    app.config["METRICS_TOKEN"] = TOKEN
+    search_args = {
+        "location": 1,
+        "booking_start": (date.today() + timedelta(days=10)).isoformat(),
+        "booking_end": (date.today() + timedelta(days=12)).isoformat(),
+        "guests": 1
+    }
+    for _ in range(2):
+        assert client.get("/search", query_string=search_args).status_code == 200
+    assert client.get("/login").status_code == 200
+
+    values = samples(scrape(client))
+    labels = 'endpoint="hotels.search",method="GET"'
+    assert values[f'hotel_website_requests_total{{{labels},status="200"}}'] == 2
+    assert values[f"hotel_website_request_duration_seconds_count{{{labels}}}"] == 2
+    assert values[f'hotel_website_request_duration_seconds_bucket{{{labels},le="+Inf"}}'] == 2
+    assert values[f"hotel_website_request_duration_seconds_sum{{{labels}}}"] > 0
+    assert values[f"hotel_website_request_db_seconds_count{{{labels}}}"] == 2
+    assert values['hotel_website_requests_total{endpoint="auth.login",method="GET",status="200"}'] == 1
+
+    # Buckets are cumulative
+    buckets = [
+        value for sample, value in values.items()
+        if sample.startswith(f"hotel_website_request_duration_seconds_bucket{{{labels}")]
+    assert buckets == sorted(buckets) and len(buckets) == 12
+
+    # The second search is answered from the search cache
+    assert values['hotel_website_cache_lookups_total{cache="search",result="hit"}'] == 1
+    assert values['hotel_website_cache_lookups_total{cache="search",result="miss"}'] == 1
+    assert values['hotel_website_cache_hit_ratio{cache="search"}'] == 0.5
+    assert 0 < values['hotel_website_cache_hit_ratio{cache="reference"}'] <= 1
+
+
+def test_password_and_pdf_metrics(app, client, auth):
+    with app.app_context():
+        booking = make_booking(Room.query.get(1), start, end)
+        db.session.commit()
+        booking_id = booking.id
+
+    auth.login(username="admin")
+    assert client.get(f"/booking_{booking_id}.pdf").status_code == 200
+    assert client.get(f"/booking_{booking_id}.pdf").status_code == 200  # Served from the PDF cache
+
+    values = samples(client.get("/metrics"))
+    assert values['hotel_website_password_hash_seconds_count{operation="check"}'] == 1
+    assert values['hotel_website_pdf_render_seconds_count{mode="request"}'] == 1
+    assert values['hotel_website_requests_total{endpoint="hotels.booking_pdf",method="GET",status="200"}'] == 2
+
+
+def test_metrics_disabled(app, client):
+    app.config["METRICS_ENABLED"] = False
+    with app.app_context():
+        before = metrics.collect()
+
+    client.get("/")
+    with app.app_context():
+        assert metrics.collect() == before
+
+    disabled = Flask(__name__)
+    disabled.config["METRICS_ENABLED"] = False
+    metrics.init_app(disabled)
+    assert disabled.test_client().get("/metrics").status_code == 404
+
+
+def test_metrics_access(app, client, auth):
+    assert client.get("/metrics").status_code == 401
+    assert scrape(client).status_code == 401  # No token is accepted until one is set
+
+    app.config["METRICS_TOKEN"] = TOKEN
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert scrape(client).status_code == 200
+
+    auth.login()
+    assert client.get("/metrics").status_code == 401
+    auth.logout()
+    auth.login(username="admin")
+    assert client.get("/metrics").status_code == 200
+
+
+def record_in_child(directory: str) -> None:
+    app = create_app(testing=True)
+    app.config["METRICS_MULTIPROCESS_DIR"] = directory
+    with app.app_context():
+        metrics.inc("hotel_website_password_hash_rejected_total", 2)
+        metrics.observe("hotel_website_pdf_render_seconds", 0.2, mode="pool")
+
+
+def test_multiprocess(tmp_path):
+    directory = str(tmp_path / "metrics")
+    app = create_app(testing=True)
+    app.config["METRICS_MULTIPROCESS_DIR"] = directory
+    app.config["METRICS_TOKEN"] = TOKEN
+
+    with app.app_context():
+        metrics.inc("hotel_website_password_hash_rejected_total")
+        metrics.observe("hotel_website_pdf_render_seconds", 0.02, mode="pool")
+
+    child = multiprocessing.get_context("fork").Process(target=record_in_child, args=(directory,))
+    child.start()
+    child.join()
+    assert child.exitcode == 0
+    assert len(list((tmp_path / "metrics").iterdir())) == 2
+
+    # Any process can serve the values added up over all of them, including ones that have exited
+    values = samples(scrape(app.test_client()))
+    assert values["hotel_website_password_hash_rejected_total"] == 3
+    assert values['hotel_website_pdf_render_seconds_count{mode="pool"}'] == 2
+    assert values['hotel_website_pdf_render_seconds_sum{mode="pool"}'] == pytest.approx(0.22)
+    assert values['hotel_website_pdf_render_seconds_bucket{mode="pool",le="0.025"}'] == 1
+    assert values['hotel_website_pdf_render_seconds_bucket{mode="pool",le="0.25"}'] == 2
+
+
+def test_metrics_file_grows(tmp_path):
+    path = str(tmp_path / "metrics_1.db")
+    values = _MmapValues(path)
+    keys = [("hotel_website_requests_total", (("endpoint", f"endpoint_{i}"),)) for i in range(2000)]
+    for i, key in enumerate(keys):
+        values.inc(key, i)
+        values.inc(key, 0.5)
+
+    assert (tmp_path / "metrics_1.db").stat().st_size > METRICS_FILE_BYTES
+    assert dict(read_metrics_file(path)) == {key: i + 0.5 for i, key in enumerate(keys)}
+
+    # A process reusing the pid carries on from the file's values
+    values.close()
+    reopened = _MmapValues(path)
+    reopened.inc(keys[0], 1)
+    assert dict(reopened.items())[keys[0]] == 1.5
+    assert len(list(read_metrics_file(path))) == len(keys)
+    reopened.close()
+
+
+def test_label_escaping(app):
+    app.config["METRICS_TOKEN"] = TOKEN
+    with app.app_context():
+        metrics.inc("hotel_website_cache_lookups_total", cache='a "quoted"\\name\n', result="hit")
+        response = scrape(app.test_client())
+
+    assert re.search(
+        r'^hotel_website_cache_lookups_total\{cache="a \\"quoted\\"\\\\name\\n",result="hit"\} 1\.0$',
+        response.get_data(as_text=True), re.MULTILINE)
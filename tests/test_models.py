@@ -0,0 +1,172 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from threading import Barrier
+
+import pytest  # noqa: F401
+from sqlalchemy import func
+
+from hotel_website.models import (
+    db, Location, Currency, Roomtype, Room, Booking, RoomInventory, LocationPopularity, User, allocate_room)
+
+today = date.today()
+start = today + timedelta(days=10)
+end = today + timedelta(days=12)
+
+
+def make_booking(room: Room = None, booking_start: date = start, booking_end: date = end) -> Booking:
+    return Booking(
+        guests=1, booking_start=booking_start, booking_end=booking_end,
+        name="Test", email="test@example.com", address_1="1 Test Street",
+        postcode="AB1 2CD", country="GB", card_type="V", card_number="4111111111111111",
+        expiry_date=date(today.year + 1, 1, 1), room=room,
+        currency=Currency.query.filter_by(acronym="GBP").first(),
+        user=User.query.filter_by(username="test").first())
+
+
+def inventory(room: Room) -> dict:
+    rows = RoomInventory.query.where(
+        RoomInventory.location_id == room.location_id,
+        RoomInventory.room_type_id == room.room_type_id,
+        RoomInventory.rooms_sold > 0)
+    return {row.night: row.rooms_sold for row in rows}
+
+
+def test_inventory_booking_created(app):
+    with app.app_context():
+        room = Room.query.first()
+        db.session.add(make_booking(room))
+        db.session.add(make_booking(room, end, end + timedelta(days=1)))
+        db.session.commit()
+
+        assert inventory(room) == {
+            start: 1,
+            start + timedelta(days=1): 1,
+            end: 2,
+            end + timedelta(days=1): 1}
+
+
+def test_inventory_booking_updated(app):
+    with app.app_context():
+        room = Room.query.first()
+        booking = make_booking(room)
+        db.session.add(booking)
+        db.session.commit()
+
+        booking.booking_start = end
+        db.session.commit()
+        assert inventory(room) == {end: 1}
+
+        other_room = Room.query.where(Room.room_type_id != room.room_type_id).first()
+        booking.room = other_room
+        db.session.commit()
+        assert inventory(room) == {}
+        assert inventory(other_room) == {end: 1}
+
+
+def test_inventory_booking_deleted(app):
+    with app.app_context():
+        room = Room.query.first()
+        booking = make_booking(room)
+        db.session.add(booking)
+        db.session.commit()
+
+        assert LocationPopularity.query.get(room.location_id).total_bookings == 1
+
+        db.session.delete(booking)
+        db.session.commit()
+
+        assert inventory(room) == {}
+        assert LocationPopularity.query.get(room.location_id).total_bookings == 0
+
+
+def test_rooms_available(app):
+    with app.app_context():
+        location = Location.query.filter_by(name="Aberdeen").first()
+        single = Roomtype.query.filter_by(room_type="S").first()
+        rooms = Room.query.filter_by(location=location, room_type=single).all()
+        total = location.rooms_available(start, end)
+
+        for room in rooms[:3]:
+            db.session.add(make_booking(room))
+        db.session.commit()
+
+        assert location.rooms_available(start, end, room_types=(single,)) == len(rooms) - 3
+        assert location.rooms_available(start, end) == total - 3
+        assert location.rooms_available(end + timedelta(days=1), end + timedelta(days=5)) == total
+
+
+def test_rooms_available_split_stays(app):
+    with app.app_context():
+        location = Location.query.filter_by(name="Aberdeen").first()
+        single = Roomtype.query.filter_by(room_type="S").first()
+        rooms = Room.query.filter_by(location=location, room_type=single).all()
+        stay_end = start + timedelta(days=3)
+
+        # Every room but one is taken for the stay, and the last two rooms are each
+        # taken for half of it, so some room is free on every night but none all stay
+        for room in rooms[:-2]:
+            db.session.add(make_booking(room, start, stay_end))
+        db.session.add(make_booking(rooms[-2], start, start + timedelta(days=1)))
+        db.session.add(make_booking(rooms[-1], start + timedelta(days=2), stay_end))
+        db.session.commit()
+
+        assert max(inventory(rooms[0]).values()) == len(rooms) - 1
+        assert location.rooms_available(start, stay_end, room_types=(single,)) == 0
+        assert location.rooms_available(start, start + timedelta(days=1), room_types=(single,)) == 1
+        assert allocate_room(make_booking(None, start, stay_end), location.id, single.id) is None
+
+
+def test_allocate_room(app):
+    with app.app_context():
+        location = Location.query.filter_by(name="Aberdeen").first()
+        single = Roomtype.query.filter_by(room_type="S").first()
+        total = location.rooms_available(start, end, room_types=(single,))
+
+        booked = [allocate_room(make_booking(), location.id, single.id) for _ in range(total)]
+
+        assert None not in booked
+        assert len({room.id for room in booked}) == total
+        assert allocate_room(make_booking(), location.id, single.id) is None
+        assert location.rooms_available(start, end, room_types=(single,)) == 0
+        # Rooms are still free outside of the booked period
+        assert allocate_room(make_booking(None, end + timedelta(days=1), end + timedelta(days=2)), location.id, single.id)
+
+
+def test_allocate_room_concurrent(file_app):
+    threads = 8
+    attempts = 6
+    barrier = Barrier(threads)
+
+    with file_app.app_context():
+        location = Location.query.filter_by(name="Aberdeen").first()
+        single = Roomtype.query.filter_by(room_type="S").first()
+        location_id, room_type_id = location.id, single.id
+        total = location.rooms_available(start, end, room_types=(single,))
+
+    def book():
+        booked = []
+        with file_app.app_context():
+            barrier.wait()
+            for _ in range(attempts):
+                room = allocate_room(make_booking(), location_id, room_type_id, attempts=20)
+                booked.append(room.id if room else None)
+            db.session.remove()
+        return booked
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = [room_id for booked in executor.map(lambda _: book(), range(threads)) for room_id in booked]
+
+    room_ids = [room_id for room_id in results if room_id is not None]
+    assert threads * attempts > total
+    assert len(room_ids) == total
+    assert len(set(room_ids)) == total
+
+    with file_app.app_context():
+        double_booked = Booking.query.with_entities(Booking.room_id).group_by(
+            Booking.room_id).having(func.count(Booking.id) > 1).all()
+        assert double_booked == []
+        location = Location.query.get(location_id)
+        assert location.rooms_available(start, end, room_types=(single,)) == 0
+        assert RoomInventory.query.with_entities(func.max(RoomInventory.rooms_sold)).scalar() == total
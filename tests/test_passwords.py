@@ -0,0 +1,163 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import time
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+
+import pytest  # noqa: F401
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
+from hotel_website.models import db, User
+from hotel_website.passwords import PasswordHashingBusy, password_hasher
+
+
+def test_hash_and_check(app):
+    with app.app_context():
+        password_hash = password_hasher.hash("password")
+
+        assert password_hash.startswith("pbkdf2:sha256:15000$")
+        assert password_hasher.check(password_hash, "password")
+        assert not password_hasher.check(password_hash, "invalid")
+        assert not password_hasher.needs_rehash(password_hash)
+
+        stats = password_hasher.stats()
+        assert stats["pending"] == 0
+        assert stats["check"]["count"] == 2
+        assert stats["check"]["max_ms"] >= stats["check"]["p95_ms"] >= stats["check"]["p50_ms"] > 0
+
+
+def test_needs_rehash_short_method(app):
+    # werkzeug adds its default number of iterations to the hashes
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256"
+
+    with app.app_context():
+        password_hash = password_hasher.hash("password")
+        assert password_hash.count(":") == 2
+        assert not password_hasher.needs_rehash(password_hash)
+        assert password_hasher.needs_rehash(password_hash.replace("pbkdf2:sha256:", "pbkdf2:sha256:1", 1))
+
+
+def test_needs_rehash_doesnt_hash(app, monkeypatch):
+    def no_hash(*args, **kwargs):
+        raise AssertionError("Hashed a password outside of the pool")
+
+    monkeypatch.setattr("hotel_website.passwords.generate_password_hash", no_hash)
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha512"
+
+    with app.app_context():
+        assert not password_hasher.needs_rehash(f"pbkdf2:sha512:{DEFAULT_PBKDF2_ITERATIONS}$salt$hash")
+        assert password_hasher.needs_rehash("pbkdf2:sha256:15000$salt$hash")
+
+
+class FinishedExecutor:
+    """Runs each function as it is submitted, so its future is done before callbacks are added."""
+    def submit(self, function, *args):
+        future = Future()
+        future.set_result(function(*args))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+def test_finished_hash_keeps_session(app):
+    with app.test_request_context():
+        password_hasher._state["executor"] = FinishedExecutor()
+        user = User.query.filter_by(username="test").first()
+
+        assert password_hasher.check(user.password, "password")
+        assert user in db.session
+        assert password_hasher.stats()["pending"] == 0
+
+
+def test_login_rehash(app, client, auth):
+    app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:16000"
+
+    with app.app_context():
+        old_hash = User.query.filter_by(username="test").first().password
+        assert password_hasher.needs_rehash(old_hash)
+
+    auth.login()
+    with client.session_transaction() as sess:
+        assert sess.get("_user_id") is not None
+
+    with app.app_context():
+        new_hash = User.query.filter_by(username="test").first().password
+        assert new_hash.startswith("pbkdf2:sha256:16000$")
+
+    auth.logout()
+    auth.login()
+    with client.session_transaction() as sess:
+        assert sess.get("_user_id") is not None
+
+    with app.app_context():
+        assert User.query.filter_by(username="test").first().password == new_hash
+
+
+@pytest.mark.parametrize(("path", "username"), (("/login", "test"), ("/register", "test_busy")))
+def test_busy(app, client, path, username):
+    app.config["PASSWORD_HASH_QUEUE_SIZE"] = 0
+
+    response = client.post(path, data={"username": username, "password": "password"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+    with client.session_transaction() as sess:
+        assert sess.get("_user_id") is None
+
+    with app.app_context():
+        assert User.query.filter_by(username="test_busy").first() is None
+        assert password_hasher.stats()["rejected"] == 1
+
+
+def test_hashing_is_bounded(app, monkeypatch):
+    app.config["PASSWORD_HASH_WORKERS"] = 2
+    app.config["PASSWORD_HASH_QUEUE_SIZE"] = 3
+    with app.app_context():
+        password_hasher.shutdown()  # The pool is started again with the new number of workers
+        hashed = password_hasher.stats()["hash"]["count"]
+
+    release = Event()
+    lock = Lock()
+    running = [0, 0]  # Currently running, most ever running at once
+
+    def slow_hash(raw_password, **kwargs):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+        return raw_password
+
+    monkeypatch.setattr("hotel_website.passwords.generate_password_hash", slow_hash)
+
+    def hash_password():
+        with app.app_context():
+            password_hasher.hash("password")
+
+    threads = [Thread(target=hash_password) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+
+    with app.app_context():
+        deadline = time.monotonic() + 5
+        while password_hasher.stats()["pending"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # The queue is full, so further hashes are turned away without waiting
+        for _ in range(2):
+            with pytest.raises(PasswordHashingBusy):
+                password_hasher.hash("password")
+
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        stats = password_hasher.stats()
+        assert running[1] == 2
+        assert stats["pending"] == 0
+        assert stats["rejected"] == 2
+        assert stats["hash"]["count"] == hashed + 3
+
+        password_hasher.shutdown()
@@ -0,0 +1,242 @@
+# George Whittington, Student ID: 20026036, 2022
+
+import os
+from concurrent.futures import Future
+from datetime import datetime
+
+import pytest  # noqa: F401
+
+from hotel_website import pdfs
+from hotel_website.models import db, Booking, Room
+from hotel_website.pdfs import booking_pdf_cache, booking_pdf_render_queue, write_atomic
+
+from .test_models import make_booking
+
+
+@pytest.fixture
+def booking_id(app):
+    with app.app_context():
+        booking = make_booking(Room.query.first())
+        db.session.add(booking)
+        db.session.commit()
+        return booking.id
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Counts the PDFs rendered by the booking PDF route."""
+    rendered = []
+    render_booking_pdf = pdfs.render_booking_pdf
+
+    def counting_render(booking):
+        rendered.append(booking.id)
+        return render_booking_pdf(booking)
+
+    monkeypatch.setattr("hotel_website.hotels.render_booking_pdf", counting_render)
+    return rendered
+
+
+def test_booking_pdf_cached(app, client, auth, booking_id, renders):
+    auth.login()
+
+    first = client.get(f"/booking_{booking_id}.pdf")
+    second = client.get(f"/booking_{booking_id}.pdf")
+
+    assert first.status_code == second.status_code == 200
+    assert first.mimetype == "application/pdf"
+    assert first.data == second.data
+    assert renders == [booking_id]
+    assert len(os.listdir(app.config["PDF_CACHE_DIR"])) == 1
+
+
+def test_booking_pdf_updated(app, client, auth, booking_id, renders):
+    auth.login()
+    client.get(f"/booking_{booking_id}.pdf")
+
+    # Two edits back to back, so both have the same date_updated to the second
+    for guests in (2, 1):
+        with app.app_context():
+            db.session.execute(Booking.__table__.update().where(Booking.id == booking_id).values(
+                guests=guests, date_updated=datetime(2030, 1, 1)))
+            db.session.commit()
+
+        assert client.get(f"/booking_{booking_id}.pdf").status_code == 200
+
+    assert renders == [booking_id, booking_id, booking_id]
+    assert len(os.listdir(app.config["PDF_CACHE_DIR"])) == 1
+
+
+def test_booking_pdf_cache_evict(app):
+    app.config["PDF_CACHE_MAX_BYTES"] = 250
+
+    with app.app_context():
+        rooms = Room.query.limit(3).all()
+        bookings = [make_booking(room) for room in rooms]
+        db.session.add_all(bookings)
+        db.session.commit()
+
+        paths = [booking_pdf_cache.put(booking, b"%PDF" + b"0" * 96) for booking in bookings[:2]]
+        # Serving the first booking makes the second the least recently used
+        os.utime(paths[1], (0, 0))
+        assert booking_pdf_cache.get(bookings[0]) == paths[0]
+        booking_pdf_cache.put(bookings[2], b"%PDF" + b"0" * 96)
+
+        assert booking_pdf_cache.get(bookings[0]) is not None
+        assert booking_pdf_cache.get(bookings[1]) is None
+        assert booking_pdf_cache.get(bookings[2]) is not None
+
+
+def test_booking_pdf_cache_admin_invalidate(app, client, auth, booking_id):
+    auth.login(username="admin", password="password")
+    client.get(f"/booking_{booking_id}.pdf")
+    assert len(os.listdir(app.config["PDF_CACHE_DIR"])) == 1
+
+    response = client.post("/admin/currency/edit/?id=2", data={
+        "full_name": "Euro",
+        "acronym": "EUR",
+        "conversion_rate": "1.10"
+    })
+    assert response.status_code == 302
+    assert os.listdir(app.config["PDF_CACHE_DIR"]) == []
+
+
+@pytest.fixture
+def render_queue(app):
+    app.config["PDF_RENDER_WORKERS"] = 1
+    yield booking_pdf_render_queue
+    with app.app_context():
+        booking_pdf_render_queue.shutdown()
+
+
+def test_render_queue(app, client, auth, booking_id, renders, render_queue):
+    auth.login()
+    assert client.get(f"/room_confirm/{booking_id}").status_code == 200
+
+    with app.app_context():
+        booking = Booking.query.get(booking_id)
+        assert render_queue.status(booking) in ("queued", "rendering", "ready")
+        job = render_queue._state["jobs"].get(booking_id)  # Removed once it has finished
+        if job is not None:
+            job.future.result(timeout=60)
+        assert render_queue.status(booking) == "ready"
+
+    response = client.get(f"/booking_{booking_id}.pdf")
+    assert response.status_code == 200
+    assert response.data.startswith(b"%PDF")
+    assert renders == []
+
+
+def test_render_queue_full(app, booking_id, render_queue):
+    app.config["PDF_RENDER_QUEUE_SIZE"] = 0
+
+    with app.test_request_context():
+        booking = Booking.query.get(booking_id)
+        assert not render_queue.enqueue(booking)
+        assert render_queue.status(booking) is None
+
+
+def test_render_queue_finished_jobs(app, render_queue, monkeypatch):
+    app.config["PDF_RENDER_QUEUE_SIZE"] = 2
+    monkeypatch.setattr(pdfs, "FAILED_RENDERS_KEPT", 2)
+    futures = []
+
+    def submit(html, path):
+        futures.append(Future())
+        return futures[-1]
+
+    monkeypatch.setattr(render_queue, "_submit", submit)
+
+    with app.test_request_context():
+        bookings = [make_booking(room) for room in Room.query.limit(4)]
+        db.session.add_all(bookings)
+        db.session.commit()
+        state = render_queue._state
+
+        assert render_queue.enqueue(bookings[0]) and render_queue.enqueue(bookings[1])
+        assert not render_queue.enqueue(bookings[2])
+        assert state["queued"] == 2
+
+        # Cancelled jobs are forgotten, making room in the queue
+        render_queue.cancel(bookings[0])
+        assert state["queued"] == 1 and bookings[0].id not in state["jobs"]
+        assert render_queue.status(bookings[0]) is None
+
+        # Only the most recent failures are remembered
+        assert render_queue.enqueue(bookings[2])
+        for future in futures[1:]:
+            future.set_exception(RuntimeError("Layout failed"))
+        assert render_queue.enqueue(bookings[3])
+        futures[-1].set_exception(RuntimeError("Layout failed"))
+
+        assert state["queued"] == 0 and state["jobs"] == {}
+        assert list(state["failed"]) == [bookings[2].id, bookings[3].id]
+        assert render_queue.status(bookings[3]) == "failed"
+        assert render_queue.status(bookings[1]) is None
+
+
+def test_render_queue_html_outside_lock(app, render_queue, monkeypatch):
+    render_booking_html = pdfs.render_booking_html
+
+    def checked_render(booking):
+        assert not render_queue._state["lock"].locked()
+        return render_booking_html(booking)
+
+    monkeypatch.setattr(pdfs, "render_booking_html", checked_render)
+    monkeypatch.setattr(render_queue, "_submit", lambda html, path: Future())
+
+    with app.test_request_context():
+        booking = make_booking(Room.query.first())
+        db.session.add(booking)
+        db.session.commit()
+
+        assert render_queue.enqueue(booking)
+        assert render_queue.status(booking) == "queued"
+
+
+def test_render_shares_queued_job(app, render_queue, monkeypatch):
+    futures = []
+
+    def submit(html, path):
+        futures.append(Future())
+        return futures[-1]
+
+    monkeypatch.setattr(render_queue, "_submit", submit)
+
+    with app.test_request_context():
+        booking = make_booking(Room.query.first())
+        db.session.add(booking)
+        db.session.commit()
+
+        assert render_queue.enqueue(booking)
+        assert render_queue.render(booking) is futures[0]
+
+        # A cancelled job is rendered again
+        render_queue.cancel(booking)
+        assert render_queue.render(booking) is futures[1]
+
+
+def test_render_queue_finished_on_submit(app, render_queue, monkeypatch):
+    def submit(html, path):
+        write_atomic(path, b"%PDF-1.4")
+        future = Future()
+        future.set_result(path)
+        return future
+
+    monkeypatch.setattr(render_queue, "_submit", submit)
+
+    with app.test_request_context():
+        booking = make_booking(Room.query.first())
+        db.session.add(booking)
+        db.session.commit()
+
+        # The job finishing as it is queued doesn't remove the request's session
+        assert render_queue.enqueue(booking)
+        assert booking in db.session
+        assert render_queue.status(booking) == "ready"
+        assert render_queue._state["queued"] == 0
+
+
+def test_render_queue_disabled(app, booking_id):
+    with app.test_request_context():
+        booking = Booking.query.get(booking_id)
+        assert not booking_pdf_render_queue.enqueue(booking)
@@ -0,0 +1,72 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from datetime import date, timedelta
+
+import pytest  # noqa: F401
+
+from hotel_website.models import Location, Roomtype, Currency
+from hotel_website.pricing import find_room_prices_batch, find_booking_prices_batch
+
+periods = (
+    (date(2022, 3, 30), date(2022, 4, 2)),
+    (date(2022, 4, 1), date(2022, 4, 1)),
+    (date(2022, 1, 31), date(2022, 3, 1)),
+    (date(2023, 2, 27), date(2023, 3, 2)),
+    (date(2024, 2, 27), date(2024, 3, 2)),
+    (date(2022, 12, 15), date(2023, 3, 14)),
+    (date(2022, 9, 20), date(2022, 12, 18))
+)
+
+
+@pytest.mark.parametrize(("booking_start", "booking_end"), periods)
+def test_find_room_prices_batch(app, booking_start, booking_end):
+    with app.app_context():
+        rooms = [
+            (location, room_type, guests)
+            for location in Location.query.all()
+            for room_type in Roomtype.query.all()
+            for guests in range(1, room_type.max_occupants + 1)]
+
+        for currency in Currency.query.all():
+            # Covers each of the advance booking discount bands
+            for advance in (0, 45, 60, 80):
+                date_booked = booking_start - timedelta(days=advance)
+                expected = [
+                    location.find_room_prices(
+                        room_type=room_type, booking_start=booking_start, booking_end=booking_end,
+                        currency=currency, guests=guests, date_booked=date_booked)
+                    for location, room_type, guests in rooms]
+
+                assert find_room_prices_batch(
+                    rooms, booking_start, booking_end, currency, date_booked=date_booked) == expected
+
+
+def test_find_room_prices_batch_empty(app):
+    with app.app_context():
+        currency = Currency.query.first()
+        assert find_room_prices_batch([], date(2022, 1, 1), date(2022, 1, 2), currency) == []
+
+
+def test_find_booking_prices_batch(app):
+    with app.app_context():
+        locations = Location.query.all()
+        room_types = Roomtype.query.all()
+
+        bookings = []
+        for i, (booking_start, booking_end) in enumerate(periods * 12):
+            room_type = room_types[i % len(room_types)]
+            # Covers each of the advance booking discount bands
+            date_booked = booking_start - timedelta(days=(0, 45, 60, 80)[i % 4])
+            bookings.append((
+                locations[i % len(locations)], room_type, i % room_type.max_occupants + 1,
+                booking_start, booking_end, date_booked))
+
+        for currency in Currency.query.all():
+            expected = [
+                location.find_room_prices(
+                    room_type=room_type, booking_start=booking_start, booking_end=booking_end,
+                    currency=currency, guests=guests, date_booked=date_booked)
+                for location, room_type, guests, booking_start, booking_end, date_booked in bookings]
+
+            assert find_booking_prices_batch(bookings, currency) == expected
+            assert find_booking_prices_batch([], currency) == []
@@ -0,0 +1,111 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from datetime import date, timedelta
+
+import pytest
+
+from hotel_website.models import User, Booking
+
+today = date.today()
+stay_start = today + timedelta(days=20)
+stay_end = today + timedelta(days=22)
+month = today.strftime("%Y-%m")
+end_month = (today.replace(day=1) + timedelta(days=70)).strftime("%Y-%m")
+
+where_to = {"location": 1, "booking_start": stay_start.isoformat(), "booking_end": stay_end.isoformat(), "guests": 1}
+
+booking_form = {
+    "full_name": "Test User",
+    "email": "test@example.com",
+    "address-address_1": "1 Test Street",
+    "address-postcode": "AB1 2CD",
+    "address-country": "GB",
+    "card_details-card_type": "V",
+    "card_details-card_number": "4111 1111 1111 1111",
+    "card_details-security_code": "123",
+    "card_details-expiry_date-expiry_month": 1,
+    "card_details-expiry_date-expiry_year": today.year + 1
+}
+
+# (user logged in as, method, path, query string, form data, most statements allowed)
+# {booking} is replaced with the id of one of load_1's upcoming bookings
+hotels_routes = [
+    (None, "GET", "/", None, None, 13),
+    (None, "POST", "/", None, where_to, 2),
+    (None, "GET", "/search", where_to, None, 6),
+    (None, "POST", "/search", None, where_to, 2),
+    ("load_1", "GET", "/room", {**where_to, "room_type": 1}, None, 5),
+    ("load_1", "POST", "/room", {**where_to, "room_type": 1}, booking_form, 14),
+    ("load_1", "GET", "/room_confirm/{booking}", None, None, 1),
+    ("load_1", "GET", "/booking_{booking}.pdf", None, None, 6),
+    ("load_1", "GET", "/delete_booking/{booking}", None, None, 6),
+    ("load_1", "POST", "/delete_booking/{booking}", None, None, 14),
+    (None, "GET", "/privacy_policy", None, None, 1)
+]
+
+auth_routes = [
+    (None, "GET", "/login", None, None, 1),
+    (None, "POST", "/login", None, {"username": "load_1", "password": "password"}, 1),
+    ("load_1", "GET", "/logout", None, None, 0),
+    (None, "GET", "/register", None, None, 1),
+    (None, "POST", "/register", None, {"username": "new_user", "password": "password"}, 3),
+    ("load_1", "GET", "/my-account", None, None, 2),
+    ("load_1", "GET", "/my-account", {"after": f"{stay_start.isoformat()}_1"}, None, 2),
+    ("load_1", "POST", "/my-account", None, {"username": "load_renamed"}, 6)
+]
+
+admin_routes = [
+    ("admin", "GET", "/admin/", None, None, 0),
+    *[("admin", "GET", f"/admin/{model}/", None, None, 2)
+      for model in ("user", "location", "currency", "roomtype", "room", "booking")],
+    ("admin", "GET", "/admin/booking/", {"page": 3, "sort": 1}, None, 2),
+    ("admin", "GET", "/admin/booking/export/csv/", None, None, 2),
+    ("admin", "GET", "/admin/user/edit/", {"id": 1}, None, 1),
+    ("admin", "GET", "/admin/location/edit/", {"id": 1}, None, 5),
+    ("admin", "GET", "/admin/currency/edit/", {"id": 1}, None, 1),
+    ("admin", "GET", "/admin/roomtype/edit/", {"id": 1}, None, 1),
+    ("admin", "GET", "/admin/room/edit/", {"id": 1}, None, 5),
+    ("admin", "GET", "/admin/booking/edit/", {"id": "{booking}"}, None, 7),
+    ("admin", "GET", "/admin/room/new/", None, None, 2),
+    ("admin", "GET", "/admin/booking/new/", None, None, 3),
+    ("admin", "GET", "/admin/analytics/", None, None, 0),
+    ("admin", "GET", "/admin/analytics/monthly_bookings", None, None, 0),
+    ("admin", "GET", "/admin/analytics/monthly_bookings", {"location": 1, "month": month}, None, 4),
+    ("admin", "POST", "/admin/analytics/compare_bookings", None,
+     {"month": month, "end_month": end_month, "locations": [1, 2, 3]}, 4),
+    ("admin", "POST", "/admin/analytics/occupancy", None,
+     {"start": today.isoformat(), "end": (today + timedelta(days=60)).isoformat(), "locations": [1, 2, 3]}, 4),
+    ("admin", "POST", "/admin/analytics/revenue", None, {"month": month, "end_month": end_month, "currency": 1}, 4),
+    ("admin", "POST", "/admin/analytics/export_pdfs", None, {"month": month, "location": 1}, 3)
+]
+
+
+@pytest.fixture
+def app(load_app):
+    return load_app
+
+
+@pytest.fixture
+def booking_id(app):
+    with app.app_context():
+        return Booking.query.join(Booking.user).where(
+            User.username == "load_1", Booking.booking_end >= today
+        ).order_by(Booking.id).first().id
+
+
+@pytest.mark.parametrize(
+    ("username", "method", "path", "query_string", "data", "limit"),
+    hotels_routes + auth_routes + admin_routes)
+def test_query_count(client, auth, queries, booking_id, username, method, path, query_string, data, limit):
+    if username is not None:
+        auth.login(username=username)
+
+    path = path.format(booking=booking_id)
+    if query_string is not None:
+        query_string = {key: str(value).format(booking=booking_id) for key, value in query_string.items()}
+
+    with queries.at_most(limit):
+        response = client.open(path, method=method, query_string=query_string, data=data)
+        response.get_data()  # Streamed responses query the database as they are read
+
+    assert response.status_code in (200, 302)
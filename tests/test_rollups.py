@@ -0,0 +1,140 @@
+# George Whittington, Student ID: 20026036, 2022
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+import pytest  # noqa: F401
+
+from hotel_website.models import db, Location, Room, Booking, BookingDailyFact
+from hotel_website.rollups import occupancy_report, refresh_booking_facts
+
+from .test_models import make_booking, start
+
+
+def facts() -> dict:
+    return {
+        (row.location_id, row.room_type_id, row.night): (
+            row.rooms_sold, row.guests, round(float(row.revenue), 2), row.arrivals, row.arrival_guests)
+        for row in BookingDailyFact.query.all()}
+
+
+def expected_facts() -> Counter:
+    """Counts rooms sold, guests and arrivals straight from the booking table."""
+    counts = Counter()
+    for booking in Booking.query.all():
+        for i in range((booking.booking_end - booking.booking_start).days + 1):
+            key = (booking.room.location_id, booking.room.room_type_id, booking.booking_start + timedelta(days=i))
+            counts[key + ("rooms_sold",)] += 1
+            counts[key + ("guests",)] += booking.guests
+            counts[key + ("arrivals",)] += int(i == 0)
+            counts[key + ("arrival_guests",)] += booking.guests if i == 0 else 0
+    return counts
+
+
+def assert_facts_match_bookings() -> None:
+    counts = expected_facts()
+    actual = facts()
+    assert set(actual) == {key[:3] for key in counts}
+    for key, (rooms_sold, guests, _, arrivals, arrival_guests) in actual.items():
+        assert (rooms_sold, guests, arrivals, arrival_guests) == (
+            counts[key + ("rooms_sold",)], counts[key + ("guests",)],
+            counts[key + ("arrivals",)], counts[key + ("arrival_guests",)])
+
+
+def backdate_bookings() -> None:
+    """Moves every booking's timestamps an hour back, out of the watermark overlap."""
+    db.session.execute(Booking.__table__.update().values(
+        date_created=datetime.utcnow() - timedelta(hours=1), date_updated=None))
+    db.session.commit()
+
+
+def test_refresh_booking_facts(app):
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1).order_by(Room.room_type_id).all()
+        bookings = [
+            make_booking(rooms[0]),
+            make_booking(rooms[1], start, start),
+            make_booking(rooms[-1], start + timedelta(days=1), start + timedelta(days=40))
+        ]
+        bookings[2].guests = 3
+        db.session.add_all(bookings)
+        db.session.commit()
+
+        assert refresh_booking_facts() == (3, 0)
+        assert_facts_match_bookings()
+
+        # Revenue adds up to each booking's price, in the location's own currency
+        revenue = sum(row.revenue for row in BookingDailyFact.query.all())
+        prices = sum(
+            booking.room.location.find_room_prices(
+                booking.room.room_type, booking.booking_start, booking.booking_end,
+                booking.room.location.currency, booking.guests)[0]
+            for booking in bookings)
+        assert float(revenue) == pytest.approx(prices, abs=0.01)
+
+
+def test_refresh_booking_facts_incremental(app):
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=2).all()
+        bookings = [make_booking(room) for room in rooms[:4]]
+        db.session.add_all(bookings)
+        db.session.commit()
+        backdate_bookings()
+
+        assert refresh_booking_facts() == (4, 0)
+        assert refresh_booking_facts() == (0, 0)
+
+        bookings[0].booking_end = bookings[0].booking_end + timedelta(days=3)
+        bookings[1].guests = 2
+        db.session.delete(bookings[2])
+        db.session.add(make_booking(Room.query.filter_by(location_id=3).first()))
+        db.session.commit()
+
+        assert refresh_booking_facts() == (3, 1)
+        assert_facts_match_bookings()
+
+        incremental = facts()
+        assert refresh_booking_facts(full=True) == (4, 0)
+        assert facts() == incremental
+
+
+def test_refresh_booking_facts_deleted_location_total(app):
+    with app.app_context():
+        room = Location.query.get(1).rooms[0]
+        booking = make_booking(room)
+        db.session.add(booking)
+        db.session.commit()
+        refresh_booking_facts()
+
+        db.session.delete(booking)
+        db.session.commit()
+
+        assert refresh_booking_facts() == (0, 1)
+        assert facts() == {}
+
+
+def test_occupancy_report(app):
+    with app.app_context():
+        rooms = Room.query.filter_by(location_id=1).order_by(Room.room_type_id).all()
+        db.session.add(make_booking(rooms[0], start, start + timedelta(days=1)))
+        db.session.add(make_booking(rooms[-1], start + timedelta(days=1), start + timedelta(days=1)))
+        db.session.commit()
+        refresh_booking_facts()
+
+        report = occupancy_report([1, 2], start, start + timedelta(days=2))
+        assert report.nights == [start + timedelta(days=i) for i in range(3)]
+        assert report.rows[-2:] == [(1, None), (2, None)]
+        assert report.capacity[report.rows.index((1, None))] == len(rooms)
+
+        single = report.rows.index((1, rooms[0].room_type_id))
+        family = report.rows.index((1, rooms[-1].room_type_id))
+        whole = report.rows.index((1, None))
+        assert report.rooms_sold[single].tolist() == [1, 1, 0]
+        assert report.rooms_sold[family].tolist() == [0, 1, 0]
+        assert report.rooms_sold[whole].tolist() == [1, 2, 0]
+        assert report.occupancy[whole].tolist() == pytest.approx([1 / len(rooms), 2 / len(rooms), 0])
+        assert report.revpar[whole].tolist() == pytest.approx(
+            (report.revenue[single] + report.revenue[family]) / len(rooms))
+
+        assert not report.rooms_sold[report.rows.index((2, None))].any()
+        assert occupancy_report([], start, start).rows == []